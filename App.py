@@ -3,11 +3,72 @@ import streamlit as st
 import pandas as pd
 import json
 import os
+import bisect
+import codecs
+import gzip
+import hashlib
+import heapq
+import hmac
+import io
+import ipaddress
+import mimetypes
+import re
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
+from email.utils import formatdate, parsedate_to_datetime
+from html import escape as html_escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlsplit
+from streamlit.errors import StreamlitAPIException
 from streamlit_autorefresh import st_autorefresh
 import plotly.express as px
 import snowflake.connector
 
+try:
+    import zstandard as zstd  # optional: better ratio/speed for snapshot history
+except ImportError:
+    zstd = None
+try:
+    import openpyxl  # attachment previews (XLSX excerpts)
+except ImportError:
+    openpyxl = None
+try:
+    import pdfplumber  # attachment previews (PDF first pages)
+except ImportError:
+    pdfplumber = None
+try:
+    from PIL import Image  # attachment previews (thumbnails)
+except ImportError:
+    Image = None
+try:
+    import invoice_extract  # PDF invoice text, run as a child process (needs pdfplumber)
+except ImportError:
+    invoice_extract = None
+from helpcenter_store import (
+    COMMENTS_DIR, COMMENTS_FILE, EVENTS_DIR, EVENT_LOG_FILE, REQUESTS_FILE, STORE_BACKEND, STORE_DB_FILE,
+    RecordVersionConflict, apply_event, atomic_write_text, comment_seqs, diff_events, dir_lock, ensure_record_ids,
+    event_log_status, new_record_id, primary_lock, publish, read_comment_rows, read_comment_threads, read_events,
+    read_primary_texts, rebase_events, rebuild_from_events, record_positions, record_version,
+    replace_primary_state, start_primary_syncer, store_change_counter, submit_write, subscribe,
+    _comment_id, _group_commit_state, _last_logged_seq, _primary_signature, _read_checkpoint,
+    _read_primary_files,
+)
+from helpcenter_attachments import (
+    ATTACHMENT_QUARANTINE, PREVIEW_DIR, UPLOADS_DIR,
+    attachment_path, attachment_storage_report, collect_orphan_attachments, invoice_text_path,
+    on_derived_dropped, preview_path, start_attachment_gc, store_attachment,
+    _LEGACY_UPLOAD_NAME, _SHA256_HEX, _attachment_gc_state, _legacy_uploads,
+)
+
 
 # ----- PORTABLE EXPORT CONFIG (no secrets) -----
 from pathlib import Path
@@ -43,7 +104,31 @@ EXPORT_ORDERS_CSV       = str(EXPORT_DIR / "orders.csv")
 EXPORT_REQUIREMENTS_CSV = str(EXPORT_DIR / "requirements.csv")
 EXPORT_COMMENTS_CSV     = str(EXPORT_DIR / "comments.csv")
 EXPORT_XLSX             = str(EXPORT_DIR / "HelpCenter_Snapshot.xlsx")
-EXPORT_JSON             = str(EXPORT_DIR / "HelpCenter_Snapshot.json")
+EXPORT_JSON             = str(EXPORT_DIR / "HelpCenter_Snapshot.json")  # no longer written; read by restores
+SNAPSHOT_JSON_INDENT    = None        # None = compact snapshot files; 2 = pretty (~2x bigger)
+SNAPSHOT_CHUNK_BYTES    = 64 * 1024   # streaming writer flush size
+
+# Typed columnar snapshot (snappy Parquet) — much smaller/faster than the CSVs
+EXPORT_ORDERS_PARQUET       = str(EXPORT_DIR / "orders.parquet")
+EXPORT_ORDER_ITEMS_PARQUET  = str(EXPORT_DIR / "order_items.parquet")
+EXPORT_REQUIREMENTS_PARQUET = str(EXPORT_DIR / "requirements.parquet")
+EXPORT_COMMENTS_PARQUET     = str(EXPORT_DIR / "comments.parquet")
+EXPORT_PARQUET_MANIFEST     = str(EXPORT_DIR / "parquet_manifest.json")  # complete? requests left out
+
+# Rotated, compressed snapshot history (restore points) + retention policy
+SNAPSHOT_HISTORY_DIR   = EXPORT_DIR / "history"
+SNAPSHOT_HISTORY_INDEX = str(SNAPSHOT_HISTORY_DIR / "index.json")
+SNAPSHOT_HISTORY_CHAIN = str(SNAPSHOT_HISTORY_DIR / "chain.json")
+SNAPSHOT_BASE_EVERY    = 50          # delta points before a new full base
+SNAPSHOT_PRUNE_EVERY   = 10 * 60     # background pruner period (seconds)
+SNAPSHOT_BACKUP_FILE   = str(EXPORT_DIR / "HelpCenter_Snapshot.json.gz")   # served by the guard
+SNAPSHOT_BACKUP_STATUS = str(EXPORT_DIR / "backup_status.json")  # last backup per process / per user
+SNAPSHOT_BACKUP_EVERY  = 30          # scheduler poll (seconds); rebuilds only when data changed
+SNAPSHOT_RETENTION     = {           # everything from the last hour, then newest per bucket
+    "hourly": 24,                    #   …per hour for 24 hours
+    "daily": 14,                     #   …per day for 14 days
+    "weekly": 8,                     #   …per ISO week for 8 weeks
+}
 
 
 
@@ -71,117 +156,2783 @@ def rebuild_from_csvs():
             qtys   = [x for x in g["Qty"].tolist()]
             prices = [x for x in g["Price"].tolist()]
 
-            base = {
-                "Status": stat,
-                "Date": dte,
-                "ETA Date": eta,
-                "Shipping Method": ship,
-                "Encargado": enc,
-                "Pago": pago,
-                "Description": descs,
-                "Quantity": qtys,
-            }
+            base = {
+                "Status": stat,
+                "Date": dte,
+                "ETA Date": eta,
+                "Shipping Method": ship,
+                "Encargado": enc,
+                "Pago": pago,
+                "Description": descs,
+                "Quantity": qtys,
+            }
+
+            if t == "💲":
+                req = {**base,
+                    "Type": "💲",
+                    "Invoice": ref,
+                    "Order#": "",
+                    "Cost": prices,
+                    "Proveedor": partner
+                }
+            else:
+                req = {**base,
+                    "Type": "🛒",
+                    "Order#": ref,
+                    "Invoice": "",
+                    "Sale Price": prices,
+                    "Cliente": partner
+                }
+            reqs_by_old[int(old_idx)] = req
+
+    # Requirements (📑)
+    if os.path.exists(EXPORT_REQUIREMENTS_CSV) and os.path.getsize(EXPORT_REQUIREMENTS_CSV) > 0:
+        rdf = pd.read_csv(EXPORT_REQUIREMENTS_CSV).fillna("")
+        for old_idx, g in rdf.groupby("RequestIndex"):
+            items = []
+            for _, row in g.iterrows():
+                items.append({
+                    "Description": str(row.get("Description","")),
+                    "Target Price": str(row.get("Target Price","")),
+                    "QTY": row.get("Qty","")
+                })
+            reqs_by_old[int(old_idx)] = {
+                "Type": "📑",
+                "Items": items,
+                "Vendedor Encargado": str(g["Vendedor Encargado"].iloc[0]) if "Vendedor Encargado" in g else "",
+                "Comprador Encargado": str(g["Comprador Encargado"].iloc[0]) if "Comprador Encargado" in g else "",
+                "Fecha": str(g["Fecha"].iloc[0]) if "Fecha" in g else "",
+                "Status": str(g["Status"].iloc[0]) if "Status" in g else "OPEN",
+            }
+
+    # Comments
+    comments_old = {}
+    if os.path.exists(EXPORT_COMMENTS_CSV) and os.path.getsize(EXPORT_COMMENTS_CSV) > 0:
+        cdf = pd.read_csv(EXPORT_COMMENTS_CSV).fillna("")
+        for old_idx, g in cdf.groupby("RequestIndex"):
+            lst = []
+            for _, row in g.iterrows():
+                entry = {
+                    "author": str(row.get("Author","")),
+                    "when": str(row.get("When","")),
+                    "text": str(row.get("Text","")),
+                }
+                att = str(row.get("Attachment",""))
+                if att.strip():
+                    entry["attachment"] = att
+                sha = str(row.get("AttachmentSha",""))
+                if sha.strip():
+                    entry["attachment_sha"] = sha
+                lst.append(entry)
+            comments_old[int(old_idx)] = lst
+
+    # Reindex requests contiguously and remap comment keys
+    sorted_pairs = sorted(reqs_by_old.items())  # [(old_idx, req), ...]
+    requests, idx_map = [], {}
+    for new_idx, (old_idx, req) in enumerate(sorted_pairs):
+        idx_map[old_idx] = new_idx
+        requests.append(req)
+
+    comments = {}
+    for old_idx, lst in comments_old.items():
+        if old_idx in idx_map:
+            comments[str(idx_map[old_idx])] = lst
+
+    return requests, comments
+
+
+# ----- PARQUET SNAPSHOT (typed, snappy) -----
+# The typed columns model these fields. Anything else a record carries goes to
+# its "Extra" JSON, as does a modelled value its column would not give back
+# as it was (an int price, a non-ISO date, ...), and so do the modelled keys
+# it lacks (listed under "__absent__"). Requests of another Type are left out.
+ORDER_KEYS = {"Type", "Invoice", "Order#", "Status", "Date", "ETA Date", "Shipping Method",
+              "Encargado", "Pago", "Description", "Quantity", "_id", "_version"}  # + the Type's partner/price keys
+REQUIREMENT_KEYS = {"Type", "Items", "Vendedor Encargado", "Comprador Encargado", "Fecha", "Status",
+                    "_id", "_version"}
+COMMENT_KEYS = {"author", "when", "text", "attachment", "attachment_sha", "status_change", "read_by", "seq"}
+ABSENT_KEY = "__absent__"
+
+
+def _as_list(v):
+    if isinstance(v, list):
+        return v
+    return [] if v in (None, "") else [v]
+
+
+def _split_number(v):
+    """Typed column value + text fallback, so mixed '5' / 5 / 'N/A' cells round-trip."""
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return float(v), None
+    return None, ("" if v is None else str(v))
+
+
+def _join_number(num, text, as_int=False):
+    if text is not None and not pd.isna(text):
+        return text
+    if num is None or pd.isna(num):
+        return None
+    if as_int and float(num).is_integer():
+        return int(num)
+    return float(num)
+
+
+def _same(a, b):
+    return type(a) is type(b) and a == b
+
+
+def _is_str(v):
+    return isinstance(v, str)
+
+
+def _is_int(v):
+    return isinstance(v, int) and not isinstance(v, bool)
+
+
+def _is_qty(v):
+    return _same(_join_number(*_split_number(v), as_int=True), v)
+
+
+def _is_price(v):
+    return _same(_join_number(*_split_number(v)), v)
+
+
+def _is_stamp(fmt):
+    """'' or a `fmt` string the datetime column prints back unchanged."""
+    def ok(v):
+        if not isinstance(v, str):
+            return False
+        if v == "":
+            return True
+        try:
+            ts = datetime.strptime(v, fmt)
+        except ValueError:
+            return False
+        return ts.strftime(fmt) == v and pd.Timestamp.min <= pd.Timestamp(ts) <= pd.Timestamp.max
+    return ok
+
+
+_is_date, _is_when = _is_stamp("%Y-%m-%d"), _is_stamp("%Y-%m-%d %H:%M")
+
+
+def _is_req_item(it):
+    return (isinstance(it, dict) and set(it) == {"Description", "Target Price", "QTY"}
+            and _is_str(it["Description"]) and _is_str(it["Target Price"]) and _is_qty(it["QTY"]))
+
+
+def _is_status_change(v):
+    return isinstance(v, dict) and set(v) == {"old", "new"} and _is_str(v["old"]) and _is_str(v["new"])
+
+
+def _is_str_list(v):
+    return isinstance(v, list) and all(isinstance(u, str) for u in v)
+
+
+def _typed(d, key, ok, extra, optional=False):
+    """d[key] for its typed column if ok(value); else None, with the value (or its absence) kept in `extra`."""
+    if key not in d:
+        if not optional:
+            extra.setdefault(ABSENT_KEY, []).append(key)
+        return None
+    if ok(d[key]):
+        return d[key]
+    extra[key] = d[key]
+    return None
+
+
+def _typed_list(d, key, ok_item, extra):
+    """d[key] as a list for the item rows; kept whole in `extra` unless every item comes back as it was."""
+    if key not in d:
+        extra.setdefault(ABSENT_KEY, []).append(key)
+        return []
+    v = d[key]
+    if not (isinstance(v, list) and all(ok_item(x) for x in v)):
+        extra[key] = v
+    return _as_list(v)
+
+
+def _unmodelled(d, known):
+    return {k: v for k, v in d.items() if k not in known}
+
+
+def _extra_json(extra):
+    return json.dumps(extra, ensure_ascii=False) if extra else None
+
+
+def build_parquet_frames(requests, comments):
+    """
+    Flatten requests/comments into typed dataframes: orders, order_items,
+    requirements, comments. Returns (frames, skipped, orphan_threads):
+    `skipped` lists the requests of an unknown Type that were left out
+    ({"index", "type"}); orphan threads (keys naming no request) are kept
+    with RequestIndex -1 and their key in "Thread".
+    """
+    orders, items, reqs, comms, skipped = [], [], [], [], []
+
+    for i, r in enumerate(requests or []):
+        t = r.get("Type")
+        if t in ("💲", "🛒"):
+            price_key = "Cost" if t == "💲" else "Sale Price"
+            partner_key = "Proveedor" if t == "💲" else "Cliente"
+            extra = _unmodelled(r, ORDER_KEYS | {price_key, partner_key})
+            orders.append({
+                "RequestIndex": i,
+                "RecordId": _typed(r, "_id", _is_str, extra, optional=True),
+                "Version": _typed(r, "_version", _is_int, extra, optional=True),
+                "Type": t,
+                "Invoice": _typed(r, "Invoice", _is_str, extra),
+                "Order#": _typed(r, "Order#", _is_str, extra),
+                "Status": _typed(r, "Status", _is_str, extra),
+                "Ordered Date": _typed(r, "Date", _is_date, extra),
+                "ETA Date": _typed(r, "ETA Date", _is_date, extra),
+                "Shipping Method": _typed(r, "Shipping Method", _is_str, extra),
+                "Encargado": _typed(r, "Encargado", _is_str, extra),
+                "Partner": _typed(r, partner_key, _is_str, extra),
+                "Pago": _typed(r, "Pago", _is_str, extra),
+            })
+            descs  = _typed_list(r, "Description", _is_str, extra)
+            qtys   = _typed_list(r, "Quantity", _is_qty, extra)
+            prices = _typed_list(r, price_key, _is_price, extra)
+            orders[-1]["Extra"] = _extra_json(extra)
+            for j in range(max(len(descs), len(qtys), len(prices))):
+                qty, qty_txt     = _split_number(qtys[j])   if j < len(qtys)   else (None, None)
+                price, price_txt = _split_number(prices[j]) if j < len(prices) else (None, None)
+                items.append({
+                    "RequestIndex": i,
+                    "Item #": j + 1,
+                    "Description": str(descs[j]) if j < len(descs) else None,
+                    "Qty": qty, "QtyText": qty_txt,
+                    "Price": price, "PriceText": price_txt,
+                })
+
+        elif t == "📑":
+            extra = _unmodelled(r, REQUIREMENT_KEYS)
+            base = {
+                "RequestIndex": i,
+                "RecordId": _typed(r, "_id", _is_str, extra, optional=True),
+                "Version": _typed(r, "_version", _is_int, extra, optional=True),
+                "Vendedor Encargado": _typed(r, "Vendedor Encargado", _is_str, extra),
+                "Comprador Encargado": _typed(r, "Comprador Encargado", _is_str, extra),
+                "Fecha": _typed(r, "Fecha", _is_date, extra),
+                "Status": _typed(r, "Status", _is_str, extra),
+            }
+            its = [it if isinstance(it, dict) else {} for it in _typed_list(r, "Items", _is_req_item, extra)]
+            base["Extra"] = _extra_json(extra)
+            if not its:
+                # keep item-less requirements so the restore is complete
+                reqs.append({**base, "Item #": 0, "Description": None, "Target Price": None,
+                             "Qty": None, "QtyText": None})
+            for j, it in enumerate(its):
+                qty, qty_txt = _split_number(it.get("QTY", ""))
+                reqs.append({**base, "Extra": None if j else base["Extra"],  # on the request's first row only
+                             "Item #": j + 1,
+                             "Description": str(it.get("Description", "")),
+                             "Target Price": str(it.get("Target Price", "")),
+                             "Qty": qty, "QtyText": qty_txt})
+
+        else:
+            skipped.append({"index": i, "type": t})
+
+    orphan_threads = 0
+    for k, lst in (comments or {}).items():
+        k_int = int(k) if str(k).isdigit() and str(int(k)) == str(k) else -1
+        if not 0 <= k_int < len(requests or []):
+            k_int = -1  # not a request's thread; "Thread" keeps its key
+            orphan_threads += bool(lst)
+        for j, c in enumerate(lst or []):
+            extra = _unmodelled(c, COMMENT_KEYS)
+            sc = _typed(c, "status_change", _is_status_change, extra, optional=True) or {}
+            comms.append({
+                "RequestIndex": k_int,
+                "Thread": k,
+                "Seq": j,
+                "CommentSeq": _typed(c, "seq", _is_int, extra, optional=True),
+                "Author": _typed(c, "author", _is_str, extra),
+                "When": _typed(c, "when", _is_when, extra),
+                "Text": _typed(c, "text", _is_str, extra),
+                "Attachment": _typed(c, "attachment", _is_str, extra, optional=True),
+                "AttachmentSha": _typed(c, "attachment_sha", _is_str, extra, optional=True),
+                "StatusOld": sc.get("old"),
+                "StatusNew": sc.get("new"),
+                "ReadBy": _typed(c, "read_by", _is_str_list, extra, optional=True),
+                "Extra": _extra_json(extra),
+            })
+
+    def _frame(rows, columns, ints=(), nullable_ints=(), floats=(), dates=(), timestamps=()):
+        df = pd.DataFrame(rows, columns=columns)
+        for col in columns:
+            if col in ints:
+                df[col] = df[col].astype("int64")
+            elif col in nullable_ints:
+                df[col] = df[col].astype("Int64")
+            elif col in floats:
+                df[col] = pd.to_numeric(df[col], errors="coerce").astype("float64")
+            elif col in dates:
+                df[col] = pd.to_datetime(df[col], errors="coerce", format="%Y-%m-%d")
+            elif col in timestamps:
+                df[col] = pd.to_datetime(df[col], errors="coerce", format="%Y-%m-%d %H:%M")
+            elif col != "ReadBy":
+                df[col] = df[col].astype("string")
+        return df
+
+    frames = {
+        "orders": _frame(orders,
+            ["RequestIndex", "RecordId", "Version", "Type", "Invoice", "Order#", "Status", "Ordered Date",
+             "ETA Date", "Shipping Method", "Encargado", "Partner", "Pago", "Extra"],
+            ints=("RequestIndex",), nullable_ints=("Version",), dates=("Ordered Date", "ETA Date")),
+        "order_items": _frame(items,
+            ["RequestIndex", "Item #", "Description", "Qty", "QtyText", "Price", "PriceText"],
+            ints=("RequestIndex", "Item #"), floats=("Qty", "Price")),
+        "requirements": _frame(reqs,
+            ["RequestIndex", "RecordId", "Version", "Item #", "Description", "Target Price", "Qty", "QtyText",
+             "Vendedor Encargado", "Comprador Encargado", "Fecha", "Status", "Extra"],
+            ints=("RequestIndex", "Item #"), nullable_ints=("Version",), floats=("Qty",), dates=("Fecha",)),
+        "comments": _frame(comms,
+            ["RequestIndex", "Thread", "Seq", "CommentSeq", "Author", "When", "Text", "Attachment",
+             "AttachmentSha", "StatusOld", "StatusNew", "ReadBy", "Extra"],
+            ints=("RequestIndex", "Seq"), nullable_ints=("CommentSeq",), timestamps=("When",)),
+    }
+    return frames, skipped, orphan_threads
+
+
+def _parquet_paths():
+    return {
+        "orders":       globals().get("EXPORT_ORDERS_PARQUET",       str(EXPORT_DIR / "orders.parquet")),
+        "order_items":  globals().get("EXPORT_ORDER_ITEMS_PARQUET",  str(EXPORT_DIR / "order_items.parquet")),
+        "requirements": globals().get("EXPORT_REQUIREMENTS_PARQUET", str(EXPORT_DIR / "requirements.parquet")),
+        "comments":     globals().get("EXPORT_COMMENTS_PARQUET",     str(EXPORT_DIR / "comments.parquet")),
+    }
+
+
+def _parquet_manifest_path():
+    return globals().get("EXPORT_PARQUET_MANIFEST", str(EXPORT_DIR / "parquet_manifest.json"))
+
+
+def write_parquet_snapshot(requests, comments):
+    """
+    Write the four typed tables as snappy-compressed Parquet (needs pyarrow),
+    then the manifest. Requests of a Type the tables don't model are left out
+    and listed there; restores skip a set that is incomplete.
+    Returns (paths, manifest).
+    """
+    frames, skipped, orphan_threads = build_parquet_frames(requests, comments)
+    paths, manifest_path = _parquet_paths(), _parquet_manifest_path()
+    atomic_write_text(manifest_path, json.dumps({"complete": False}))  # until all four tables are new
+    for name, df in frames.items():
+        df.to_parquet(paths[name], index=False, compression="snappy")
+    manifest = {"complete": not skipped, "requests": len(requests or []),
+                "skipped": skipped, "orphan_threads": orphan_threads}
+    atomic_write_text(manifest_path, json.dumps(manifest, ensure_ascii=False))
+    return paths, manifest
+
+
+def parquet_snapshot_mtime():
+    """mtime of the oldest Parquet table, or None if the set is incomplete (a table missing, requests left out)."""
+    paths = list(_parquet_paths().values())
+    if not all(os.path.exists(p) and os.path.getsize(p) > 0 for p in paths):
+        return None
+    if os.path.exists(_parquet_manifest_path()):  # sets written before the manifest are always complete
+        try:
+            with open(_parquet_manifest_path(), "r", encoding="utf-8") as f:
+                complete = json.load(f).get("complete", False)
+        except (OSError, ValueError):
+            complete = False
+        if not complete:
+            return None
+    return min(os.path.getmtime(p) for p in paths)
+
+
+def load_parquet_snapshot(tables=None):
+    """Fast loader: {name: DataFrame} for the requested tables (default: all four)."""
+    paths = _parquet_paths()
+    return {name: pd.read_parquet(paths[name]) for name in (tables or paths)}
+
+
+def rebuild_from_parquet(frames=None):
+    """
+    Rebuild requests/comments from the Parquet snapshot (or `frames`): field
+    by field from the typed columns, then each record's "Extra". Snapshots
+    that still carry a "Raw" JSON column are read from it.
+    """
+    def _s(v):
+        return "" if v is None or pd.isna(v) else str(v)
+
+    def _d(v):
+        return "" if v is None or pd.isna(v) else v.strftime("%Y-%m-%d")
+
+    def _raw(row):
+        v = row.get("Raw")
+        return None if v is None or pd.isna(v) else json.loads(v)
+
+    def _finish(rec, row, ids=True):
+        if ids:
+            if not pd.isna(row.get("RecordId")):
+                rec["_id"] = str(row["RecordId"])
+            if not pd.isna(row.get("Version")):
+                rec["_version"] = int(row["Version"])
+        v = row.get("Extra")
+        extra = {} if v is None or pd.isna(v) else json.loads(v)
+        for key in extra.pop(ABSENT_KEY, []):
+            rec.pop(key, None)
+        rec.update(extra)
+        return rec
+
+    frames = frames if frames is not None else load_parquet_snapshot()
+    reqs_by_old = {}
+
+    items_by_req = {}
+    for row in frames["order_items"].sort_values(["RequestIndex", "Item #"]).to_dict("records"):
+        items_by_req.setdefault(row["RequestIndex"], []).append(row)
+
+    for row in frames["orders"].to_dict("records"):
+        if _raw(row) is not None:
+            reqs_by_old[int(row["RequestIndex"])] = _raw(row)
+            continue
+        t = row["Type"]
+        price_key = "Cost" if t == "💲" else "Sale Price"
+        descs, qtys, prices = [], [], []
+        for it in items_by_req.get(row["RequestIndex"], []):
+            if it["Description"] is not None and not pd.isna(it["Description"]):
+                descs.append(it["Description"])
+            q = _join_number(it["Qty"], it["QtyText"], as_int=True)
+            if q is not None:
+                qtys.append(q)
+            p = _join_number(it["Price"], it["PriceText"])
+            if p is not None:
+                prices.append(p)
+        req = {
+            "Type": t,
+            "Invoice": _s(row["Invoice"]),
+            "Order#": _s(row["Order#"]),
+            "Date": _d(row["Ordered Date"]),
+            "Status": _s(row["Status"]),
+            "Shipping Method": _s(row["Shipping Method"]),
+            "ETA Date": _d(row["ETA Date"]),
+            "Description": descs,
+            "Quantity": qtys,
+            price_key: prices,
+            "Proveedor" if t == "💲" else "Cliente": _s(row["Partner"]),
+            "Encargado": _s(row["Encargado"]),
+            "Pago": _s(row["Pago"]),
+        }
+        reqs_by_old[int(row["RequestIndex"])] = _finish(req, row)
+
+    rdf = frames["requirements"].sort_values(["RequestIndex", "Item #"])
+    for old_idx, g in rdf.groupby("RequestIndex"):
+        first = g.iloc[0]
+        if _raw(first) is not None:
+            reqs_by_old[int(old_idx)] = _raw(first)
+            continue
+        items = []
+        for it in g.to_dict("records"):
+            if it["Item #"] == 0:
+                continue
+            q = _join_number(it["Qty"], it["QtyText"], as_int=True)
+            items.append({
+                "Description": _s(it["Description"]),
+                "Target Price": _s(it["Target Price"]),
+                "QTY": "" if q is None else q,
+            })
+        req = {
+            "Type": "📑",
+            "Items": items,
+            "Vendedor Encargado": _s(first["Vendedor Encargado"]),
+            "Comprador Encargado": _s(first["Comprador Encargado"]),
+            "Fecha": _d(first["Fecha"]),
+            "Status": _s(first["Status"]),
+        }
+        reqs_by_old[int(old_idx)] = _finish(req, first)
+
+    threads = {}  # key -> (RequestIndex, comments)
+    cdf = frames["comments"].sort_values(["RequestIndex", "Seq"])
+    for row in cdf.to_dict("records"):
+        req_idx = int(row["RequestIndex"])
+        key = row.get("Thread")
+        key = str(req_idx) if key is None or pd.isna(key) else key
+        thread = threads.setdefault(key, (req_idx, []))[1]
+        if _raw(row) is not None:
+            thread.append(_raw(row))
+            continue
+        when = row["When"]
+        entry = {
+            "author": _s(row["Author"]),
+            "text": _s(row["Text"]),
+            "when": "" if when is None or pd.isna(when) else when.strftime("%Y-%m-%d %H:%M"),
+        }
+        if not pd.isna(row.get("CommentSeq")):
+            entry["seq"] = int(row["CommentSeq"])
+        if row["Attachment"] is not None and not pd.isna(row["Attachment"]):
+            entry["attachment"] = row["Attachment"]
+        if not pd.isna(row.get("AttachmentSha")):
+            entry["attachment_sha"] = str(row["AttachmentSha"])
+        if not (pd.isna(row["StatusOld"]) and pd.isna(row["StatusNew"])):
+            entry["status_change"] = {"old": _s(row["StatusOld"]), "new": _s(row["StatusNew"])}
+        if row["ReadBy"] is not None:
+            entry["read_by"] = [str(u) for u in row["ReadBy"]]
+        thread.append(_finish(entry, row, ids=False))
+
+    # Reindex requests contiguously and remap request thread keys (same as CSV rebuild)
+    requests, idx_map = [], {}
+    for new_idx, (old_idx, req) in enumerate(sorted(reqs_by_old.items())):
+        idx_map[old_idx] = str(new_idx)
+        requests.append(req)
+
+    comments = {}
+    for key, (req_idx, thread) in threads.items():
+        if req_idx < 0:
+            comments[key] = thread  # not a request's thread: kept under its key
+        elif req_idx in idx_map:
+            comments[idx_map[req_idx]] = thread
+    return requests, comments
+
+
+# ----- STREAMING SNAPSHOT ENCODER -----
+def iter_snapshot_json(requests, comments, indent=None, meta=None):
+    """
+    Encode {**meta, "requests": [...], "comments": {...}} one request / one
+    comment thread at a time, so the full document never sits in memory.
+    indent=None is compact; indent=2 matches json.dumps(..., indent=2) exactly.
+    """
+    kv = ": " if indent else ":"
+    nl1 = "\n" + " " * indent if indent else ""
+    nl2 = "\n" + " " * (2 * indent) if indent else ""
+
+    def enc(obj):
+        if not indent:
+            return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+        return json.dumps(obj, ensure_ascii=False, indent=indent).replace("\n", nl2)
+
+    yield "{"
+    for k, v in (meta or {}).items():
+        yield nl1 + json.dumps(k) + kv + json.dumps(v, ensure_ascii=False) + ","
+    yield nl1 + '"requests"' + kv + "["
+    for i, r in enumerate(requests or []):
+        yield ("," if i else "") + nl2 + enc(r)
+    yield (nl1 if requests else "") + "]," + nl1 + '"comments"' + kv + "{"
+    for i, (k, thread) in enumerate((comments or {}).items()):
+        yield ("," if i else "") + nl2 + json.dumps(str(k), ensure_ascii=False) + kv + enc(thread)
+    yield (nl1 if comments else "") + "}" + ("\n" if indent else "") + "}"
+
+
+def write_snapshot_stream(fp, requests, comments, indent=None, meta=None):
+    """Write iter_snapshot_json() to a binary file/stream in ~64 KB chunks. Returns bytes written."""
+    buf, pending, written = [], 0, 0
+    for chunk in iter_snapshot_json(requests, comments, indent=indent, meta=meta):
+        buf.append(chunk)
+        pending += len(chunk)
+        if pending >= SNAPSHOT_CHUNK_BYTES:
+            data = "".join(buf).encode("utf-8")
+            fp.write(data)
+            written += len(data)
+            buf, pending = [], 0
+    if buf:
+        data = "".join(buf).encode("utf-8")
+        fp.write(data)
+        written += len(data)
+    return written
+
+
+# ----- SNAPSHOT HISTORY (rotated, compressed restore points: full bases + deltas) -----
+@st.cache_resource
+def _history_state():
+    """Process-wide lock (plus a flock on the folder, see dir_lock) + pruner stats."""
+    return {"lock": threading.Lock(), "last_prune": None, "removed": 0, "error": None}
+
+
+def _open_archive(path, mode="rb"):
+    if str(path).endswith(".zst"):
+        if zstd is None:
+            raise RuntimeError("zstandard is not installed; cannot read .zst snapshot")
+        if "r" in mode:
+            return zstd.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+        return zstd.ZstdCompressor(level=10).stream_writer(open(path, "wb"), closefd=True)
+    return gzip.open(path, mode, compresslevel=6) if "w" in mode else gzip.open(path, mode)
+
+
+def _read_archive(name):
+    with _open_archive(SNAPSHOT_HISTORY_DIR / name, "rb") as f:
+        return json.load(f)
+
+
+def _read_history_index():
+    """Index entries (newest first). Rebuilt from file names if missing/corrupt."""
+    try:
+        with open(SNAPSHOT_HISTORY_INDEX, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        pass
+    # HelpCenter_Snapshot_<YYYYmmdd_HHMMSS>_<seq>.<base|delta>.json.<gz|zst>
+    entries = []
+    if SNAPSHOT_HISTORY_DIR.exists():
+        for p in SNAPSHOT_HISTORY_DIR.glob("HelpCenter_Snapshot_*.json.*"):
+            try:
+                stem, kind = p.name[len("HelpCenter_Snapshot_"):].split(".")[:2]
+                ts = datetime.strptime(stem[:15], "%Y%m%d_%H%M%S")
+                seq = int(stem[16:])
+            except ValueError:
+                continue
+            entries.append({"file": p.name, "kind": kind, "seq": seq,
+                            "ts": ts.isoformat(timespec="seconds"),
+                            "epoch": ts.timestamp(), "bytes": p.stat().st_size})
+    base = None
+    for e in sorted(entries, key=lambda e: e["seq"]):
+        if e["kind"] == "base":
+            base = e["file"]
+        e["base"] = base
+    return sorted(entries, key=lambda e: e["seq"], reverse=True)
+
+
+def _write_history_index(entries):
+    tmp = SNAPSHOT_HISTORY_INDEX + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(entries, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, SNAPSHOT_HISTORY_INDEX)
+
+
+def _read_history_chain():
+    """Where the last restore point stands: its base, change-log seq and thread sizes."""
+    try:
+        with open(SNAPSHOT_HISTORY_CHAIN, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def _digest(obj):
+    raw = json.dumps(obj, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=8).hexdigest()
+
+
+def _touched_since(since_seq, upto_seq):
+    """
+    (request indexes, thread keys) the change log touched in (since_seq,
+    upto_seq], or None when a delta can't express it: a delete/truncate/reset
+    re-indexes or replaces everything, or the log doesn't reach back that far.
+    """
+    reqs, keys, expected = set(), set(), since_seq + 1
+    for ev in read_events(since_seq):
+        if ev["seq"] > upto_seq:
+            break
+        if ev["seq"] != expected:
+            return None
+        expected += 1
+        if ev["op"] in ("add_request", "update_request"):
+            reqs.add(ev["idx"])
+        elif ev["op"] in ("append_comments", "put_thread", "drop_thread"):
+            keys.add(ev["key"])
+        else:
+            return None
+    return (reqs, keys) if expected == upto_seq + 1 else None
+
+
+def archive_snapshot(force_base=False):
+    """
+    Add a compressed restore point of the stored data to history/ (zstd if
+    available, else gzip).
+
+    Points are keyed by a change sequence number. Most are deltas holding only
+    the requests and comment threads the change log touched since the previous
+    point (read_events from the chain's log seq; nothing is re-hashed); a full
+    base is cut every SNAPSHOT_BASE_EVERY points, when the log can't express
+    the change (a delete re-indexes everything, a reset, a rewound log) or when
+    a delta would be as big as a base. Returns None when nothing changed,
+    otherwise {"path", "kind", "seq"}.
+    """
+    state = _history_state()
+    with dir_lock(SNAPSHOT_HISTORY_DIR, state["lock"]):  # index/chain are shared by all workers
+        entries = _read_history_index()
+        chain = _read_history_chain()
+        if chain and (not any(e["file"] == chain.get("base") for e in entries) or "log_seq" not in chain):
+            chain = None  # base was lost (or a chain from before log-based deltas): start a new chain
+
+        with primary_lock(shared=True):  # the stored state and its log position as one pair
+            log_seq = _last_logged_seq()
+            if chain and log_seq == chain["log_seq"] and not force_base:
+                return None
+            touched = None
+            if chain and not force_base and chain["deltas"] < SNAPSHOT_BASE_EVERY and log_seq > chain["log_seq"]:
+                touched = _touched_since(chain["log_seq"], log_seq)
+            if touched is None:
+                requests, comments = _read_primary_files()
+            else:
+                requests_text, _ = read_primary_texts(comments=False)
+                requests = json.loads(requests_text) if requests_text else []
+                comments = read_comment_threads(touched[1])
+
+        make_base = touched is None or len(touched[0]) + len(touched[1]) > max(len(requests), 1) // 2
+        if make_base and touched is not None:  # too big for a delta after all: read every thread
+            with primary_lock(shared=True):
+                log_seq = _last_logged_seq()
+                requests, comments = _read_primary_files()
+        if make_base:
+            changed = len(requests) + len(comments)
+            counts = {k: len(v or []) for k, v in comments.items()}
+        else:
+            changed_reqs = {str(i): requests[i] for i in sorted(touched[0]) if i < len(requests)}
+            removed_coms = sorted(k for k in touched[1] if k not in comments)
+            changed = len(changed_reqs) + len(comments)
+            counts = {k: n for k, n in chain["comment_counts"].items() if k not in removed_coms}
+            counts.update({k: len(v or []) for k, v in comments.items()})
+
+        seq = (chain["seq"] if chain else max((e["seq"] for e in entries), default=0)) + 1
+        now = datetime.now()
+        kind = "base" if make_base else "delta"
+        ext = "zst" if zstd is not None else "gz"
+        name = f"HelpCenter_Snapshot_{now.strftime('%Y%m%d_%H%M%S')}_{seq}.{kind}.json.{ext}"
+        path = SNAPSHOT_HISTORY_DIR / name
+        with _open_archive(path, "wb") as f:
+            if make_base:
+                write_snapshot_stream(f, requests, comments, meta={"seq": seq, "kind": kind})
+                base = name
+            else:
+                payload = {"seq": seq, "kind": kind, "base": chain["base"],
+                           "n_requests": len(requests), "requests": changed_reqs,
+                           "comments": comments, "removed_comments": removed_coms}
+                f.write(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+                base = chain["base"]
+
+        entries.insert(0, {
+            "file": name,
+            "kind": kind,
+            "seq": seq,
+            "base": base,
+            "ts": now.isoformat(timespec="seconds"),
+            "epoch": now.timestamp(),
+            "codec": ext,
+            "bytes": path.stat().st_size,
+            "changed": changed,
+            "requests": len(requests),
+            "comments": sum(counts.values()),
+        })
+        _write_history_index(entries)
+
+        tmp = SNAPSHOT_HISTORY_CHAIN + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"seq": seq, "base": base, "deltas": 0 if make_base else chain["deltas"] + 1,
+                       "log_seq": log_seq, "comment_counts": counts}, f)
+        os.replace(tmp, SNAPSHOT_HISTORY_CHAIN)
+        return {"path": str(path), "kind": kind, "seq": seq}
+
+
+def load_restore_point(name, entries=None):
+    """Materialize a restore point: its base + the deltas of that chain up to its seq."""
+    entries = entries if entries is not None else _read_history_index()
+    entry = next((e for e in entries if e["file"] == name), None)
+    if entry is None:
+        raise FileNotFoundError(name)
+
+    base = _read_archive(entry["base"])
+    requests = list(base.get("requests", []))
+    comments = dict(base.get("comments", {}))
+    chain = sorted((e for e in entries
+                    if e["kind"] == "delta" and e["base"] == entry["base"] and e["seq"] <= entry["seq"]),
+                   key=lambda e: e["seq"])
+    for e in chain:
+        delta = _read_archive(e["file"])
+        n = delta["n_requests"]
+        requests = requests[:n] + [None] * (n - len(requests))
+        for i, r in delta["requests"].items():
+            requests[int(i)] = r
+        for k in delta["removed_comments"]:
+            comments.pop(k, None)
+        comments.update(delta["comments"])
+    return {"requests": requests, "comments": comments}
+
+
+def _retained_points(entries, now):
+    """Apply SNAPSHOT_RETENTION: keep the newest point of each hour/day/week bucket."""
+    keep, seen = set(), {"hourly": set(), "daily": set(), "weekly": set()}
+    span = {"hourly": 3600, "daily": 86400, "weekly": 7 * 86400}
+    for e in sorted(entries, key=lambda e: e["epoch"], reverse=True):
+        age = now - e["epoch"]
+        dt = datetime.fromtimestamp(e["epoch"])
+        buckets = {
+            "hourly": dt.strftime("%Y%m%d%H"),
+            "daily": dt.strftime("%Y%m%d"),
+            "weekly": "%d-%02d" % dt.isocalendar()[:2],
+        }
+        if age < 3600:
+            keep.add(e["file"])
+        for policy, bucket in buckets.items():
+            if bucket in seen[policy]:
+                continue
+            seen[policy].add(bucket)
+            if age < SNAPSHOT_RETENTION[policy] * span[policy]:
+                keep.add(e["file"])
+
+    # a kept delta needs its base and every earlier delta of the same chain
+    needed = set(keep)
+    for e in entries:
+        if e["file"] in keep and e["kind"] == "delta":
+            needed.add(e["base"])
+            needed.update(d["file"] for d in entries
+                          if d["kind"] == "delta" and d["base"] == e["base"] and d["seq"] < e["seq"])
+    return needed
+
+
+def prune_snapshot_history():
+    """Delete restore points outside the retention policy. Returns #removed."""
+    state = _history_state()
+    with dir_lock(SNAPSHOT_HISTORY_DIR, state["lock"]):
+        entries = _read_history_index()
+        keep = _retained_points(entries, datetime.now().timestamp())
+        removed = 0
+        for e in entries:
+            if e["file"] not in keep:
+                try:
+                    (SNAPSHOT_HISTORY_DIR / e["file"]).unlink()
+                except FileNotFoundError:
+                    pass
+                removed += 1
+        if removed or not os.path.exists(SNAPSHOT_HISTORY_INDEX):
+            SNAPSHOT_HISTORY_DIR.mkdir(parents=True, exist_ok=True)
+            _write_history_index([e for e in entries if e["file"] in keep])
+        state["last_prune"] = datetime.now()
+        state["removed"] += removed
+        return removed
+
+
+@st.cache_resource
+def start_snapshot_pruner():
+    """One daemon thread per process that enforces the retention policy."""
+    state = _history_state()
+
+    def _loop():
+        while True:
+            try:
+                prune_snapshot_history()
+                state["error"] = None
+            except Exception as e:  # keep the pruner alive; surfaced in Backup & Restore
+                state["error"] = str(e)
+            time.sleep(SNAPSHOT_PRUNE_EVERY)
+
+    t = threading.Thread(target=_loop, name="snapshot-pruner", daemon=True)
+    t.start()
+    return t
+
+
+def list_restore_points():
+    """Available restore points from the index (newest first) — no archive is opened."""
+    return _read_history_index()
+
+
+# ----- SCHEDULED SERVER-SIDE BACKUPS (pre-built, compressed download) -----
+@st.cache_resource
+def _backup_state():
+    """Process-wide backup status + the cached download payload."""
+    return {"lock": threading.Lock(), "status_lock": threading.Lock(), "signature": None,
+            "last_backup": None, "bytes": 0, "error": None}
+
+
+def _read_backup_status():
+    try:
+        with open(SNAPSHOT_BACKUP_STATUS, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {"processes": {}, "users": {}}
+
+
+def _update_backup_status(section, key, value):
+    """Read-modify-write of one entry, under dir_lock so workers don't drop each other's updates."""
+    with dir_lock(os.path.dirname(SNAPSHOT_BACKUP_STATUS), _backup_state()["status_lock"], "backup_status.lock"):
+        status = _read_backup_status()
+        status.setdefault(section, {})[key] = value
+        tmp = f"{SNAPSHOT_BACKUP_STATUS}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(status, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, SNAPSHOT_BACKUP_STATUS)
+
+
+def run_scheduled_backup(force=False):
+    """
+    Rebuild the compressed download snapshot from the primary JSONs on disk
+    (no session state needed) if they changed since the last backup.
+    Returns True when a new backup file was written.
+    """
+    state = _backup_state()
+    with state["lock"]:
+        sig = _primary_signature()
+        if not force and sig == state["signature"] and os.path.exists(SNAPSHOT_BACKUP_FILE):
+            return False
+        snap = {"requests": [], "comments": {}}
+        with primary_lock(shared=True):  # a matching requests/comments pair
+            for key, text in zip(("requests", "comments"), read_primary_texts()):
+                if text:
+                    snap[key] = json.loads(text)
+
+        tmp = f"{SNAPSHOT_BACKUP_FILE}.{os.getpid()}.tmp"
+        with gzip.open(tmp, "wb", compresslevel=6) as f:
+            write_snapshot_stream(f, snap["requests"], snap["comments"], indent=SNAPSHOT_JSON_INDENT)
+        os.replace(tmp, SNAPSHOT_BACKUP_FILE)
+
+        now = datetime.now()
+        state.update(signature=sig, last_backup=now, error=None,
+                     bytes=os.path.getsize(SNAPSHOT_BACKUP_FILE))
+        _update_backup_status("processes", f"{platform.node()}:{os.getpid()}", {
+            "last_backup": now.isoformat(timespec="seconds"),
+            "bytes": state["bytes"],
+            "requests": len(snap["requests"]),
+        })
+        return True
+
+
+@st.cache_resource
+def start_backup_scheduler():
+    """One daemon thread per process that keeps SNAPSHOT_BACKUP_FILE current."""
+    state = _backup_state()
+
+    def _loop():
+        while True:
+            try:
+                run_scheduled_backup()
+                state["error"] = None
+            except Exception as e:  # keep the scheduler alive; surfaced in Backup & Restore
+                state["error"] = str(e)
+            time.sleep(SNAPSHOT_BACKUP_EVERY)
+
+    t = threading.Thread(target=_loop, name="backup-scheduler", daemon=True)
+    t.start()
+    return t
+
+
+def latest_backup_payload():
+    """Bytes of the last scheduled backup, read from disk once per new file."""
+    if not os.path.exists(SNAPSHOT_BACKUP_FILE):
+        run_scheduled_backup(force=True)
+    s = os.stat(SNAPSHOT_BACKUP_FILE)
+
+    def _read():
+        with open(SNAPSHOT_BACKUP_FILE, "rb") as f:
+            return f.read()
+
+    payload = cached_export("guard_backup", ((s.st_mtime_ns, s.st_size),), _read)
+    return payload, datetime.fromtimestamp(s.st_mtime)
+
+
+# ----- EXPORT ARTIFACT CACHE (download payloads shared across reruns & sessions) -----
+EXPORT_CACHE_MAX_ENTRIES = 64
+EXPORT_CACHE_MAX_BYTES   = 64 * 1024 * 1024
+
+
+@st.cache_resource
+def _export_cache():
+    """Process-wide LRU of built download payloads + hit/miss counters."""
+    return {"lock": threading.Lock(), "items": OrderedDict(), "bytes": 0, "hits": 0, "misses": 0}
+
+
+def cached_export(kind, key, build):
+    """
+    Payload bytes for `kind` + `key`, calling `build()` only on a miss.
+    `key` must start with the data version the payload is built from
+    (see st.session_state.data_version); a None version is never cached.
+    """
+    cache = _export_cache()
+    full_key = (kind,) + tuple(key)
+    if key[0] is not None:
+        with cache["lock"]:
+            if full_key in cache["items"]:
+                cache["items"].move_to_end(full_key)
+                cache["hits"] += 1
+                return cache["items"][full_key]
+
+    payload = build()
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+
+    with cache["lock"]:
+        cache["misses"] += 1
+        if key[0] is not None and full_key not in cache["items"]:
+            cache["items"][full_key] = payload
+            cache["bytes"] += len(payload)
+            while cache["items"] and (len(cache["items"]) > EXPORT_CACHE_MAX_ENTRIES
+                                      or cache["bytes"] > EXPORT_CACHE_MAX_BYTES):
+                _, old = cache["items"].popitem(last=False)
+                cache["bytes"] -= len(old)
+    return payload
+
+
+def lazy_download_button(label, kind, key, build, file_name, mime, widget_key, **kwargs):
+    """
+    A download button whose payload is only built once the user asks for it:
+    `label` first prepares cached_export(kind, key, build), then a download
+    button serves it. Preparing is remembered per session for that `key`, so
+    new data (a new version in `key`) asks again instead of building on render.
+    """
+    prepared = f"{widget_key}_prepared"
+    if st.session_state.get(prepared) != key:
+        if not st.button(label, key=f"{widget_key}_prepare", **kwargs):
+            return False
+        st.session_state[prepared] = key
+    return st.download_button(f"⬇️ Download {file_name}", cached_export(kind, key, build), file_name, mime,
+                              key=widget_key, **kwargs)
+
+
+def export_cache_stats():
+    cache = _export_cache()
+    with cache["lock"]:
+        total = cache["hits"] + cache["misses"]
+        return {
+            "hits": cache["hits"],
+            "misses": cache["misses"],
+            "hit_rate": cache["hits"] / total if total else 0.0,
+            "entries": len(cache["items"]),
+            "bytes": cache["bytes"],
+        }
+
+
+def record_user_backup(user):
+    _update_backup_status("users", user, datetime.now().isoformat(timespec="seconds"))
+
+
+def last_user_backup(user):
+    ts = _read_backup_status().get("users", {}).get(user)
+    return datetime.fromisoformat(ts) if ts else None
+
+
+# ----- STREAMING, VALIDATED RESTORE -----
+RESTORE_BATCH = 500  # records per staged write / progress update
+
+
+def iter_snapshot_upload(fp, chunk_size=256 * 1024):
+    """
+    Incrementally parse a snapshot stream, yielding ("request", i, record)
+    and ("comments", key, thread) without ever holding the whole document.
+    Other top-level keys (e.g. history metadata) are skipped.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    s = {"buf": "", "pos": 0, "eof": False}
+
+    def fill(size):
+        if s["eof"]:
+            return False
+        data = fp.read(size)
+        if s["pos"] > (1 << 20):  # drop what was already consumed
+            s["buf"], s["pos"] = s["buf"][s["pos"]:], 0
+        s["buf"] += utf8.decode(data, final=not data)
+        s["eof"] = not data
+        return True
+
+    def peek():
+        while True:
+            buf, pos = s["buf"], s["pos"]
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            s["pos"] = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not fill(chunk_size):
+                return ""
+
+    def expect(ch):
+        found = peek()
+        if found != ch:
+            raise ValueError(f"Invalid snapshot JSON: expected {ch!r}, found {found or 'end of file'!r}")
+        s["pos"] += 1
+
+    def value():
+        peek()
+        size = chunk_size
+        while True:
+            try:
+                obj, end = decoder.raw_decode(s["buf"], s["pos"])
+                # a number/literal ending exactly at the buffer edge may be cut short
+                if end < len(s["buf"]) or s["eof"] or isinstance(obj, (dict, list, str)):
+                    s["pos"] = end
+                    return obj
+            except json.JSONDecodeError:
+                if s["eof"]:
+                    raise
+            fill(size)
+            size *= 2
+
+    expect("{")
+    if peek() == "}":
+        return
+    while True:
+        key = value()
+        expect(":")
+        if key in ("requests", "comments"):
+            opener, closer = ("[", "]") if key == "requests" else ("{", "}")
+            expect(opener)
+            i = 0
+            if peek() == closer:
+                s["pos"] += 1
+            else:
+                while True:
+                    if key == "requests":
+                        yield ("request", i, value())
+                    else:
+                        k = value()
+                        expect(":")
+                        yield ("comments", k, value())
+                    i += 1
+                    if peek() == ",":
+                        s["pos"] += 1
+                        continue
+                    expect(closer)
+                    break
+        else:
+            value()
+        if peek() == ",":
+            s["pos"] += 1
+            continue
+        expect("}")
+        return
+
+
+def validate_request_record(rec):
+    """Schema problems for one request (empty list = valid)."""
+    if not isinstance(rec, dict):
+        return ["not an object"]
+    problems = []
+    t = rec.get("Type")
+    if t in ("💲", "🛒"):
+        price_key = "Cost" if t == "💲" else "Sale Price"
+        for k in ("Description", "Quantity", price_key):
+            if k in rec and not isinstance(rec[k], list):
+                problems.append(f"{k} must be a list")
+    elif t == "📑":
+        items = rec.get("Items", [])
+        if not isinstance(items, list) or not all(isinstance(it, dict) for it in items):
+            problems.append("Items must be a list of objects")
+    else:
+        problems.append(f"unknown Type {t!r}")
+    for k in ("Status", "Date", "ETA Date", "Fecha", "Encargado"):
+        if k in rec and not isinstance(rec[k], str):
+            problems.append(f"{k} must be text")
+    return problems
+
+
+def validate_comment_thread(key, thread):
+    """Schema problems for one comment thread (empty list = valid)."""
+    if not (isinstance(key, str) and key.isdigit()):
+        return [f"comment key {key!r} is not a request index"]
+    if not isinstance(thread, list):
+        return ["thread must be a list"]
+    problems = []
+    for j, c in enumerate(thread):
+        if not isinstance(c, dict) or not isinstance(c.get("author", ""), str):
+            problems.append(f"comment #{j + 1} is malformed")
+        elif "read_by" in c and not isinstance(c["read_by"], list):
+            problems.append(f"comment #{j + 1}: read_by must be a list")
+        elif "status_change" in c and not isinstance(c["status_change"], dict):
+            problems.append(f"comment #{j + 1}: status_change must be an object")
+    return problems
+
+
+def restore_snapshot_upload(uploaded, on_progress=None):
+    """
+    Stream an uploaded snapshot (.json or .json.gz) into staged copies of the
+    primary JSONs, validating every record and writing in RESTORE_BATCH
+    batches. Only once everything validated does it replace the live state,
+    in one writer commit (replace_primary_state); other sessions keep
+    reading the old data until then. That commit needs the parsed records,
+    so the staged copies are loaded back for it: peak memory is one parsed
+    copy of the snapshot (the upload bytes are never buffered whole).
+    Returns (n_requests, n_threads); raises ValueError on schema problems.
+    """
+    total = getattr(uploaded, "size", 0) or 1
+    uploaded.seek(0)
+    stream = gzip.GzipFile(fileobj=uploaded) if uploaded.read(2) == b"\x1f\x8b" else uploaded
+    uploaded.seek(0)
+
+    staged, files = {}, {}
+    data_dir = os.path.dirname(os.path.abspath(REQUESTS_FILE))
+    for path in (REQUESTS_FILE, COMMENTS_FILE):  # unique names: restores may run concurrently
+        fd, staged[path] = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".restore.tmp", dir=data_dir)
+        files[path] = os.fdopen(fd, "w", encoding="utf-8")
+    counts = {"request": 0, "comments": 0}
+    pending = {"request": [], "comments": []}
+    problems = []
+
+    def flush(kind):
+        f = files[REQUESTS_FILE if kind == "request" else COMMENTS_FILE]
+        f.write("".join(pending[kind]))
+        f.flush()
+        pending[kind].clear()
+        if on_progress:
+            on_progress(min(uploaded.tell() / total, 1.0), counts["request"], counts["comments"])
+
+    try:
+        files[REQUESTS_FILE].write("[")
+        files[COMMENTS_FILE].write("{")
+        for kind, key, obj in iter_snapshot_upload(stream):
+            if kind == "request":
+                errs = validate_request_record(obj)
+                enc = json.dumps(obj, ensure_ascii=False)
+                where = f"request #{key}"
+            else:
+                errs = validate_comment_thread(key, obj)
+                enc = json.dumps(key, ensure_ascii=False) + ":" + json.dumps(obj, ensure_ascii=False)
+                where = f"comments[{key!r}]"
+            problems += [f"{where}: {e}" for e in errs]
+            if len(problems) >= 10:
+                break
+            pending[kind].append(("," if counts[kind] else "") + enc)
+            counts[kind] += 1
+            if len(pending[kind]) >= RESTORE_BATCH:
+                flush(kind)
+        if problems:
+            raise ValueError("snapshot failed validation — nothing was changed:\n" + "\n".join(problems))
+
+        flush("request")
+        flush("comments")
+        files[REQUESTS_FILE].write("]")
+        files[COMMENTS_FILE].write("}")
+        for f in files.values():
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        with open(staged[REQUESTS_FILE], "r", encoding="utf-8") as f:
+            requests = json.load(f)
+        with open(staged[COMMENTS_FILE], "r", encoding="utf-8") as f:
+            comments = json.load(f)
+        replace_primary_state(requests, comments, f"restore upload {getattr(uploaded, 'name', '')}",
+                              st.session_state.get("user_name", ""))
+        return counts["request"], counts["comments"]
+    finally:
+        for f in files.values():
+            f.close()
+        for tmp in staged.values():
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+def _record_digest(record):
+    """Content digest of a record, ignoring _version (a snapshot's copy may carry an older one)."""
+    return _digest({k: v for k, v in record.items() if k != "_version"})
+
+
+def _stored_position(positions, ref, n):
+    """Where the record `ref` ({"id", "idx"}) is stored now: by _id, else by position (None if gone)."""
+    if ref["id"]:
+        return positions.get(ref["id"])
+    return ref["idx"] if ref["idx"] < n else None
+
+
+def diff_snapshot_upload(uploaded):
+    """
+    Stream an uploaded snapshot and diff it against the stored data: records
+    are matched by _id (by position in a snapshot from before ids), threads
+    by the record they belong to. Only records that differ are kept in memory,
+    with the digest of the stored copy they would replace and the store
+    signature they were compared against (see apply_snapshot_diff).
+    Raises ValueError on schema problems (same checks as a full restore).
+    """
+    with primary_lock(shared=True):
+        signature = _primary_signature()
+        requests, comments = _read_primary_files()
+    positions = record_positions(requests)
+
+    uploaded.seek(0)
+    stream = gzip.GzipFile(fileobj=uploaded) if uploaded.read(2) == b"\x1f\x8b" else uploaded
+    uploaded.seek(0)
+
+    diff = {
+        "signature": signature, "ids": [], "requests": {}, "comments": {}, "base": {}, "thread_base": {},
+        "added": [], "changed": [], "removed": [],
+        "threads_added": [], "threads_changed": [], "threads_removed": [],
+    }
+    matched, seen_threads = set(), set()
+    problems, legacy = [], False
+    for kind, key, obj in iter_snapshot_upload(stream):
+        if kind == "request":
+            errs = validate_request_record(obj)
+            problems += [f"request #{key}: {e}" for e in errs]
+            if key == 0:
+                legacy = "_id" not in obj  # a snapshot from before ids: match its records by position
+            pos = _stored_position(positions, {"id": obj.get("_id"), "idx": key}, len(requests)) \
+                if legacy or obj.get("_id") else None
+            # matched by position: follow the stored record's id from here on
+            diff["ids"].append(obj.get("_id") or (requests[pos].get("_id") if pos is not None else None))
+            if pos is None:
+                diff["added"].append(key)
+                diff["requests"][key] = obj
+                continue
+            matched.add(pos)
+            if _record_digest(obj) != _record_digest(requests[pos]):
+                diff["changed"].append(pos)
+                diff["requests"][key] = obj
+                diff["base"][key] = _record_digest(requests[pos])
+        else:
+            errs = validate_comment_thread(key, obj)
+            problems += [f"comments[{key!r}]: {e}" for e in errs]
+            seen_threads.add(key)
+            stored_key = _snapshot_thread_key(diff, key, positions, len(requests))
+            if stored_key is None or stored_key not in comments:
+                diff["threads_added"].append(key)
+                diff["comments"][key] = obj
+            elif _digest(obj) != _digest(comments[stored_key]):
+                diff["threads_changed"].append(key)
+                diff["comments"][key] = obj
+                diff["thread_base"][key] = _digest(comments[stored_key])
+        if len(problems) >= 10:
+            break
+    if problems:
+        raise ValueError("snapshot failed validation — nothing was changed:\n" + "\n".join(problems))
+
+    diff["n_requests"] = len(diff["ids"])
+    diff["removed"] = [i for i in range(len(requests)) if i not in matched]
+    diff["removed_refs"] = [{"id": requests[i].get("_id"), "idx": i, "digest": _record_digest(requests[i])}
+                            for i in diff["removed"]]
+    # stored threads the snapshot has no thread for (keyed by their record, so they survive a re-index)
+    owned = {_snapshot_thread_key(diff, k, positions, len(requests)) for k in seen_threads}
+    diff["threads_removed"] = sorted((k for k in comments if k not in owned), key=lambda k: (not k.isdigit(), k.zfill(12)))
+    diff["threads_removed_refs"] = [
+        {"key": k, "id": requests[int(k)].get("_id") if k.isdigit() and int(k) < len(requests) else None,
+         "digest": _digest(comments[k])}
+        for k in diff["threads_removed"]
+    ]
+    return diff
+
+
+def _snapshot_thread_key(diff, key, positions, n):
+    """Stored key of the snapshot's thread `key`: its record's position now (None for a record being added)."""
+    if not key.isdigit() or int(key) >= len(diff["ids"]):
+        return key  # not a record's thread (or the snapshot lists its record later): by key
+    if diff["ids"][int(key)] is None and int(key) in diff["added"]:
+        return None
+    pos = _stored_position(positions, {"id": diff["ids"][int(key)], "idx": int(key)}, n)
+    return None if pos is None else str(pos)
+
+
+def diff_change_count(diff, removals=True):
+    n = len(diff["requests"]) + len(diff["comments"])
+    if removals:
+        n += len(diff["removed"]) + len(diff["threads_removed"])
+    return n
+
+
+class SnapshotDiffStale(ValueError):
+    """The stored data moved on since the snapshot was compared: compare again."""
+
+
+def apply_snapshot_diff(diff, removals=True):
+    """
+    Apply a diff from diff_snapshot_upload through the writer, touching only
+    the records and threads it lists (found by _id again inside the job).
+    Raises SnapshotDiffStale, changing nothing, if the store signature or
+    any listed record moved since the compare. With removals=False, records
+    and threads missing from the snapshot are kept. Returns the number of
+    changes applied.
+    """
+    settle_pending_writes(wait=False)
+
+    def _job(requests, comments):
+        if _primary_signature() != diff["signature"]:
+            raise SnapshotDiffStale("the live data changed since the comparison — compare again")
+        positions = record_positions(requests)
+        n = len(requests)
+        events = []
+        # 1) check every listed record/thread is still what was compared
+        targets = {}
+        for key in diff["requests"]:
+            if key in diff["base"]:
+                pos = _stored_position(positions, {"id": diff["ids"][key], "idx": key}, n)
+                if pos is None or _record_digest(requests[pos]) != diff["base"][key]:
+                    raise SnapshotDiffStale(f"request #{key} changed since the comparison — compare again")
+                targets[key] = pos
+        doomed = []
+        if removals:
+            for ref in diff["removed_refs"]:
+                pos = _stored_position(positions, ref, n)
+                if pos is None or _record_digest(requests[pos]) != ref["digest"]:
+                    raise SnapshotDiffStale(f"request #{ref['idx']} changed since the comparison — compare again")
+                doomed.append(pos)
+        for key, digest in diff["thread_base"].items():
+            stored_key = _snapshot_thread_key(diff, key, positions, n)
+            if _digest(comments.get(stored_key)) != digest:
+                raise SnapshotDiffStale(f"comments[{key!r}] changed since the comparison — compare again")
+
+        # 2) records: changed in place, added at the end, removed last (threads follow their record)
+        for key, pos in targets.items():
+            old = requests[pos]
+            new = {**diff["requests"][key], "_id": old.get("_id") or new_record_id(),
+                   "_version": record_version(old) + 1}
+            ev = {"op": "update_request", "idx": pos, "set": {k: v for k, v in new.items() if k not in old or old[k] != v}}
+            removed_keys = [k for k in old if k not in new]
+            if removed_keys:
+                ev["unset"] = removed_keys
+            events.append(ev)
+            apply_event(requests, comments, ev)
+        added_ids = {}
+        taken = set(positions)
+        for key in sorted(k for k in diff["requests"] if k not in diff["base"]):
+            rid = diff["ids"][key] if diff["ids"][key] and diff["ids"][key] not in taken else new_record_id()
+            taken.add(rid)
+            added_ids[key] = rid
+            ev = {"op": "add_request", "idx": len(requests),
+                  "record": {**diff["requests"][key], "_id": rid, "_version": 1}}
+            events.append(ev)
+            apply_event(requests, comments, ev)
+        doomed_ids = {requests[p].get("_id") for p in doomed}
+        for pos in sorted(doomed, reverse=True):
+            ev = {"op": "delete_request", "idx": pos}
+            events.append(ev)
+            apply_event(requests, comments, ev)
+
+        # 3) threads, at their record's position after the record changes
+        positions, n = record_positions(requests), len(requests)
+        ids = [added_ids.get(i, rid) for i, rid in enumerate(diff["ids"])]
+        remap = {**diff, "ids": ids}
+        for key, thread in diff["comments"].items():
+            stored_key = _snapshot_thread_key(remap, key, positions, n)
+            if stored_key is None:
+                continue
+            ev = {"op": "put_thread", "key": stored_key, "thread": thread}
+            events.append(ev)
+            apply_event(requests, comments, ev)
+        if removals:
+            for ref in diff["threads_removed_refs"]:
+                if ref["id"] in doomed_ids:
+                    continue  # went with its record
+                stored_key = str(positions[ref["id"]]) if ref["id"] in positions else ref["key"]
+                if stored_key in comments and _digest(comments[stored_key]) == ref["digest"]:
+                    ev = {"op": "drop_thread", "key": stored_key}
+                    events.append(ev)
+                    apply_event(requests, comments, ev)
+        return [{**ev, "reason": "merge upload"} for ev in events], diff_change_count(diff, removals)
+
+    result = submit_write(_job, st.session_state.get("user_name", "")).result()
+    _adopt_commit(result)
+    try:
+        export_snapshot_to_disk()
+    except Exception as e:
+        st.warning(f"Auto-export failed: {e}")
+    return result["value"]
+
+
+
+# ----- OPTIMISTIC CONCURRENCY (per-record versions, compare-and-swap) -----
+# Each session remembers the exact bytes it loaded (its baseline). A save
+# diffs baseline → session to get *its own* edits and replays them onto the
+# current disk state: a record update only lands if the stored version is
+# still the one the session started from, otherwise it becomes a merge
+# conflict for the user. Comment threads are merged (appends + read_by).
+
+
+def _set_baseline(requests_text, comments_text):
+    st.session_state._baseline_raw = (requests_text, comments_text)
+
+
+def _baseline():
+    """(requests, comments) as this session last loaded/saved them, or None."""
+    raw = st.session_state.get("_baseline_raw")
+    if raw is None:
+        return None
+    try:
+        return json.loads(raw[0] or "[]"), json.loads(raw[1] or "{}")
+    except json.JSONDecodeError:
+        return None
+
+
+def queue_merge_conflicts(conflicts, stamps=None):
+    """Hand conflicts to the merge prompt (one per record, newest wins; deleted records have nothing to merge)."""
+    pending = st.session_state.setdefault("merge_conflicts", {})
+    for c in conflicts:
+        if c["theirs"] is not None:
+            pending[c["idx"]] = {**c, "stamps": stamps or []}
+
+
+
+# ----- SAVES THROUGH THE WRITER (session side) -----
+# The writer itself lives in helpcenter_store; these adopt a commit's stored
+# state into the session and report what became of its non-durable saves.
+def _adopt_commit(result):
+    """
+    Make a committed write's stored state this session's data + baseline.
+    The commit only carries the threads it read or wrote; the other threads
+    this session holds come from the thread index. If that has moved past
+    the commit (another write landed since), data_version stays unset so the
+    next load_data() reconciles.
+    """
+    requests_text = json.dumps(result["requests"])  # also copies it out of the shared result
+    keys = st.session_state.get("comments") or {}
+    touched = result["comments"]
+    signature, stored = result["signature"], {}
+    if any(k not in touched for k in keys):
+        index = thread_index()
+        with index["lock"]:
+            signature, stored = index["signature"], index["texts"]
+    threads = {k: touched[k] if k in touched else json.loads(stored[k])
+               for k in keys if k in touched or k in stored}
+    threads_text = json.dumps(threads)
+    st.session_state.requests = json.loads(requests_text)
+    st.session_state.comments = json.loads(threads_text)  # only the threads this session holds
+    _set_baseline(requests_text, threads_text)
+    st.session_state.data_version = result["signature"] if signature == result["signature"] else None
+
+
+def settle_pending_writes(wait=True):
+    """
+    Surface the outcome (merge conflicts, failures) of this session's
+    non-durable saves. load_data() waits for them so it reads its own
+    writes; further saves only collect the ones already finished, so a
+    burst of saves still shares group commits.
+    """
+    pending = st.session_state.get("_pending_writes")
+    if not pending:
+        return
+    ready = [p for p in pending if wait or p[0].done()]
+    st.session_state._pending_writes = [p for p in pending if p not in ready]
+    landed = False
+    for fut, previous_baseline in ready:
+        try:
+            result = fut.result()
+        except Exception as e:
+            # the edits never landed: make them local (unsaved) edits again
+            st.session_state._baseline_raw = previous_baseline
+            st.warning(f"Save failed: {e}")
+            continue
+        _report_save_outcome(result)
+        landed = True
+    if landed:  # exports read the stored comments, so they follow the commit
+        try:
+            export_snapshot_to_disk()
+        except Exception as e:
+            st.warning(f"Auto-export failed: {e}")
+
+
+def _report_save_outcome(result):
+    value = result["value"] or {}
+    if value.get("delete_conflict"):
+        st.warning("⚠️ This record was changed by someone else, so it was not deleted — review it and try again.")
+    conflicts = [c for c in value.get("conflicts", []) if c["theirs"] is not None]
+    gone = [c for c in value.get("conflicts", []) if c["theirs"] is None]
+    if conflicts:
+        queue_merge_conflicts([c for c in conflicts if c["fields"]])
+        st.warning(f"⚠️ {len(conflicts)} record(s) were changed by someone else — your edits to them were not saved yet.")
+    if gone:
+        st.warning(f"⚠️ {len(gone)} record(s) you edited were deleted by someone else — those edits were dropped.")
+
+
+
+# ----- CHANGE NOTIFICATIONS (session subscriptions) -----
+# The bus lives in helpcenter_store; a session keeps one subscription per
+# topic and reloads only when it reports a change that concerns it.
+NOTIFY_FALLBACK_RELOAD = 30  # s; reload anyway now and then (hand-edited files, lost datagrams)
+
+
+def poll_changes(*topics):
+    """Ids changed on `topics` since this session last polled them (session-held subscriptions)."""
+    subs = st.session_state.setdefault("_bus_subscriptions", {})
+    changed = set()
+    for topic in topics:
+        if topic not in subs:
+            subs[topic] = subscribe(topic)
+        changed |= subs[topic].poll()
+    return changed
+
+
+def refresh_on_change(*topics, ids=None):
+    """
+    load_data() only if the bus reported a change on `topics` — for one of
+    `ids` if given — since this session last looked, or if the last reload is
+    older than NOTIFY_FALLBACK_RELOAD. Returns True if it reloaded.
+    """
+    changed = poll_changes(*topics)
+    now = time.monotonic()
+    stale = now - st.session_state.get("_bus_last_reload", 0.0) > NOTIFY_FALLBACK_RELOAD
+    if stale or (changed and (ids is None or "*" in changed or changed & {str(i) for i in ids})):
+        st.session_state._bus_last_reload = now
+        load_data()
+        return True
+    return False
+
+
+
+# ----- LAZY COMMENT THREADS -----
+# A session only holds the comment threads it opened: st.session_state.comments
+# is a partial dict (and so is the comments half of its baseline), capped at
+# COMMENT_SESSION_THREADS recently viewed threads without unsaved edits. The
+# process keeps one index of the stored threads — their JSON text plus an
+# (author, read_by) summary per comment for unread counters — refreshed when
+# the store signature moves. The SQLite store re-parses only the rows whose
+# text changed, and so does the JSON store (one file per thread).
+COMMENT_SESSION_THREADS = 16
+
+
+@st.cache_resource
+def _thread_index_state():
+    return {"lock": threading.Lock(), "signature": None, "texts": {}, "summary": {}, "last_seq": {},
+            "counts": {}}
+
+
+def _summarize_thread(thread):
+    return tuple((c.get("author", ""), frozenset(c.get("read_by", []))) for c in thread)
+
+
+def thread_index():
+    """The process-wide index of stored threads, brought up to date with the store."""
+    state = _thread_index_state()
+    if state["signature"] is not None and state["signature"] == _primary_signature():
+        return state
+    with primary_lock(shared=True), state["lock"]:  # always primary lock first
+        signature = _primary_signature()
+        if signature == state["signature"] and signature is not None:
+            return state
+        rows = read_comment_rows()
+        old_texts, summary, last_seq = state["texts"], {}, {}
+        for k, t in rows.items():
+            if old_texts.get(k) == t and k in state["summary"]:
+                summary[k], last_seq[k] = state["summary"][k], state["last_seq"][k]
+            else:
+                thread = json.loads(t)
+                summary[k], last_seq[k] = _summarize_thread(thread), (comment_seqs(thread) or [0])[-1]
+        state.update(signature=signature, texts=rows, summary=summary, last_seq=last_seq, counts={})
+    return state
+
+
+def unread_counts(user):
+    """{thread key: comments by others `user` hasn't read}, without loading thread bodies."""
+    state = thread_index()
+    counts = state["counts"].get(user)
+    if counts is None:
+        counts = {}
+        for k, summary in state["summary"].items():
+            n = sum(1 for author, read_by in summary if author != user and user not in read_by)
+            if n:
+                counts[k] = n
+        state["counts"][user] = counts
+    own = st.session_state.get("comments") or {}
+    if own:  # this session's copies may have newer (unsaved) read marks
+        counts = dict(counts)
+        for k, thread in own.items():
+            counts[k] = sum(1 for c in thread if c.get("author", "") != user and user not in c.get("read_by", []))
+    return counts
+
+
+def _baseline_threads(add=None, drop=()):
+    """Add/remove threads in the comments half of this session's baseline."""
+    raw = st.session_state.get("_baseline_raw")
+    if raw is None:
+        return
+    threads = json.loads(raw[1] or "{}")
+    threads.update(add or {})
+    for k in drop:
+        threads.pop(k, None)
+    _set_baseline(raw[0], json.dumps(threads))
+
+
+def load_threads(keys):
+    """
+    Bring the stored threads `keys` into this session (and its baseline) if
+    it doesn't hold them yet. Returns {key: session thread} for those that exist.
+    """
+    keys = [str(k) for k in keys]
+    comments = st.session_state.comments
+    missing = [k for k in keys if k not in comments]
+    if missing:
+        index = thread_index()
+        if index["signature"] != st.session_state.get("data_version"):
+            load_data()  # keys must mean the same records as this session's requests
+            comments, index = st.session_state.comments, thread_index()
+        found = {k: index["texts"][k] for k in missing if k in index["texts"] and k not in comments}
+        if found:
+            for k, text in found.items():
+                comments[k] = json.loads(text)
+            _baseline_threads({k: json.loads(t) for k, t in found.items()})
+    return {k: comments[k] for k in keys if k in comments}
+
+
+def _evict_threads():
+    """Drop the least recently viewed threads without unsaved edits beyond the cap."""
+    comments = st.session_state.comments
+    base = _baseline()
+    if len(comments) <= COMMENT_SESSION_THREADS or base is None:
+        return
+    lru = st.session_state.setdefault("_thread_lru", [])
+    order = sorted(comments, key=lambda k: lru.index(k) if k in lru else -1)
+    drop = [k for k in order[:len(comments) - COMMENT_SESSION_THREADS] if base[1].get(k) == comments[k]]
+    for k in drop:
+        comments.pop(k)
+    lru[:] = [k for k in lru if k in comments]
+    _baseline_threads(drop=drop)
+
+
+def load_thread(idx):
+    """This session's copy of the thread of request `idx`, loaded on demand ([] if none)."""
+    key = str(idx)
+    thread = load_threads([key]).get(key)
+    lru = st.session_state.setdefault("_thread_lru", [])
+    if key in lru:
+        lru.remove(key)
+    lru.append(key)
+    _evict_threads()
+    return thread if thread is not None else []
+
+
+
+# ----- COMMENT SEQUENCE NUMBERS + INCREMENTAL CHAT FETCH -----
+# The writer gives every comment it stores a per-thread "seq" (1, 2, ...);
+# comments from before numbering count by position. Chat panels keep the
+# history they already rendered and only fetch comments newer than the last
+# seq they saw, showing the latest CHAT_PAGE_SIZE with a "load older" control.
+CHAT_PAGE_SIZE = 50
+
+
+def thread_last_seq(idx):
+    """Newest seq of stored thread `idx` (0 if empty), from the index — no thread body."""
+    return thread_index()["last_seq"].get(str(idx), 0)
+
+
+def fetch_comments(idx, since_seq=0, limit=None):
+    """(seq, comment) pairs of thread `idx` newer than `since_seq`; the latest `limit` if given."""
+    thread = load_thread(idx)
+    seqs = comment_seqs(thread)
+    start = bisect.bisect_right(seqs, since_seq)
+    pairs = list(zip(seqs[start:], thread[start:]))
+    return pairs[-limit:] if limit else pairs
+
+
+def chat_window(idx):
+    """
+    What the chat panel shows for thread `idx`: the history this session
+    already rendered plus comments newer than the last seq it saw, trimmed to
+    the latest `limit` (raised by show_older_comments), from a segment boundary. The view starts over
+    if the rendered history no longer matches the thread (a concurrent comment
+    took the seq of an unsaved one, a restore, a re-index after a delete).
+    Returns (comments, number of older comments not shown).
+    """
+    views = st.session_state.setdefault("_chat_views", {})
+    view = views.get(str(idx))
+    thread = load_thread(idx)
+    if view is not None and view["seen"]:
+        seqs = comment_seqs(thread)
+        i = bisect.bisect_left(seqs, view["seen"])
+        if (i >= len(seqs) or seqs[i] != view["seen"] or _comment_id(thread[i]) != view["last_id"]
+                or _comment_id(thread[0]) != view["head_id"]):
+            view = None
+    if view is None:
+        view = views[str(idx)] = {"seen": 0, "last_id": None, "head_id": None,
+                                  "items": [], "seqs": [], "limit": CHAT_PAGE_SIZE}
+    new = fetch_comments(idx, since_seq=view["seen"])
+    if new:
+        view["items"] += [c for _, c in new]
+        view["seqs"] += [s for s, _ in new]
+        view["seen"], view["last_id"] = new[-1][0], _comment_id(new[-1][1])
+        view["head_id"] = _comment_id(view["items"][0])
+    start = max(0, len(view["items"]) - view["limit"])
+    start -= start % CHAT_PAGE_SIZE  # whole segments (see render_chat)
+    return view["items"][start:], start
+
+
+def rerun_chat():
+    """Rerun only the chat fragment (the whole script if this is a full run)."""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+
+def show_older_comments(idx):
+    view = st.session_state.get("_chat_views", {}).get(str(idx))
+    if view is not None:
+        view["limit"] += CHAT_PAGE_SIZE
+
+
+
+# Chat threads are drawn as one escaped HTML block per CHAT_PAGE_SIZE segment
+# of the history (segments start at fixed positions, so only the newest one
+# changes as messages arrive), memoized process-wide by thread, segment, last
+# seq, viewer, page style, file server URL and link expiry (links are signed
+# for the viewer) and which previews are built.
+CHAT_HTML_CACHE_SIZE = 512  # segments
+CHAT_BUBBLE_COLORS = ["#D1E8FF", "#FFD1DC", "#DFFFD6", "#FFFACD", "#E0E0E0"]
+
+
+@st.cache_resource
+def _chat_html_cache():
+    return {"lock": threading.Lock(), "html": OrderedDict(), "hits": 0, "misses": 0}
+
+
+def _comment_html(c, viewer, colors, status_color, out_text_color, files_url):
+    author = c.get("author", "")
+    when = html_escape(c.get("when", ""))
+    if "status_change" in c:
+        old_s, new_s = c["status_change"].get("old", ""), c["status_change"].get("new", "")
+        return (f'<div class="status-change" style="background:{status_color(new_s)};">'
+                f'{html_escape(author)} cambió estado: <b>{html_escape(old_s)}</b> → <b>{html_escape(new_s)}</b>'
+                f'<div class="status-small">{when}</div></div>')
+    align = "right" if author == viewer else "left"
+    cls = "out" if author == viewer else "in"
+    parts = [f'<div class="chat-author-{cls}" style="text-align:{align};">{html_escape(author)}</div>']
+    stamp = f'<div class="chat-timestamp" style="text-align:{align};">{when}</div><div style="clear:both;"></div>'
+    attachment = c.get("attachment")
+    if attachment:
+        name = html_escape(attachment)
+        href = attachment_href(c, files_url, viewer)
+        kind = preview_status(c)
+        preview = _preview_html(c, files_url, kind, viewer) if kind else ""
+        link = (f'<a href="{html_escape(href)}" class="attachment-link" target="_blank">{name}</a>' if href
+                else f'<span class="attachment-link">{name}</span>')  # legacy upload, or no reachable file server
+        parts.append(f'<div class="chat-attachment" style="float:{align};">📎 {link}{preview}</div>' + stamp)
+    text = c.get("text", "")
+    if text:
+        color = ""
+        if out_text_color:
+            color = f" color:{out_text_color if cls == 'out' else '#000'};"
+        body = html_escape(text).replace("\n", "<br>")  # a blank line would end the HTML block
+        parts.append(f'<div class="chat-bubble" style="background:{colors.get(author, "#EDEDED")};{color} '
+                     f'float:{align};">{body}</div>' + stamp)
+    return "".join(parts)
+
+
+def render_chat(idx, viewer, status_color, style="detail", out_text_color=None):
+    """
+    Draw the chat panel's history for thread `idx` (see chat_window) plus its
+    "load older" control. `style` names the page's look for the memo key.
+    """
+    shown, n_older = chat_window(idx)
+    if n_older and st.button(f"⬆ Load older ({n_older})", key=f"chat_older_{idx}"):
+        show_older_comments(idx)
+        rerun_chat()
+    view = st.session_state._chat_views[str(idx)]
+    items, seqs = view["items"], view["seqs"]
+    colors = {}
+    for c in items:  # first-appearance order over the whole history: stable as it grows
+        if c.get("author") and c["author"] not in colors:
+            colors[c["author"]] = CHAT_BUBBLE_COLORS[len(colors) % len(CHAT_BUBBLE_COLORS)]
+    cache = _chat_html_cache()
+    files_url = attachment_base_url()
+    for start in range(len(items) - len(shown), len(items), CHAT_PAGE_SIZE):
+        segment = items[start:start + CHAT_PAGE_SIZE]
+        previews = tuple(preview_status(c) for c in segment if c.get("attachment_sha"))
+        key = (str(idx), view["head_id"], start, seqs[start + len(segment) - 1], viewer, style, files_url,
+               files_link_expiry(), previews)
+        with cache["lock"]:
+            block = cache["html"].get(key)
+            if block is not None:
+                cache["html"].move_to_end(key)
+                cache["hits"] += 1
+        if block is None:
+            block = "".join(_comment_html(c, viewer, colors, status_color, out_text_color, files_url)
+                            for c in segment)
+            with cache["lock"]:
+                cache["misses"] += 1
+                cache["html"][key] = block
+                while len(cache["html"]) > CHAT_HTML_CACHE_SIZE:
+                    cache["html"].popitem(last=False)
+        st.markdown(block, unsafe_allow_html=True)
+
+
+# ----- PER-TICK TIMING -----
+# Script time of page runs and fragment ticks (last TICK_SAMPLES each), shown
+# in Backup & Restore so refresh costs can be compared.
+TICK_SAMPLES = 200
+CHAT_REFRESH_SECONDS = 1  # the chat fragments' own timer
+
+
+@st.cache_resource
+def _tick_state():
+    return {"lock": threading.Lock(), "ticks": {}}
+
+
+def record_tick(label, started):
+    """Record a run that began at time.perf_counter() == `started`."""
+    ms = (time.perf_counter() - started) * 1000
+    state = _tick_state()
+    with state["lock"]:
+        state["ticks"].setdefault(label, deque(maxlen=TICK_SAMPLES)).append(ms)
+
+
+def tick_stats():
+    """{label: (samples, median ms)}"""
+    state = _tick_state()
+    with state["lock"]:
+        return {k: (len(v), sorted(v)[len(v) // 2]) for k, v in state["ticks"].items() if v}
+
+
+
+# ----- COMMENT SEARCH INDEX -----
+# An inverted index over comment text, authors and attachment names (plus the
+# extracted text of PDF invoices, see queue_invoice_text), kept
+# per process and maintained incrementally from the change log: a search
+# first applies the events logged since the index's seq, so it never scans
+# the stored threads again after the first build. Threads get a stable id, so a
+# delete re-indexes the thread mapping, not every posting.
+SEARCH_MAX_RESULTS = 200
+_SEARCH_WORD = re.compile(r"[^\W_]+")
+
+
+def search_tokens(text):
+    """Lower-cased, accent-free words of `text`."""
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    return set(_SEARCH_WORD.findall("".join(ch for ch in text if not unicodedata.combining(ch))))
+
+
+@st.cache_resource
+def _search_state():
+    return {"lock": threading.Lock(), "seq": None, "signature": None, "postings": {}, "vocab": None,
+            "docs": {}, "by_author": {}, "by_sha": {}, "thread_docs": {}, "key_uid": {}, "uid_key": {},
+            "next_doc": 0, "next_uid": 0, "invoice_sub": None}
+
+
+def _search_drop_thread(state, key):
+    uid = state["key_uid"].pop(key, None)
+    if uid is None:
+        return
+    state["uid_key"].pop(uid, None)
+    for doc_id in state["thread_docs"].pop(uid, []):
+        doc = state["docs"].pop(doc_id)
+        by_author = state["by_author"].get(doc["author"])
+        if by_author is not None:
+            by_author.discard(doc_id)
+            if not by_author:
+                del state["by_author"][doc["author"]]
+        by_sha = state["by_sha"].get(doc["sha"])
+        if by_sha is not None:
+            by_sha.discard(doc_id)
+            if not by_sha:
+                del state["by_sha"][doc["sha"]]
+        for tok in doc["tokens"]:
+            ids = state["postings"].get(tok)
+            if ids is not None:
+                ids.discard(doc_id)
+                if not ids:
+                    del state["postings"][tok]
+                    state["vocab"] = None
+
+
+def _search_add_comments(state, key, comments, first_seq):
+    uid = state["key_uid"].get(key)
+    if uid is None:
+        uid = state["next_uid"] = state["next_uid"] + 1
+        state["key_uid"][key], state["uid_key"][uid] = uid, key
+    docs = state["thread_docs"].setdefault(uid, [])
+    prev = first_seq - 1
+    for c in comments:
+        prev = c.get("seq", prev + 1)
+        tokens = (search_tokens(c.get("text")) | search_tokens(c.get("author"))
+                  | search_tokens(c.get("attachment")))
+        if "status_change" in c:
+            tokens |= search_tokens(f"{c['status_change'].get('old', '')} {c['status_change'].get('new', '')}")
+        doc_id = state["next_doc"] = state["next_doc"] + 1
+        state["docs"][doc_id] = {"uid": uid, "seq": prev, "author": c.get("author", ""),
+                                 "when": c.get("when", ""), "text": c.get("text", ""),
+                                 "attachment": c.get("attachment"), "tokens": tokens,
+                                 "id": _comment_id(c), "sha": c.get("attachment_sha"), "invoice": None}
+        docs.append(doc_id)
+        state["by_author"].setdefault(c.get("author", ""), set()).add(doc_id)
+        _search_post(state, doc_id, tokens)
+        if c.get("attachment_sha"):
+            state["by_sha"].setdefault(c["attachment_sha"], set()).add(doc_id)
+            _search_add_invoice(state, c["attachment_sha"], [doc_id])
+
+
+def _search_post(state, doc_id, tokens):
+    for tok in tokens:
+        ids = state["postings"].get(tok)
+        if ids is None:
+            ids = state["postings"][tok] = set()
+            state["vocab"] = None
+        ids.add(doc_id)
+
+
+def _search_add_invoice(state, sha, doc_ids=None):
+    """Index the extracted text of invoice `sha` into its comments (if extracted and not indexed yet)."""
+    doc_ids = [d for d in (state["by_sha"].get(sha, ()) if doc_ids is None else doc_ids)
+               if state["docs"][d]["invoice"] is None]
+    if not doc_ids:
+        return
+    extracted = read_invoice_text(sha)
+    if extracted is None:
+        return
+    tokens = search_tokens(extracted.get("text"))
+    summary = {"numbers": extracted.get("invoice_numbers", []), "totals": extracted.get("totals", [])}
+    for doc_id in doc_ids:
+        doc = state["docs"][doc_id]
+        doc["tokens"] = doc["tokens"] | tokens
+        doc["invoice"] = summary
+        _search_post(state, doc_id, tokens)
+
+
+def _search_put_thread(state, key, thread):
+    uid = state["key_uid"].get(key)
+    old = [state["docs"][d]["id"] for d in state["thread_docs"].get(uid, [])]
+    if old == [_comment_id(c) for c in thread]:
+        return  # only read marks changed
+    _search_drop_thread(state, key)
+    _search_add_comments(state, key, thread, 1)
+
+
+def _search_rebuild(state, comments):
+    for name in ("postings", "docs", "by_author", "by_sha", "thread_docs", "key_uid", "uid_key"):
+        state[name] = {}
+    state["vocab"] = None
+    for key, thread in comments.items():
+        _search_add_comments(state, key, thread, 1)
+
+
+def _search_apply(state, ev):
+    op = ev["op"]
+    if op == "append_comments":
+        docs = state["thread_docs"].get(state["key_uid"].get(ev["key"]), [])
+        last = state["docs"][docs[-1]]["seq"] if docs else 0
+        _search_add_comments(state, ev["key"], ev["comments"], last + 1)
+    elif op == "put_thread":
+        _search_put_thread(state, ev["key"], ev["thread"])
+    elif op == "drop_thread":
+        _search_drop_thread(state, ev["key"])
+    elif op == "delete_request":
+        i = ev["idx"]
+        _search_drop_thread(state, str(i))
+        shifted = {}
+        for key, uid in state["key_uid"].items():
+            j = int(key) if key.isdigit() else None
+            shifted[str(j - 1) if j is not None and j > i else key] = uid
+        state["key_uid"] = shifted
+        state["uid_key"] = {uid: key for key, uid in shifted.items()}
+    elif op == "reset":
+        _search_rebuild(state, _read_checkpoint(os.path.join(EVENTS_DIR, ev["checkpoint"]))["comments"])
+
+
+def comment_search_index():
+    """
+    The process-wide search index, caught up with the change log (or the
+    store, without a log) and with the invoice extractions announced since.
+    """
+    state = _search_state()
+    signature = _primary_signature()
+    if state["signature"] is None or signature != state["signature"]:
+        with primary_lock(shared=True), state["lock"]:
+            signature = _primary_signature()
+            if state["seq"] is None or not os.path.exists(EVENT_LOG_FILE):
+                _search_rebuild(state, {k: json.loads(t) for k, t in read_comment_rows().items()})
+                state["seq"] = _last_logged_seq() if os.path.exists(EVENT_LOG_FILE) else None
+            else:
+                for ev in read_events(state["seq"]):
+                    _search_apply(state, ev)
+                    state["seq"] = ev["seq"]
+            state["signature"] = signature
+    with state["lock"]:
+        if state["invoice_sub"] is None:
+            state["invoice_sub"] = subscribe("invoice")
+        done = state["invoice_sub"].poll()  # "*" the first time: look for all of them
+        for sha in list(state["by_sha"]) if "*" in done else done:
+            _search_add_invoice(state, sha)
+    return state
+
+
+def search_comments(query, author=None, date_from=None, date_to=None, keys=None, limit=SEARCH_MAX_RESULTS):
+    """
+    Comments matching every word of `query` (the last one also as a prefix,
+    for search-as-you-type), optionally by `author`, within [date_from,
+    date_to] ("YYYY-MM-DD") and among thread `keys`. Newest first, as dicts
+    {key, seq, author, when, text, attachment, invoice}; plus the total match count.
+    """
+    state = comment_search_index()
+    with state["lock"]:
+        candidates = _search_candidates(state, query)
+        if candidates is not None and not candidates:
+            return [], 0
+        if author:
+            mine = state["by_author"].get(author, set())
+            candidates = mine if candidates is None else candidates & mine
+        if candidates is None:
+            candidates = state["docs"].keys()
+        hits = []
+        for doc_id in candidates:
+            doc = state["docs"][doc_id]
+            key = state["uid_key"].get(doc["uid"])
+            if (key is None or (keys is not None and key not in keys)
+                    or (date_from and doc["when"][:10] < date_from) or (date_to and doc["when"][:10] > date_to)):
+                continue
+            hits.append((doc["when"], doc_id, key))
+        top = heapq.nlargest(limit, hits)
+        return [{"key": key, "seq": state["docs"][d]["seq"], "author": state["docs"][d]["author"],
+                 "when": when, "text": state["docs"][d]["text"], "attachment": state["docs"][d]["attachment"],
+                 "invoice": state["docs"][d]["invoice"]}
+                for when, d, key in top], len(hits)
+
+
+def _search_candidates(state, query):
+    """Doc ids matching every word of `query` (the last one also as a prefix); None for no words."""
+    words = sorted(search_tokens(query), key=len)
+    last = (search_tokens(query.split()[-1]) if query.split() else set())
+    candidates = None
+    for word in words:
+        ids = set(state["postings"].get(word, ()))
+        if word in last:  # prefix matches, from the sorted vocabulary
+            if state["vocab"] is None:
+                state["vocab"] = sorted(state["postings"])
+            vocab = state["vocab"]
+            i = bisect.bisect_left(vocab, word)
+            while i < len(vocab) and vocab[i].startswith(word):
+                ids |= state["postings"][vocab[i]]
+                i += 1
+        candidates = ids if candidates is None else candidates & ids
+        if not candidates:
+            return set()
+    return candidates
+
+
+def search_invoice_threads(query):
+    """Thread keys with an invoice PDF whose text (or comment) matches every word of `query`."""
+    state = comment_search_index()
+    with state["lock"]:
+        candidates = _search_candidates(state, query)
+        return {state["uid_key"][state["docs"][d]["uid"]] for d in candidates or ()
+                if state["docs"][d]["invoice"] is not None and state["docs"][d]["uid"] in state["uid_key"]}
+
+
+def comment_search_authors():
+    state = comment_search_index()
+    with state["lock"]:
+        return sorted(a for a in state["by_author"] if a)
+
+
+# ----- CONTENT-ADDRESSED ATTACHMENTS (links + legacy migration) -----
+# The store itself (uploads/ab/cd/<hash>), the orphan collector and the
+# storage report are in helpcenter_attachments.
+def attachment_href(c, base, user):
+    """
+    The signed link of comment `c`'s attachment on the file server at `base`,
+    issued to `user`; None for a legacy upload (no hash, nothing is served)
+    or when this browser can't reach the file server (`base` is None).
+    """
+    sha = c.get("attachment_sha")
+    if not sha or not base:
+        return None
+    return signed_files_url(base, f"/{UPLOADS_DIR}/{sha[:2]}/{sha[2:4]}/{sha}", c["attachment"], user)
+
+
+@st.cache_resource
+def migrate_legacy_uploads():
+    """
+    Move legacy flat uploads into the content store and point their comments
+    at the hash (one writer job, so it lands as one logged change). Files no
+    comment references are left for the orphan collector. Returns the number
+    of comments migrated.
+    """
+    if not _legacy_uploads():
+        return 0
+    moved = []
+
+    def _job(requests, comments):
+        stored = {}  # legacy name -> sha; hash everything before touching the state
+        for thread in comments.values():
+            for c in thread:
+                name = c.get("attachment")
+                if name and not c.get("attachment_sha") and name not in stored:
+                    path = os.path.join(UPLOADS_DIR, name)
+                    if os.path.isfile(path):
+                        with open(path, "rb") as fp:
+                            stored[name] = store_attachment(fp)[0]
+        events, count = [], 0
+        for key, thread in comments.items():
+            changed = False
+            for c in thread:
+                name = c.get("attachment")
+                if name in stored and not c.get("attachment_sha"):
+                    match = _LEGACY_UPLOAD_NAME.match(name)
+                    c["attachment"] = match.group(1) if match else name
+                    c["attachment_sha"] = stored[name]
+                    changed, count = True, count + 1
+            if changed:
+                events.append({"op": "put_thread", "key": key, "thread": thread})
+        moved.extend(stored)
+        return events, count
+
+    count = submit_write(_job, user="migration").result()["value"]
+    for name in moved:  # the comments now point at the store
+        try:
+            os.remove(os.path.join(UPLOADS_DIR, name))
+        except FileNotFoundError:
+            pass
+    cache = _chat_html_cache()
+    with cache["lock"]:
+        cache["html"].clear()  # memoized bubbles still link the old paths
+    return count
+
+
+# ----- ATTACHMENT FILE SERVER -----
+# Streamlit does not serve uploads/, so attachment links point at a small
+# threaded HTTP server started once per process (FILES_PORT, on 127.0.0.1
+# unless HELP_CENTER_FILES_ADDRESS says otherwise; with several workers they
+# share the port via SO_REUSEPORT). It only serves URLs the app signed: a
+# logged-in session's chat issues each link with an HMAC over path, name,
+# user and expiry, so the server never hands out a file the app didn't show
+# that user. Files are streamed from disk in chunks on the server's own
+# threads, never through a script run. Stored files are named by their hash,
+# so the hash is a strong ETag and responses are cacheable; Last-Modified /
+# If-Modified-Since and single byte ranges (PDF viewers fetch pages this way)
+# are supported too.
+FILES_CHUNK = 256 * 1024  # bytes per read/write while streaming
+FILES_TOKEN_TTL = 6 * 3600  # s; a link stays valid for one to two TTLs
+FILES_SECRET_FILE = "files.secret"  # HMAC key shared by the workers (unless HELP_CENTER_FILES_SECRET)
+
+
+def _is_loopback(host):
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == "localhost"
+
+
+def attachment_base_url():
+    """
+    Where this session's browser reaches the file server: FILES_URL, else the
+    page's host on FILES_PORT over http. None (warned once per session) when
+    that can't work: the server only listens on loopback and the browser is
+    on another machine, or the page is https and the links would be blocked
+    as mixed content. Attachments are then listed without links.
+    """
+    if FILES_URL:
+        return FILES_URL.rstrip("/")
+    headers = st.context.headers
+    host = urlsplit("//" + (headers.get("Host") or "")).hostname or "localhost"
+    scheme = urlsplit(headers.get("Origin") or "").scheme or headers.get("X-Forwarded-Proto") or "http"
+    if scheme == "https":
+        problem = "this page is served over https, and plain-http links to the file server would be blocked"
+    elif _is_loopback(FILES_ADDRESS) and not _is_loopback(host):
+        problem = f"the file server only listens on {FILES_ADDRESS}, which this browser can't reach"
+    else:
+        return f"http://{f'[{host}]' if ':' in host else host}:{FILES_PORT}"
+    if not st.session_state.get("files_url_warned"):
+        st.session_state.files_url_warned = True
+        st.warning(f"📎 Attachments are listed without links: {problem}. "
+                   "Set HELP_CENTER_FILES_URL (see README).")
+    return None
+
+
+@st.cache_resource
+def _files_secret():
+    """The link-signing key: HELP_CENTER_FILES_SECRET, or FILES_SECRET_FILE (created once, 0600)."""
+    if FILES_SECRET:
+        return FILES_SECRET.encode("utf-8")
+    if not os.path.exists(FILES_SECRET_FILE):
+        tmp = f"{FILES_SECRET_FILE}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(tmp, FILES_SECRET_FILE)  # atomic: the first worker's key wins
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+    with open(FILES_SECRET_FILE, encoding="utf-8") as f:
+        return f.read().strip().encode("utf-8")
+
+
+def files_link_expiry(now=None):
+    """Expiry of links issued now: rounded to TTL steps, so memoized chat HTML stays valid for a while."""
+    now = time.time() if now is None else now
+    return (int(now) // FILES_TOKEN_TTL + 2) * FILES_TOKEN_TTL
+
+
+def _files_signature(path, name, user, exp):
+    msg = f"{path}\n{name}\n{user}\n{exp}".encode("utf-8")
+    return hmac.new(_files_secret(), msg, hashlib.sha256).hexdigest()
+
+
+def signed_files_url(base, path, name, user):
+    """URL of file server `path` (unquoted) at `base`, served as `name`, for `user` until files_link_expiry()."""
+    exp = files_link_expiry()
+    query = urlencode({"name": name, "u": user, "exp": exp, "sig": _files_signature(path, name, user, exp)})
+    return f"{base}{quote(path)}?{query}"
+
+
+def _files_link_valid(path, query):
+    args = {k: v[0] for k, v in parse_qs(query).items()}
+    try:
+        exp = int(args.get("exp", ""))
+    except ValueError:
+        return False
+    if exp < time.time():
+        return False
+    expected = _files_signature(path, args.get("name", ""), args.get("u", ""), exp)
+    return hmac.compare_digest(args.get("sig", ""), expected)
+
+
+def _resolve_attachment(path):
+    """(file path, ETag) for a (decoded) /uploads/... request path, or None if it isn't one."""
+    parts = path.split("/")
+    if len(parts) == 5 and parts[:2] == ["", UPLOADS_DIR] and _SHA256_HEX.match(parts[4]) \
+            and parts[2:4] == [parts[4][:2], parts[4][2:4]]:
+        sha = parts[4]
+        live = attachment_path(sha)
+        if not os.path.exists(live):  # quarantined by a collector run racing a new reference
+            live = os.path.join(UPLOADS_DIR, ATTACHMENT_QUARANTINE, sha)
+        return live, sha
+    if len(parts) == 5 and parts[:3] == ["", UPLOADS_DIR, PREVIEW_DIR] and parts[4].endswith(".png") \
+            and _SHA256_HEX.match(parts[4][:-4]) and parts[3] == parts[4][:2]:
+        return preview_path(parts[4][:-4], "png"), f"{parts[4][:-4]}-preview"
+    return None
+
+
+class AttachmentHandler(BaseHTTPRequestHandler):
+    """GET/HEAD /uploads/ab/cd/<sha>?name=<original name>&u=&exp=&sig= (see signed_files_url)."""
+
+    protocol_version = "HTTP/1.1"
+    server_version = "HelpCenterFiles"
+
+    def log_message(self, format, *args):
+        pass  # one line per request would drown the Streamlit log
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def _fail(self, code, headers=()):
+        self.send_response(code)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _serve(self, body):
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        found = _resolve_attachment(path)
+        if found is None:
+            return self._fail(404)
+        if not _files_link_valid(path, url.query):
+            return self._fail(403)  # unsigned, tampered with or expired
+        path, tag = found
+        try:
+            f = open(path, "rb")
+        except (FileNotFoundError, IsADirectoryError):
+            return self._fail(404)
+        with f:
+            info = os.fstat(f.fileno())
+            size, mtime = info.st_size, int(info.st_mtime)
+            etag = f'"{tag}"'
+            name = (parse_qs(url.query).get("name") or [os.path.basename(path)])[0]
+            headers = [
+                ("ETag", etag),
+                ("Last-Modified", formatdate(mtime, usegmt=True)),
+                ("Accept-Ranges", "bytes"),
+                ("Cache-Control", f"private, max-age={FILES_TOKEN_TTL}, immutable"),
+            ]
+            if self._not_modified(etag, mtime):
+                return self._fail(304, headers)
+            start, end = 0, size - 1
+            ranged = self._byte_range(size, etag, mtime)
+            if ranged == "unsatisfiable":
+                return self._fail(416, [("Content-Range", f"bytes */{size}")])
+            if ranged:
+                start, end = ranged
+            self.send_response(206 if ranged else 200)
+            for k, v in headers:
+                self.send_header(k, v)
+            self.send_header("Content-Type", mimetypes.guess_type(name)[0] or "application/octet-stream")
+            self.send_header("Content-Disposition", f"inline; filename*=UTF-8''{quote(name)}")
+            if ranged:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            if not body:
+                return
+            f.seek(start)
+            left = end - start + 1
+            try:
+                while left > 0:
+                    chunk = f.read(min(FILES_CHUNK, left))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    left -= len(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True  # the viewer cancelled (seeking, closed tab)
+
+    def _not_modified(self, etag, mtime):
+        match = self.headers.get("If-None-Match")
+        if match is not None:
+            return match.strip() == "*" or etag in [t.strip() for t in match.split(",")]
+        since = self.headers.get("If-Modified-Since")
+        if since:
+            try:
+                return mtime <= parsedate_to_datetime(since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _byte_range(self, size, etag, mtime):
+        """(first, last) of a single "Range: bytes=" request; None for the whole file."""
+        spec = self.headers.get("Range", "")
+        if not spec.startswith("bytes=") or "," in spec:
+            return None  # absent, or several ranges: send the whole file
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range != etag and if_range != formatdate(mtime, usegmt=True):
+            return None  # the client's copy is stale
+        first, _, last = spec[6:].strip().partition("-")
+        try:
+            if not first:  # the last N bytes
+                n = int(last)
+                return (max(0, size - n), size - 1) if n > 0 and size else "unsatisfiable"
+            first = int(first)
+            last = min(int(last), size - 1) if last else size - 1
+        except ValueError:
+            return None
+        if first >= size or first > last:
+            return "unsatisfiable"
+        return first, last
+
+
+class _ReusePortServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_port = hasattr(socket, "SO_REUSEPORT")  # every worker can bind FILES_PORT
+
+
+@st.cache_resource
+def start_attachment_server():
+    """The per-process file server thread; returns the server (None if the port can't be bound)."""
+    try:
+        server = _ReusePortServer((FILES_ADDRESS, FILES_PORT), AttachmentHandler)
+    except OSError:
+        return None  # port taken (by another worker without SO_REUSEPORT): that one serves the files
+    t = threading.Thread(target=server.serve_forever, name="attachment-server", daemon=True)
+    t.start()
+    return server
+
+
+# ----- ATTACHMENT PREVIEWS -----
+# Chat bubbles show a preview of their attachment: a first-page thumbnail for
+# PDFs, a downscaled copy of PNGs and the first rows of each XLSX sheet. A
+# small background pool builds them into uploads/previews/ab/<hash>.png|.json
+# (once per content, like the files themselves). New uploads are queued when
+# their comment is added; older ones when a chat first shows them. Rendering
+# only ever checks whether a preview exists.
+PREVIEW_WORKERS = 2
+PREVIEW_SIZE = (320, 320)  # px bounding box of thumbnails
+PREVIEW_PDF_DPI = 50  # first-page render resolution before downscaling
+PREVIEW_SHEETS, PREVIEW_ROWS, PREVIEW_COLS = 3, 6, 6  # XLSX excerpt
+
+
+@st.cache_resource
+def _preview_state():
+    return {"lock": threading.Lock(), "pool": ThreadPoolExecutor(PREVIEW_WORKERS, thread_name_prefix="preview"),
+            "ready": {}, "pending": set(), "built": 0, "failed": 0}
+
+
+class PreviewUnreadable(ValueError):
+    """The attachment could not be parsed (it gets an .err marker and is not retried)."""
+
+
+def _preview_kind(name):
+    """The preview kind of attachment `name`, or None if it has none or this process lacks the library."""
+    ext = os.path.splitext(name or "")[1].lower()
+    if ext == ".pdf":
+        return "png" if pdfplumber is not None and Image is not None else None
+    if ext == ".png":
+        return "png" if Image is not None else None
+    if ext == ".xlsx":
+        return "json" if openpyxl is not None else None
+    return None
+
+
+def _forget_preview(sha):
+    """The collector deleted the previews of `sha` (see helpcenter_attachments.drop_derived_files)."""
+    with _preview_state()["lock"]:
+        _preview_state()["ready"].pop(sha, None)
+
+
+on_derived_dropped("previews", _forget_preview)
+
+
+def _render_preview(fp, name, kind):
+    """The preview of attachment `name` read from `fp`: the XLSX excerpt (kind "json") or a PIL thumbnail."""
+    if kind == "json":
+        wb = openpyxl.load_workbook(fp, read_only=True, data_only=True)  # a file object: openpyxl rejects paths without .xlsx
+        try:
+            return {"sheets": [{"name": ws.title,
+                                "rows": [["" if v is None else str(v) for v in row]
+                                         for row in ws.iter_rows(max_row=PREVIEW_ROWS, max_col=PREVIEW_COLS, values_only=True)]}
+                               for ws in wb.worksheets[:PREVIEW_SHEETS]]}
+        finally:
+            wb.close()
+    if name.lower().endswith(".pdf"):
+        with pdfplumber.open(fp) as pdf:
+            image = pdf.pages[0].to_image(resolution=PREVIEW_PDF_DPI).original
+    else:
+        image = Image.open(fp)
+        image.load()
+    image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+    image.thumbnail(PREVIEW_SIZE)
+    return image
+
 
-            if t == "💲":
-                req = {**base,
-                    "Type": "💲",
-                    "Invoice": ref,
-                    "Order#": "",
-                    "Cost": prices,
-                    "Proveedor": partner
-                }
-            else:
-                req = {**base,
-                    "Type": "🛒",
-                    "Order#": ref,
-                    "Invoice": "",
-                    "Sale Price": prices,
-                    "Cliente": partner
-                }
-            reqs_by_old[int(old_idx)] = req
+def _build_preview(sha, name):
+    """
+    Worker: write the preview of stored attachment `sha`. Only a file the
+    parser rejects gets an .err marker; other failures (the file vanished,
+    a full disk) are retried on the next start.
+    """
+    kind = _preview_kind(name)
+    out = preview_path(sha, kind)
+    tmp = f"{out}.{os.getpid()}.{threading.get_ident()}.tmp"
+    state = _preview_state()
+    try:
+        with open(attachment_path(sha), "rb") as fp:
+            try:
+                preview = _render_preview(fp, name, kind)
+            except MemoryError:
+                raise
+            except Exception as e:
+                raise PreviewUnreadable(str(e)) from e
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        if kind == "json":
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(preview, f)
+        else:
+            preview.save(tmp, format="PNG", optimize=True)
+        os.replace(tmp, out)
+        with state["lock"]:
+            state["ready"][sha] = kind
+            state["built"] += 1
+    except Exception as e:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        if isinstance(e, PreviewUnreadable):
+            try:
+                os.makedirs(os.path.dirname(out), exist_ok=True)
+                open(preview_path(sha, "err"), "w").close()  # don't retry it
+            except OSError:
+                pass
+        with state["lock"]:
+            state["ready"][sha] = None
+            state["failed"] += 1
+    finally:
+        with state["lock"]:
+            state["pending"].discard(sha)
+
+
+def preview_status(c):
+    """
+    The preview kind ("png"/"json") of comment `c`'s attachment if it is
+    built, False while it is queued (this call queues it), None if there is
+    none. Cheap: a memory lookup after the first check of each file.
+    """
+    sha, kind = c.get("attachment_sha"), _preview_kind(c.get("attachment"))
+    if not sha or not kind:
+        return None
+    state = _preview_state()
+    with state["lock"]:
+        if sha in state["ready"]:
+            return state["ready"][sha]
+        if sha in state["pending"]:
+            return False
+    if os.path.exists(preview_path(sha, kind)):
+        found = kind
+    elif os.path.exists(preview_path(sha, "err")):
+        found = None
+    elif not os.path.exists(attachment_path(sha)):
+        return None  # missing or quarantined: nothing to build from
+    else:
+        queue_preview(sha, c["attachment"])
+        return False
+    with state["lock"]:
+        state["ready"][sha] = found
+    return found
+
+
+def queue_preview(sha, name):
+    """Build the preview of `sha` (named `name`) in the background, unless it's queued already or can't be built here."""
+    if not _preview_kind(name):
+        return  # no preview for this type, or its optional library isn't installed
+    state = _preview_state()
+    with state["lock"]:
+        if sha in state["pending"] or state["ready"].get(sha):
+            return
+        state["pending"].add(sha)
+    state["pool"].submit(_build_preview, sha, name)
+
+
+def _preview_html(c, files_url, kind, viewer):
+    """The inline preview of comment `c`'s attachment for `viewer` (built: see preview_status)."""
+    sha = c["attachment_sha"]
+    if kind == "png":
+        if not files_url:
+            return ""
+        src = html_escape(signed_files_url(files_url, f"/{UPLOADS_DIR}/{PREVIEW_DIR}/{sha[:2]}/{sha}.png",
+                                           f"{os.path.splitext(c['attachment'])[0]}.png", viewer))
+        return (f'<a href="{html_escape(attachment_href(c, files_url, viewer))}" target="_blank">'
+                f'<img src="{src}" loading="lazy" alt="" style="display:block; max-width:100%; '
+                f'margin-top:6px; border-radius:4px;"></a>')
+    try:
+        with open(preview_path(sha, "json"), encoding="utf-8") as f:
+            sheets = json.load(f)["sheets"]
+    except (OSError, ValueError, KeyError):
+        return ""
+    parts = []
+    for sheet in sheets:
+        rows = "".join("<tr>" + "".join(f'<td style="border:1px solid #BBB; padding:1px 4px;">{html_escape(v)}</td>'
+                                        for v in row) + "</tr>" for row in sheet["rows"])
+        parts.append(f'<div style="font-size:11px; margin-top:6px;"><b>{html_escape(sheet["name"])}</b>'
+                     f'<table style="border-collapse:collapse; font-size:11px;">{rows}</table></div>')
+    return "".join(parts)
+
+
+# ----- PDF INVOICE TEXT EXTRACTION -----
+# PDFs attached to 💲 orders are purchase invoices: their text (plus invoice
+# numbers and totals, when spotted) is extracted once per content into
+# uploads/text/ab/<hash>.json by running `invoice_extract.py --json` as a
+# child process (a few at a time), so parsing never holds the GIL of the app
+# process or blocks an upload. A child is a fresh interpreter importing only
+# invoice_extract: nothing is forked from this threaded server, and a child
+# that crashes or runs out of memory takes nothing else down. Only a file the
+# parser rejects gets an .err marker; other failures are retried on the next
+# start. Uploads are queued when their comment is added; a backfill at startup
+# queues the PDFs stored before. A finished extraction is published on the
+# bus ("invoice", hash) and the search index adds the text to that comment.
+INVOICE_WORKERS = 2
+INVOICE_TIMEOUT = 120  # s per file
+
+
+class InvoiceUnreadable(ValueError):
+    """invoice_extract could not parse the file (it is not retried)."""
+
+
+@st.cache_resource
+def _invoice_state():
+    return {"lock": threading.Lock(), "pending": set(), "extracted": 0, "failed": 0,
+            "pool": ThreadPoolExecutor(INVOICE_WORKERS, thread_name_prefix="invoice")}
+
+
+def _run_invoice_extract(path):
+    """invoice_extract.extract_invoice(path), in a child process."""
+    proc = subprocess.run([sys.executable, invoice_extract.__file__, "--json", path],
+                          capture_output=True, timeout=INVOICE_TIMEOUT, stdin=subprocess.DEVNULL)
+    if proc.returncode == invoice_extract.UNREADABLE_EXIT:
+        raise InvoiceUnreadable(proc.stderr.decode("utf-8", "replace").strip())
+    if proc.returncode != 0:
+        raise RuntimeError(f"invoice_extract exited with {proc.returncode}")
+    return json.loads(proc.stdout)
+
+
+def read_invoice_text(sha):
+    """The extraction stored for attachment `sha`, or None (not a 💲 PDF, not done yet, or failed)."""
+    try:
+        with open(invoice_text_path(sha), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-    # Requirements (📑)
-    if os.path.exists(EXPORT_REQUIREMENTS_CSV) and os.path.getsize(EXPORT_REQUIREMENTS_CSV) > 0:
-        rdf = pd.read_csv(EXPORT_REQUIREMENTS_CSV).fillna("")
-        for old_idx, g in rdf.groupby("RequestIndex"):
-            items = []
-            for _, row in g.iterrows():
-                items.append({
-                    "Description": str(row.get("Description","")),
-                    "Target Price": str(row.get("Target Price","")),
-                    "QTY": row.get("Qty","")
-                })
-            reqs_by_old[int(old_idx)] = {
-                "Type": "📑",
-                "Items": items,
-                "Vendedor Encargado": str(g["Vendedor Encargado"].iloc[0]) if "Vendedor Encargado" in g else "",
-                "Comprador Encargado": str(g["Comprador Encargado"].iloc[0]) if "Comprador Encargado" in g else "",
-                "Fecha": str(g["Fecha"].iloc[0]) if "Fecha" in g else "",
-                "Status": str(g["Status"].iloc[0]) if "Status" in g else "OPEN",
-            }
 
-    # Comments
-    comments_old = {}
-    if os.path.exists(EXPORT_COMMENTS_CSV) and os.path.getsize(EXPORT_COMMENTS_CSV) > 0:
-        cdf = pd.read_csv(EXPORT_COMMENTS_CSV).fillna("")
-        for old_idx, g in cdf.groupby("RequestIndex"):
-            lst = []
-            for _, row in g.iterrows():
-                entry = {
-                    "author": str(row.get("Author","")),
-                    "when": str(row.get("When","")),
-                    "text": str(row.get("Text","")),
-                }
-                att = str(row.get("Attachment",""))
-                if att.strip():
-                    entry["attachment"] = att
-                lst.append(entry)
-            comments_old[int(old_idx)] = lst
+def _store_invoice_text(sha, fut):
+    """Pool callback: save the extraction (an .err marker if the PDF is unreadable) and announce it."""
+    state = _invoice_state()
+    out = invoice_text_path(sha)
+    try:
+        result = fut.result()
+        tmp = f"{out}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        os.replace(tmp, out)
+        with state["lock"]:
+            state["extracted"] += 1
+        publish("invoice", sha)
+    except Exception as e:
+        if isinstance(e, InvoiceUnreadable):
+            try:
+                open(invoice_text_path(sha, "err"), "w").close()  # don't retry it
+            except OSError:
+                pass
+        with state["lock"]:
+            state["failed"] += 1
+    finally:
+        with state["lock"]:
+            state["pending"].discard(sha)
+
+
+def queue_invoice_text(sha, name):
+    """Extract the text of PDF attachment `sha` in the background, unless it's done or queued."""
+    if invoice_extract is None or not (name or "").lower().endswith(".pdf"):
+        return
+    if os.path.exists(invoice_text_path(sha)) or os.path.exists(invoice_text_path(sha, "err")):
+        return
+    state = _invoice_state()
+    with state["lock"]:
+        if sha in state["pending"]:
+            return
+        state["pending"].add(sha)
+    os.makedirs(os.path.dirname(invoice_text_path(sha)), exist_ok=True)
+    fut = state["pool"].submit(_run_invoice_extract, attachment_path(sha))
+    fut.add_done_callback(lambda f: _store_invoice_text(sha, f))
+
+
+@st.cache_resource
+def start_invoice_backfill():
+    """One pass per process queueing the 💲 orders' PDFs that have no extracted text yet."""
+    def _run():
+        try:
+            with primary_lock(shared=True):
+                requests, comments = _read_primary_files()
+            for key, thread in comments.items():
+                i = int(key) if key.isdigit() else -1
+                if 0 <= i < len(requests) and requests[i].get("Type") == "💲":
+                    for c in thread or []:
+                        if c.get("attachment_sha") and os.path.exists(attachment_path(c["attachment_sha"])):
+                            queue_invoice_text(c["attachment_sha"], c.get("attachment"))
+        except Exception:
+            pass  # uploads are still queued as they happen; the next start retries
 
-    # Reindex requests contiguously and remap comment keys
-    sorted_pairs = sorted(reqs_by_old.items())  # [(old_idx, req), ...]
-    requests, idx_map = [], {}
-    for new_idx, (old_idx, req) in enumerate(sorted_pairs):
-        idx_map[old_idx] = new_idx
-        requests.append(req)
+    t = threading.Thread(target=_run, name="invoice-backfill", daemon=True)
+    t.start()
+    return t
 
-    comments = {}
-    for old_idx, lst in comments_old.items():
-        if old_idx in idx_map:
-            comments[str(idx_map[old_idx])] = lst
 
-    return requests, comments
+def try_restore_from_snapshot(point=None):
+    """
+    If local JSONs are empty/missing, restore from the newest of the Parquet
+    snapshot, the latest history point (base + deltas), the JSON snapshot and
+    the change log (checkpoint + tail), else from CSVs. With `point` (a file name from list_restore_points()),
+    restore exactly that history point — only its chain's archives are opened.
+    """
+    def _adopt(requests, comments, reason):
+        # through the writer (locked, logged, versions bumped) so normal load() works next run
+        st.session_state.comments = {}  # threads are loaded again on demand
+        _adopt_commit(replace_primary_state(requests, comments, reason, st.session_state.get("user_name", "")))
+        return True
 
+    if point is not None:
+        try:
+            snap = load_restore_point(point)
+            return _adopt(snap["requests"], snap["comments"], f"restore point {point}")
+        except Exception as e:
+            st.warning(f"Restore point {point} failed: {e}")
+            return False
 
-def try_restore_from_snapshot():
-    """If local JSONs are empty/missing, restore from snapshot JSON, else from CSVs."""
-    # Prefer JSON snapshot (exact structure)
+    def _from_json():  # written by older versions; the history replaced it
+        with open(EXPORT_JSON, "r", encoding="utf-8") as f:
+            snap = json.load(f)
+        return snap.get("requests", []), snap.get("comments", {})
+
+    def _from_history():
+        snap = load_restore_point(points[0]["file"], points)
+        return snap["requests"], snap["comments"]
+
+    # Newest source first (ties: Parquet, then history, then JSON, then change log)
+    sources = []
+    pq_mtime = parquet_snapshot_mtime()
+    if pq_mtime is not None:
+        sources.append((pq_mtime, "Parquet snapshot", rebuild_from_parquet))
+    points = list_restore_points()
+    if points:
+        sources.append((points[0]["epoch"], "Snapshot history", _from_history))
     if os.path.exists(EXPORT_JSON) and os.path.getsize(EXPORT_JSON) > 0:
+        sources.append((os.path.getmtime(EXPORT_JSON), "JSON snapshot", _from_json))
+    if os.path.exists(EVENT_LOG_FILE) and os.path.getsize(EVENT_LOG_FILE) > 0:
+        sources.append((os.path.getmtime(EVENT_LOG_FILE), "Change log", lambda: rebuild_from_events()[:2]))
+
+    for _, label, loader in sorted(sources, key=lambda s: -s[0]):
         try:
-            with open(EXPORT_JSON, "r", encoding="utf-8") as f:
-                snap = json.load(f)
-            st.session_state.requests = snap.get("requests", [])
-            st.session_state.comments = snap.get("comments", {})
-            # write back the primary JSONs so normal load() works next run
-            with open(REQUESTS_FILE, "w", encoding="utf-8") as f:
-                json.dump(st.session_state.requests, f, ensure_ascii=False, indent=2)
-            with open(COMMENTS_FILE, "w", encoding="utf-8") as f:
-                json.dump(st.session_state.comments, f, ensure_ascii=False, indent=2)
-            return True
+            requests, comments = loader()
+            if requests:
+                return _adopt(requests, comments, f"auto-restore from {label}")
         except Exception as e:
-            st.warning(f"JSON snapshot restore failed: {e}")
+            st.warning(f"{label} restore failed: {e}")
 
     # Fallback: rebuild from CSVs
     try:
         requests, comments = rebuild_from_csvs()
         if requests:
-            st.session_state.requests = requests
-            st.session_state.comments = comments
-            with open(REQUESTS_FILE, "w", encoding="utf-8") as f:
-                json.dump(requests, f, ensure_ascii=False, indent=2)
-            with open(COMMENTS_FILE, "w", encoding="utf-8") as f:
-                json.dump(comments, f, ensure_ascii=False, indent=2)
-            return True
+            return _adopt(requests, comments, "auto-restore from CSVs")
     except Exception as e:
         st.warning(f"CSV restore failed: {e}")
 
@@ -197,13 +2948,33 @@ def try_restore_from_snapshot():
 # -------------------------------------------
 st.set_page_config(page_title="Tito's Depot Help Center", layout="wide", page_icon="🛒")
 
-REQUESTS_FILE = "requests.json"
-COMMENTS_FILE = "comments.json"
-UPLOADS_DIR = "uploads"
+# REQUESTS_FILE, COMMENTS_DIR, STORE_BACKEND, NOTIFY_BACKEND, ...: see helpcenter_store; UPLOADS_DIR: helpcenter_attachments
+# attachment file server: bind address/port, the URL browsers use (if proxied), link-signing key
+FILES_ADDRESS = os.environ.get("HELP_CENTER_FILES_ADDRESS", "127.0.0.1")
+FILES_PORT = int(os.environ.get("HELP_CENTER_FILES_PORT", "8600"))
+FILES_URL = os.environ.get("HELP_CENTER_FILES_URL", "").strip()
+FILES_SECRET = os.environ.get("HELP_CENTER_FILES_SECRET", "").strip()
 
 # Ensure the uploads directory exists
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 
+# Background jobs (one thread per process): history retention, scheduled backups, batched fsync
+start_snapshot_pruner()
+start_backup_scheduler()
+start_primary_syncer()
+try:
+    ensure_record_ids()  # records from before stable ids
+except Exception as e:
+    st.warning(f"Record id migration failed: {e}")
+# One-time move of flat legacy uploads into the content-addressed store
+try:
+    migrate_legacy_uploads()
+except Exception as e:
+    st.warning(f"Attachment migration failed: {e}")
+start_attachment_gc()
+start_attachment_server()
+start_invoice_backfill()
+
 # Example users (username: password)
 VALID_USERS = {
     "Andres": "GreenPhone13!",
@@ -253,53 +3024,121 @@ def format_status_badge(status):
 # Persistence Helpers
 
 def load_data():
-    # Load requests
-    if os.path.exists(REQUESTS_FILE) and os.path.getsize(REQUESTS_FILE) > 0:
-        try:
-            with open(REQUESTS_FILE, "r", encoding="utf-8") as f:
-                st.session_state.requests = json.load(f)
-        except json.JSONDecodeError:
-            st.session_state.requests = []
-    else:
-        st.session_state.requests = []
-
-    # Load comments
-    if os.path.exists(COMMENTS_FILE) and os.path.getsize(COMMENTS_FILE) > 0:
+    settle_pending_writes()
+    version = _primary_signature()
+    if (version == st.session_state.get("data_version") and "requests" in st.session_state
+            and st.session_state.get("_baseline_raw") is not None):
+        return  # files unchanged since this session last loaded/saved them
+
+    # Read the requests and the thread index as one consistent pair (shared
+    # lock; missing/empty → empty). Only threads this session holds are parsed.
+    corrupt = None
+    with primary_lock(shared=True):
+        version = _primary_signature()
+        requests_text, _ = read_primary_texts(comments=False)
         try:
-            with open(COMMENTS_FILE, "r", encoding="utf-8") as f:
-                st.session_state.comments = json.load(f)
-        except json.JSONDecodeError:
-            st.session_state.comments = {}
-    else:
-        st.session_state.comments = {}
+            stored_threads = thread_index()["texts"]
+        except json.JSONDecodeError as e:
+            corrupt, stored_threads = f"a comment thread in {COMMENTS_DIR}/ is unreadable ({e})", {}
+    try:
+        requests = json.loads(requests_text) if requests_text else []
+    except json.JSONDecodeError as e:
+        corrupt, requests = f"{REQUESTS_FILE} is unreadable ({e})", []
+
+    # Writes are atomic, so a decode error is real damage — never treat it as "no data"
+    if corrupt:
+        if "requests" in st.session_state:
+            st.warning(f"{corrupt}; keeping the copy already loaded.")
+            return
+        st.warning(f"{corrupt}; restoring from the newest backup source.")
+        if try_restore_from_snapshot():
+            return
+    held = st.session_state.get("comments") or {}
+    threads_text = json.dumps({k: json.loads(stored_threads[k]) for k in held if k in stored_threads})
+    comments = json.loads(threads_text)
+
+    # Keep this session's unsaved edits: replay them on top of the new data
+    base = _baseline()
+    if base is not None and "requests" in st.session_state:
+        local = diff_events(base[0], base[1], st.session_state.requests, st.session_state.comments)
+        if local:
+            _, conflicts = rebase_events(local, base[0], base[1], requests, comments)
+            queue_merge_conflicts([c for c in conflicts if c["fields"]])
+    st.session_state.requests = requests
+    st.session_state.comments = comments
+    _set_baseline(requests_text, threads_text)
 
     # --- NEW: if both are empty, try to restore from snapshot/CSVs ---
-    if not st.session_state.requests and not st.session_state.comments:
+    if not st.session_state.requests and not stored_threads:
         if try_restore_from_snapshot():
             st.toast("Restored data from snapshot ✅", icon="✅")
 
+    # Version of the data now in session (None if the files changed mid-read)
+    st.session_state.data_version = version if version == _primary_signature() else None
+
 def export_snapshot_to_disk():
     """
-    Build dataframes from session state and write:
-      - CSVs: orders, requirements, comments
-      - Excel workbook with 3 sheets
-      - JSON snapshot with full structure (requests + comments)
+    Record the stored data (never this session's copy) in the snapshot
+    history: a compressed restore point holding a delta of the requests and
+    comment threads changed since the last point (a full base every
+    SNAPSHOT_BASE_EVERY points), so the I/O per save follows what changed.
+    The full-table exports (CSVs, Excel, Parquet) are then refreshed in the
+    background, at most every EXPORT_TABLES_EVERY seconds (see
+    write_export_tables).
+    """
+    try:
+        history_out = archive_snapshot()
+    except Exception as e:
+        history_out = None
+        st.warning(f"Snapshot history not saved: {e}")
+    request_export_tables()
+    return {"history": history_out}
+
+
+# ----- FULL-TABLE EXPORTS (CSV / Excel / Parquet, debounced) -----
+# The spreadsheets and Parquet tables are rewritten whole, so they are not
+# written per save: export_snapshot_to_disk() marks them stale and one thread
+# per process rebuilds them from the stored state at most every
+# EXPORT_TABLES_EVERY seconds. A flock on the export folder keeps workers
+# from writing them at the same time; the history is the current restore source.
+EXPORT_TABLES_EVERY = 5 * 60  # seconds
+
+
+@st.cache_resource
+def _export_tables_state():
+    return {"cond": threading.Condition(), "lock": threading.Lock(), "stale": False,
+            "last_run": None, "error": None, "parquet_skipped": []}
+
+
+def request_export_tables():
+    """Mark the table exports stale; the writer thread refreshes them soon."""
+    start_export_tables_writer()
+    state = _export_tables_state()
+    with state["cond"]:
+        state["stale"] = True
+        state["cond"].notify()
+
+
+def write_export_tables(requests, comments):
+    """
+    Write the CSVs (orders, requirements, comments), the Excel workbook with
+    those three sheets and the Parquet tables for `requests` / `comments`.
     Uses EXPORT_* globals if present; otherwise derives paths from EXPORT_DIR or ./exports.
     """
     # ── Resolve paths (robust if some globals are missing) ─────────────────────────
     from pathlib import Path
     export_dir = Path(globals().get("EXPORT_DIR", Path.cwd() / "exports"))
     export_dir.mkdir(parents=True, exist_ok=True)
+    state = _export_tables_state()
 
     orders_csv    = globals().get("EXPORT_ORDERS_CSV",       str(export_dir / "orders.csv"))
     reqs_csv      = globals().get("EXPORT_REQUIREMENTS_CSV", str(export_dir / "requirements.csv"))
     comments_csv  = globals().get("EXPORT_COMMENTS_CSV",     str(export_dir / "comments.csv"))
     xlsx_path     = globals().get("EXPORT_XLSX",             str(export_dir / "HelpCenter_Snapshot.xlsx"))
-    json_path     = globals().get("EXPORT_JSON",             str(export_dir / "HelpCenter_Snapshot.json"))
 
     # ── Build Orders (PO/SO) — one row per item ───────────────────────────────────
     orders_rows = []
-    for i, r in enumerate(st.session_state.get("requests", []) or []):
+    for i, r in enumerate(requests or []):
         t = r.get("Type")
         if t not in ("💲", "🛒"):
             continue
@@ -331,7 +3170,7 @@ def export_snapshot_to_disk():
 
     # ── Requirements (📑) — one row per item ──────────────────────────────────────
     req_rows = []
-    for i, r in enumerate(st.session_state.get("requests", []) or []):
+    for i, r in enumerate(requests or []):
         if r.get("Type") != "📑":
             continue
         for j, it in enumerate(r.get("Items", []) or []):
@@ -350,18 +3189,19 @@ def export_snapshot_to_disk():
 
     # ── Comments ──────────────────────────────────────────────────────────────────
     comments_rows = []
-    for k, comments in (st.session_state.get("comments", {}) or {}).items():
+    for k, thread in (comments or {}).items():
         try:
             k_int = int(k)
         except Exception:
             k_int = k
-        for c in comments or []:
+        for c in thread or []:
             comments_rows.append({
                 "RequestIndex": k_int,
                 "Author": c.get("author",""),
                 "When":   c.get("when",""),
                 "Text":   c.get("text",""),
                 "Attachment": c.get("attachment",""),
+                "AttachmentSha": c.get("attachment_sha",""),
             })
     comments_df = pd.DataFrame(comments_rows)
 
@@ -384,50 +3224,171 @@ def export_snapshot_to_disk():
             req_df.to_excel(xls, index=False, sheet_name="Requirements")
             comments_df.to_excel(xls, index=False, sheet_name="Comments")
         xlsx_out = str(alt)
-        st.warning(f"Excel is open. Saved snapshot to {alt}.")
+        state["error"] = f"Excel is open. Saved snapshot to {alt}."
 
-    # ── Write JSON snapshot (authoritative restore source) ────────────────────────
+    # ── Write Parquet snapshot (typed tables, preferred by restores when newer) ──
+    parquet_out = None
     try:
-        snap = {
-            "requests": st.session_state.get("requests", []),
-            "comments": st.session_state.get("comments", {})
-        }
-        with open(json_path, "w", encoding="utf-8") as f:
-            json.dump(snap, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        st.warning(f"Snapshot JSON not saved: {e}")
+        parquet_out, manifest = write_parquet_snapshot(requests, comments)
+        state["parquet_skipped"] = manifest["skipped"]
+    except ImportError:
+        pass  # pyarrow not installed: CSVs and the history still cover restores
 
-    # Optional: return paths for logging/diagnostics
     return {
         "orders_csv": orders_csv,
         "requirements_csv": reqs_csv,
         "comments_csv": comments_csv,
         "xlsx": xlsx_out,
-        "json": json_path,
+        "parquet": parquet_out,
     }
 
 
+@st.cache_resource
+def start_export_tables_writer():
+    """One daemon thread per process refreshing the table exports when they are stale."""
+    state = _export_tables_state()
+
+    def _loop():
+        while True:
+            with state["cond"]:
+                while not state["stale"]:
+                    state["cond"].wait()
+            if state["last_run"] is not None:
+                time.sleep(max(0.0, EXPORT_TABLES_EVERY - (time.time() - state["last_run"])))
+            with state["cond"]:
+                state["stale"] = False
+            try:
+                with primary_lock(shared=True):
+                    requests, comments = _read_primary_files()
+                state["error"] = None
+                with dir_lock(EXPORT_DIR, state["lock"]):
+                    write_export_tables(requests, comments)
+            except Exception as e:  # keep the writer alive; surfaced in Backup & Restore
+                state["error"] = str(e)
+            state["last_run"] = time.time()
+
+    t = threading.Thread(target=_loop, name="export-tables", daemon=True)
+    t.start()
+    return t
+
+
+def save_data(events=None, durable=False):
+    """
+    Persist this session's edits and append them to the change log. The edits
+    (baseline → session) are replayed onto the stored state record by record
+    (compare-and-swap on _version, see rebase_events), so a stale session
+    never overwrites what others saved meanwhile. `events` are mutations the
+    field diff can't express (a mid-list delete) and are replayed first.
+
+    The write goes through the group-commit writer. With durable=True this
+    waits for it; otherwise the returned Future is settled on the next
+    load/save of this session (settle_pending_writes).
+    """
+    settle_pending_writes(wait=False)
+    previous_baseline = st.session_state.get("_baseline_raw")
+    hints = json.loads(json.dumps(list(events or [])))
+    base = _baseline()
+    local = None
+    if base is not None:
+        for ev in hints:
+            apply_event(base[0], base[1], ev)
+        # copy: the session may keep mutating its objects before the writer runs
+        local = json.loads(json.dumps(diff_events(base[0], base[1],
+                                                  st.session_state.requests, st.session_state.comments)))
+    else:  # no baseline: diff against the stored state inside the job
+        local_requests = json.loads(json.dumps(st.session_state.requests))
+        local_comments = json.loads(json.dumps(st.session_state.comments))
+
+    def _job(requests, comments):
+        if previous_baseline is not None:
+            base_requests, base_comments = json.loads(previous_baseline[0] or "[]"), json.loads(previous_baseline[1] or "{}")
+        else:  # only the threads the session holds: the others are not its edits
+            base_requests = json.loads(json.dumps(requests))
+            base_comments = json.loads(json.dumps({k: comments[k] for k in local_comments if k in comments}))
+        applied, conflicts = rebase_events(hints, base_requests, base_comments, requests, comments)
+        if hints and conflicts:
+            return applied, {"delete_conflict": True}
+        edits = local if local is not None else diff_events(base_requests, base_comments, local_requests, local_comments)
+        more, conflicts = rebase_events(edits, base_requests, base_comments, requests, comments)
+        return applied + more, {"conflicts": conflicts}
+
+    fut = submit_write(_job, st.session_state.get("user_name", ""))
+    if durable:
+        result = fut.result()
+        _adopt_commit(result)
+        _report_save_outcome(result)
+        try:
+            export_snapshot_to_disk()
+        except Exception as e:
+            st.warning(f"Auto-export failed: {e}")
+    else:
+        # treat the edits as saved for this session; the next run settles the
+        # outcome and exports once the write has landed
+        _set_baseline(json.dumps(st.session_state.requests), json.dumps(st.session_state.comments))
+        st.session_state.setdefault("_pending_writes", []).append((fut, previous_baseline))
+    return fut
+
 
-def save_data():
-    with open(REQUESTS_FILE, "w") as f:
-        json.dump(st.session_state.requests, f, indent=2)
-    with open(COMMENTS_FILE, "w") as f:
-        json.dump(st.session_state.comments, f, indent=2)
+def patch_request(idx, fields, expected_version=None, comments=None, record_id=None):
+    """
+    Apply `fields` to request `idx` as stored on disk (not the session copy),
+    optionally appending `comments` to its thread, and log only what changed.
+    Other records and fields are left exactly as stored. With `record_id`
+    (the record's _id) the record is found wherever it is stored now, so a
+    delete by someone else since this session loaded can't redirect the
+    patch; `idx` then only names it in errors. Raises RecordVersionConflict
+    if `expected_version` no longer matches, IndexError if the record is gone.
+    Returns the record's new version (waits for the group commit).
+
+    On the JSON store the commit still rewrites the whole requests.json (one
+    atomic replace); only the touched comment thread file is rewritten.
+    """
+    settle_pending_writes(wait=False)
+    fields = json.loads(json.dumps(fields))
+    comments = json.loads(json.dumps(list(comments or [])))
+
+    def _job(requests, all_comments):
+        pos = record_positions(requests).get(record_id, -1) if record_id else idx
+        if not 0 <= pos < len(requests):
+            raise IndexError(f"request #{idx} does not exist (deleted by someone else?)")
+        record = requests[pos]
+        version = record_version(record)
+        if expected_version is not None and version != expected_version:
+            raise RecordVersionConflict(pos, expected_version, record)
+        changed = {k: v for k, v in fields.items() if k not in record or record[k] != v}
+        events = []
+        if changed:
+            version += 1
+            changed["_version"] = version
+            record.update(changed)
+            events.append({"op": "update_request", "idx": pos, "set": changed})
+        if comments:
+            all_comments.setdefault(str(pos), []).extend(comments)
+            events.append({"op": "append_comments", "key": str(pos), "comments": comments})
+        return events, (version, pos)
+
+    result = submit_write(_job, st.session_state.get("user_name", "")).result()
+    _adopt_commit(result)
+    version, pos = result["value"]
+    if pos != idx and st.session_state.get("selected_request") == idx:
+        st.session_state.selected_request = pos  # the open detail page follows the record
     try:
         export_snapshot_to_disk()
     except Exception as e:
         st.warning(f"Auto-export failed: {e}")
+    return version
 
 
 def add_request(data):
     idx = len(st.session_state.requests)
-    st.session_state.requests.append(data)
+    st.session_state.requests.append({**data, "_id": new_record_id()})
     st.session_state.comments[str(idx)] = []
     save_data()
 
 
-def add_comment(index, author, text="", attachment=None):
+def add_comment(index, author, text="", attachment=None, attachment_sha=None):
     key = str(index)
+    load_thread(index)
     if key not in st.session_state.comments:
         st.session_state.comments[key] = []
     comment_entry = {
@@ -437,23 +3398,48 @@ def add_comment(index, author, text="", attachment=None):
     }
     if attachment:
         comment_entry["attachment"] = attachment
+    if attachment_sha:
+        comment_entry["attachment_sha"] = attachment_sha
+        queue_preview(attachment_sha, attachment)
+        if st.session_state.requests[index].get("Type") == "💲":
+            queue_invoice_text(attachment_sha, attachment)
     st.session_state.comments[key].append(comment_entry)
     save_data()
 
 
 def delete_request(index):
     if 0 <= index < len(st.session_state.requests):
-        st.session_state.requests.pop(index)
-        st.session_state.comments.pop(str(index), None)
-        # Re-index
-        st.session_state.comments = {str(i): st.session_state.comments.get(str(i), [])
-                                     for i in range(len(st.session_state.requests))}
-        save_data()
+        # Remove + re-index the threads this session holds (the store does the rest)
+        apply_event(st.session_state.requests, st.session_state.comments, {"op": "delete_request", "idx": index})
+        save_data(events=[{"op": "delete_request", "idx": index}])
         st.success("🗑️ Request deleted successfully.")
         st.session_state.page = "requests"
         st.rerun()
 
 
+def follow_pinned_record(form_prefix, widget_key):
+    """
+    Positions shift when someone else deletes a record. While a detail page
+    is open on its pinned record (widget `widget_key` alive, form pinned
+    under `form_prefix` + index), move selected_request and the pin to where
+    the record's _id is stored now. Returns False if the record is gone.
+    """
+    index = st.session_state.selected_request
+    pinned = st.session_state.get(f"{form_prefix}{index}")
+    if widget_key not in st.session_state or not pinned or not pinned.get("_id"):
+        return True
+    requests = st.session_state.requests
+    if index < len(requests) and requests[index].get("_id") == pinned["_id"]:
+        return True
+    pos = record_positions(requests).get(pinned["_id"])
+    st.session_state.pop(f"{form_prefix}{index}")
+    if pos is None:
+        return False
+    st.session_state[f"{form_prefix}{pos}"] = pinned
+    st.session_state.selected_request = pos
+    return True
+
+
 def go_to(page):
     st.session_state.page = page
     st.rerun()
@@ -492,16 +3478,20 @@ if not st.session_state.authenticated:
 
 
 # ─────────────────────────────────────────────────────────────────────
-# SNAPSHOT GUARD: force users to download the live JSON every N seconds
+# SNAPSHOT GUARD: force users to download the live snapshot every N seconds
 # ─────────────────────────────────────────────────────────────────────
-def require_snapshot_download(every_seconds: int = 12600, file_basename: str = "HelpCenter_Snapshot.json"):
+def require_snapshot_download(every_seconds: int = 12600, file_basename: str = "HelpCenter_Snapshot.json.gz"):
     """
-    Blocks with a modal until the user 1) downloads the JSON and 2) confirms.
-    Pops back up every `every_seconds`.
+    Blocks with a modal until the user 1) downloads the snapshot (.json.gz) and 2) confirms.
+    Pops back up every `every_seconds`. The download is the pre-built backup
+    from the server-side scheduler, so the 1s dialog tick never re-exports.
     """
-    # state
+    user = st.session_state.user_name
+
+    # state (a backup this user already took from another session counts)
     if "snapshot_ack_ts" not in st.session_state:
-        st.session_state.snapshot_ack_ts = None
+        last_dl = last_user_backup(user)
+        st.session_state.snapshot_ack_ts = last_dl.timestamp() if last_dl else None
     if "snapshot_dl_clicked" not in st.session_state:
         st.session_state.snapshot_dl_clicked = False
 
@@ -510,16 +3500,6 @@ def require_snapshot_download(every_seconds: int = 12600, file_basename: str = "
     if last is not None and (now - last) < every_seconds:
         return
 
-    # live snapshot
-    snap = {
-        "requests": st.session_state.get("requests", []),
-        "comments": st.session_state.get("comments", {})
-    }
-    try:
-        export_snapshot_to_disk()
-    except Exception as e:
-        st.warning(f"Auto-export failed: {e}")
-
     @st.dialog("⚠️ Download required", width="large")
     def _guard():
         st.markdown("""
@@ -530,21 +3510,25 @@ def require_snapshot_download(every_seconds: int = 12600, file_basename: str = "
         """, unsafe_allow_html=True)
 
         #st.markdown("### 🔐 Please download the current snapshot")
-        st.write("To keep your data safe, download the live JSON. This prompt will reappear every **3 hours 30 minutes**.")
+        st.write("To keep your data safe, download the live snapshot (gzip-compressed JSON, restorable as is). "
+                 "This prompt will reappear every **3 hours 30 minutes**.")
+
+        payload, built_at = latest_backup_payload()
 
         # ⬇️ BOTH BUTTONS ON THE SAME LINE
         left, right = st.columns([1, 1])
         with left:
             dl = st.download_button(
-                "⬇️ Download live snapshot (JSON)",
-                data=json.dumps(snap, ensure_ascii=False, indent=2),
+                "⬇️ Download live snapshot (.json.gz)",
+                data=payload,
                 file_name=file_basename,
-                mime="application/json",
+                mime="application/gzip",
                 key="force_snapshot_dl_btn",
                 use_container_width=True
             )
             if dl:
                 st.session_state.snapshot_dl_clicked = True
+                record_user_backup(user)
 
         with right:
             cont = st.button(
@@ -558,12 +3542,74 @@ def require_snapshot_download(every_seconds: int = 12600, file_basename: str = "
                 st.session_state.snapshot_dl_clicked = False
                 st.rerun()
 
-        #st.caption("After confirming, the next reminder is in 2 minutes.")
+        st.caption(f"Server backup built at {built_at:%Y-%m-%d %H:%M:%S} (compressed, restorable from Home → Backup & Restore).")
         _ = st_autorefresh(interval=1000, limit=None, key="snapshot_guard_tick")
 
     _guard()
     st.stop()
 
+def render_merge_prompt():
+    """
+    If a write of this session lost a compare-and-swap (see rebase_events /
+    patch_request), ask field by field what to keep instead of reloading.
+    """
+    pending = st.session_state.get("merge_conflicts")
+    if not pending:
+        return
+    idx = next(iter(pending))
+    conflict = pending[idx]
+
+    def _fmt(v):
+        return "—" if v is None else json.dumps(v, ensure_ascii=False) if isinstance(v, (list, dict)) else str(v)
+
+    @st.dialog("🔀 Someone else changed this record", width="large")
+    def _merge():
+        theirs, base = conflict["theirs"], conflict["base"]
+        label = theirs.get("Order#") or theirs.get("Invoice") or theirs.get("Type", "")
+        st.write(f"Request **#{idx}** {label} was saved by someone else after you opened it "
+                 f"(now version {record_version(theirs)}). Choose what to keep for each field you changed.")
+        keep = {}
+        for field, mine in conflict["fields"].items():
+            now = theirs.get(field)
+            if mine == now:
+                continue
+            if now == base.get(field):  # only you changed it
+                keep[field] = mine
+                st.markdown(f"**{field}**: {_fmt(now)} → {_fmt(mine)} *(only you changed this)*")
+                continue
+            pick = st.radio(f"**{field}**", ["Keep mine", "Keep theirs"], horizontal=True,
+                            key=f"merge_{idx}_{field}")
+            st.caption(f"was: {_fmt(base.get(field))} · mine: {_fmt(mine)} · theirs: {_fmt(now)}")
+            if pick == "Keep mine":
+                keep[field] = mine
+
+        apply_col, drop_col = st.columns(2)
+        if apply_col.button("✅ Apply merge", use_container_width=True, key="merge_apply_btn"):
+            stamps = []
+            if "Status" in keep and keep["Status"] != theirs.get("Status"):
+                stamps = [{**s, "status_change": {"old": theirs.get("Status", " "), "new": keep["Status"]}}
+                          for s in conflict.get("stamps", []) if "status_change" in s]
+            try:
+                patch_request(idx, keep, expected_version=record_version(theirs), comments=stamps,
+                              record_id=theirs.get("_id"))
+                pending.pop(idx, None)
+            except RecordVersionConflict as e:  # changed yet again: merge against the newest
+                conflict["base"], conflict["theirs"] = theirs, e.current
+            except IndexError:
+                pending.pop(idx, None)
+            if idx not in pending:  # detail forms re-pin to the merged record
+                st.session_state.pop(f"_detail_form_{idx}", None)
+                st.session_state.pop(f"_req_detail_form_{idx}", None)
+            st.rerun()
+        if drop_col.button("↩️ Discard my changes", use_container_width=True, key="merge_discard_btn"):
+            pending.pop(idx, None)
+            st.session_state.pop(f"_detail_form_{idx}", None)
+            st.session_state.pop(f"_req_detail_form_{idx}", None)
+            st.rerun()
+
+    _merge()
+
+
 # ---------- GLOBAL SNAPSHOT GUARD (all pages except login) ----------
 # Put this right AFTER the login block (the login block calls st.stop() if not auth)
 if st.session_state.authenticated:
@@ -572,6 +3618,8 @@ if st.session_state.authenticated:
         _ = st_autorefresh(interval=10_000, limit=None, key=f"guard_heartbeat_{st.session_state.page}")
     # show the overlay everywhere (except login) every 2 minutes
     require_snapshot_download(every_seconds=12600)
+    # concurrent-edit merge prompt (only when a save lost a compare-and-swap)
+    render_merge_prompt()
 
 
 # ─────────────────────────────────────────────────────────────────────
@@ -621,8 +3669,8 @@ if st.session_state.page == "home":
     st.markdown(f"Logged in as: **{st.session_state.user_name}**")
     st.markdown("<hr style='margin: 1rem 0;'>", unsafe_allow_html=True)
 
-    # ── Three buttons on Home ────────────────────────────────
-    col1, col2, col3 = st.columns(3)
+    # ── Buttons on Home ──────────────────────────────────────
+    col1, col2, col3, col4 = st.columns(4)
 
     # — Requerimientos Clientes (locked for Bodega) —
     with col1:
@@ -650,40 +3698,208 @@ if st.session_state.page == "home":
             st.button("🔒 Summary", disabled=True, use_container_width=True, key="home_summary_locked")
             st.caption("You don’t have access to this page.")
 
+    # — Comment search (open to everyone; Bodega only sees order threads) —
+    with col4:
+        if st.button("🔎 Search Comments", use_container_width=True, key="home_comment_search"):
+            st.session_state.page = "comment_search"
+            st.rerun()
+
     # --- Backup & Restore (manual) ---
     with st.expander("Backup & Restore"):
         st.caption(f"Export folder: {EXPORT_DIR}")
 
-        # Download current snapshot (in-memory)
-        snap = {
-            "requests": st.session_state.get("requests", []),
-            "comments": st.session_state.get("comments", {})
-        }
-        st.download_button(
-            "⬇️ Download snapshot (JSON)",
-            data=json.dumps(snap, ensure_ascii=False, indent=2),
-            file_name="HelpCenter_Snapshot.json",
-            mime="application/json",
-            key="backup_dl_btn"
-        )
+        # Download current snapshot (the stored state, built on request once per store version)
+        def _build_snapshot():
+            with primary_lock(shared=True):
+                requests, comments = _read_primary_files()
+            buf = io.BytesIO()
+            write_snapshot_stream(buf, requests, comments, indent=SNAPSHOT_JSON_INDENT)
+            return buf.getvalue()
+
+        lazy_download_button("💾 Prepare snapshot (JSON)", "home_snapshot", (_primary_signature(),), _build_snapshot,
+                             "HelpCenter_Snapshot.json", "application/json", "backup_dl_btn")
 
         # Upload + restore
         uploaded = st.file_uploader(
             "Restore from snapshot JSON",
-            type=["json"],
+            type=["json", "gz"],
             key="restore_uploader"
         )
-        if uploaded and st.button("Restore now", key="restore_now_btn"):
+        restore_mode = st.radio(
+            "Restore mode",
+            ["Replace everything", "Merge (apply only differences)"],
+            horizontal=True,
+            key="restore_mode",
+        )
+        merge_mode = restore_mode.startswith("Merge")
+        if uploaded and merge_mode:
+            token = (uploaded.name, getattr(uploaded, "size", 0), st.session_state.get("data_version"))
+            if st.button("Compare with live data", key="restore_diff_btn"):
+                try:
+                    with st.spinner("Comparing snapshot…"):
+                        diff = diff_snapshot_upload(uploaded)
+                    st.session_state.restore_diff = {"token": token, "diff": diff}
+                except Exception as e:
+                    st.session_state.pop("restore_diff", None)
+                    st.error(f"Compare failed: {e}")
+            pending = st.session_state.get("restore_diff")
+            if pending and pending["token"] != token:
+                st.session_state.pop("restore_diff", None)
+                pending = None
+                st.info("Live data or upload changed since the comparison — compare again.")
+            if pending:
+                diff = pending["diff"]
+                c1, c2, c3 = st.columns(3)
+                c1.metric("Added", f"{len(diff['added'])} req · {len(diff['threads_added'])} threads")
+                c2.metric("Changed", f"{len(diff['changed'])} req · {len(diff['threads_changed'])} threads")
+                c3.metric("Removed", f"{len(diff['removed'])} req · {len(diff['threads_removed'])} threads")
+                for label, ids in (("Added requests", diff["added"]), ("Changed requests", diff["changed"]), ("Removed requests", diff["removed"])):
+                    if ids:
+                        st.caption(f"{label}: " + ", ".join(f"#{i}" for i in ids[:50]) + (" …" if len(ids) > 50 else ""))
+                removals = st.checkbox(
+                    "Also remove records missing from the snapshot",
+                    value=False,
+                    key="restore_merge_removals",
+                )
+                n_changes = diff_change_count(diff, removals)
+                if n_changes == 0:
+                    st.success("Live data already matches the snapshot — nothing to apply.")
+                elif st.button(f"Apply {n_changes} change(s)", key="restore_merge_apply"):
+                    try:
+                        applied = apply_snapshot_diff(diff, removals)
+                    except SnapshotDiffStale as e:
+                        st.session_state.pop("restore_diff", None)
+                        st.warning(f"Nothing was applied: {e}.")
+                    else:
+                        st.session_state.pop("restore_diff", None)
+                        st.success(f"Merged {applied} change(s) from uploaded snapshot ✅")
+                        st.rerun()
+        if uploaded and not merge_mode and st.button("Restore now", key="restore_now_btn"):
+            bar = st.progress(0.0, text="Restoring…")
             try:
-                data = json.load(uploaded)
-                st.session_state.requests = data.get("requests", [])
-                st.session_state.comments = data.get("comments", {})
-                save_data()
-                st.success("Restored from uploaded snapshot ✅")
+                n_req, n_threads = restore_snapshot_upload(
+                    uploaded,
+                    on_progress=lambda frac, r, c: bar.progress(frac, text=f"Restoring… {r} requests · {c} comment threads"),
+                )
+                load_data()
+                try:
+                    export_snapshot_to_disk()
+                except Exception as e:
+                    st.warning(f"Auto-export failed: {e}")
+                st.success(f"Restored {n_req} requests and {n_threads} comment threads from uploaded snapshot ✅")
                 st.rerun()
             except Exception as e:
+                bar.empty()
                 st.error(f"Restore failed: {e}")
 
+        # Point-in-time restore from the rotated history
+        points = list_restore_points()
+        if points:
+            by_file = {p["file"]: p for p in points}
+
+            def _point_label(name):
+                p = by_file[name]
+                kind = "full" if p["kind"] == "base" else f"Δ {p['changed']}" if "changed" in p else "Δ"
+                detail = f" · {p['requests']} requests · {p['comments']} comments" if "requests" in p else ""
+                return f"#{p['seq']} {p['ts'].replace('T', ' ')} ({kind}){detail} · {p['bytes'] / 1024:.1f} KB"
+
+            choice = st.selectbox("Restore a point in time", list(by_file), format_func=_point_label,
+                                  key="restore_point_select")
+            if st.button("Restore selected point", key="restore_point_btn"):
+                if try_restore_from_snapshot(point=choice):
+                    st.success("Restored from history ✅")
+                    st.rerun()
+        backup = _backup_state()
+        mine = last_user_backup(st.session_state.user_name)
+        st.caption(
+            f"Server backup: {backup['last_backup']:%H:%M:%S} ({backup['bytes'] / 1024:.0f} KB compressed)"
+            if backup["last_backup"] else "Server backup: pending"
+        )
+        st.caption(f"Your last downloaded backup: {mine:%Y-%m-%d %H:%M}" if mine else "You have not downloaded a backup yet.")
+        if backup["error"]:
+            st.caption(f"⚠️ Backup scheduler: {backup['error']}")
+        cs = export_cache_stats()
+        st.caption(f"Export cache: {cs['hit_rate']:.0%} hits ({cs['hits']}/{cs['hits'] + cs['misses']}) · "
+                   f"{cs['entries']} artifacts · {cs['bytes'] / 1024:.0f} KB")
+        if STORE_BACKEND == "sqlite":
+            st.caption(f"Store: shared SQLite ({STORE_DB_FILE}) · change #{store_change_counter()}")
+        for label, (n, ms) in sorted(tick_stats().items()):
+            st.caption(f"{label}: {ms:.0f} ms median over {n} runs")
+        gc = _group_commit_state()
+        if gc["batches"]:
+            st.caption(f"Writer: {gc['jobs']} saves in {gc['batches']} group commits")
+        log = event_log_status()
+        st.caption(f"Change log: seq {log['seq']} · last checkpoint "
+                   f"{'#' + str(log['checkpoint']) if log['checkpoint'] is not None else 'none'} · "
+                   f"{log['bytes'] / 1024:.0f} KB")
+        hist = _history_state()
+        if hist["error"]:
+            st.caption(f"⚠️ History pruner: {hist['error']}")
+        elif hist["last_prune"]:
+            st.caption(f"{len(points)} restore points · last pruned {hist['last_prune']:%H:%M} "
+                       f"({hist['removed']} removed since start)")
+        tables = _export_tables_state()
+        if tables["error"]:
+            st.caption(f"⚠️ CSV/Excel/Parquet export: {tables['error']}")
+        elif tables["last_run"]:
+            st.caption(f"CSV/Excel/Parquet exports refreshed {datetime.fromtimestamp(tables['last_run']):%H:%M} "
+                       f"(at most every {EXPORT_TABLES_EVERY // 60} min)")
+        if tables["parquet_skipped"]:
+            left_out = ", ".join(f"#{s['index']} ({s['type']!r})" for s in tables["parquet_skipped"][:5])
+            st.caption(f"⚠️ Parquet tables leave out {len(tables['parquet_skipped'])} request(s) of an unknown "
+                       f"Type ({left_out}); restores use the other snapshots meanwhile.")
+
+        # Attachment storage (admins): usage report + orphan collector
+        if st.session_state.user_name in SUMMARY_ALLOWED:
+            gc_state = _attachment_gc_state()
+            if gc_state["error"]:
+                st.caption(f"⚠️ Attachment collector: {gc_state['error']}")
+            elif gc_state["last_run"]:
+                last = gc_state["last_result"]
+                st.caption(f"Attachment collector: last run {gc_state['last_run']:%H:%M} · "
+                           f"{last['quarantined']} quarantined · {last['deleted']} deleted "
+                           f"({last['freed'] / 1024:.0f} KB freed)")
+            c1, c2 = st.columns(2)
+            if c1.button("📦 Attachment storage report", key="attachment_report_btn"):
+                st.session_state.attachment_report = attachment_storage_report()
+            if c2.button("🧹 Collect orphaned attachments", key="attachment_gc_btn"):
+                done = collect_orphan_attachments()
+                gc_state["last_result"], gc_state["last_run"] = done, datetime.now()
+                st.success(f"Quarantined {done['quarantined']}, restored {done['restored']}, "
+                           f"deleted {done['deleted']} ({done['freed'] / 1024:.0f} KB freed).")
+                st.session_state.attachment_report = attachment_storage_report()
+            report = st.session_state.get("attachment_report")
+            if report:
+                def _size(n):
+                    return f"{n / 1048576:.1f} MB" if abs(n) >= 1048576 else f"{n / 1024:.0f} KB"
+
+                m1, m2, m3, m4 = st.columns(4)
+                m1.metric("Stored", _size(report["bytes"]), f"{report['files']} files", delta_color="off")
+                m2.metric("Referenced", _size(report["referenced_bytes"]),
+                          f"{_size(report['referenced_bytes'] - report['bytes'] + report['orphan_bytes'])} deduplicated", delta_color="off")
+                m3.metric("Orphans", _size(report["orphan_bytes"]), f"{report['orphans']} files", delta_color="off")
+                m4.metric("Quarantine", _size(report["quarantined_bytes"]),
+                          f"{report['quarantined']} files", delta_color="off")
+                reqs = st.session_state.get("requests", [])
+
+                def _ref(i):
+                    r = reqs[i] if 0 <= i < len(reqs) else {}
+                    return f"{r.get('Type', '')} {r.get('Order#') or r.get('Invoice') or ''}".strip()
+
+                if report["per_request"]:
+                    st.caption("Bytes per request")
+                    st.dataframe(pd.DataFrame([{**r, "ref": _ref(r["request"]), "size": _size(r["bytes"])}
+                                               for r in report["per_request"]])[["request", "ref", "files", "size"]],
+                                 hide_index=True, use_container_width=True)
+                if report["largest"]:
+                    st.caption("Largest files")
+                    st.dataframe(pd.DataFrame([{"file": r["file"][:12], "names": ", ".join(r["names"]) or "(orphan)",
+                                                "requests": ", ".join(f"#{i}" for i in r["requests"]),
+                                                "size": _size(r["bytes"])} for r in report["largest"]]),
+                                 hide_index=True, use_container_width=True)
+                if report["missing"]:
+                    st.caption(f"⚠️ {len(report['missing'])} referenced file(s) missing from uploads/")
+
 
 #####
 
@@ -842,6 +4058,67 @@ elif st.session_state.page == "summary":
 
     st.button("⬅ Back to Home", on_click=lambda: go_to("home"))
 
+# ──────────────────────────────────────────────────────────────────────
+# ---------------- COMMENT SEARCH PAGE ---------------------------------
+# ──────────────────────────────────────────────────────────────────────
+elif st.session_state.page == "comment_search":
+    st.markdown("# 🔎 Search Comments")
+    st.markdown("---")
+    refresh_on_change("request")
+    user = st.session_state.user_name
+    requests_all = st.session_state.requests
+
+    c_q, c_a, c_from, c_to = st.columns([3, 1.2, 1, 1])
+    query = c_q.text_input("Search", key="csearch_q", placeholder="Words in comments, authors, file names or invoices…")
+    who = c_a.selectbox("Author", ["All"] + comment_search_authors(), key="csearch_author")
+    d_from = c_from.date_input("From", value=None, key="csearch_from")
+    d_to = c_to.date_input("To", value=None, key="csearch_to")
+
+    def _highlight(text, words):
+        """Escaped `text` (first 300 chars) with words starting like a query word marked."""
+        out = []
+        for part in re.split(r"([^\W_]+)", text[:300]):
+            hit = part and any(w and next(iter(search_tokens(part)), "").startswith(w) for w in words)
+            out.append(f"<mark>{html_escape(part)}</mark>" if hit else html_escape(part))
+        return "".join(out) + ("…" if len(text) > 300 else "")
+
+    if query.strip() or who != "All" or d_from or d_to:
+        # Bodega doesn't see Requerimientos Clientes, so not their threads either
+        keys = None
+        if user in REQS_DENIED:
+            keys = {str(i) for i, r in enumerate(requests_all) if r.get("Type") != "📑"}
+        t0 = time.perf_counter()
+        hits, total = search_comments(query, author=None if who == "All" else who,
+                                      date_from=str(d_from) if d_from else None,
+                                      date_to=str(d_to) if d_to else None, keys=keys)
+        took = (time.perf_counter() - t0) * 1000
+        st.caption(f"{total} matching comments in {took:.0f} ms"
+                   + (f" · showing the newest {len(hits)}" if total > len(hits) else ""))
+        words = search_tokens(query)
+        for n, hit in enumerate(hits):
+            i = int(hit["key"]) if hit["key"].isdigit() else -1
+            req = requests_all[i] if 0 <= i < len(requests_all) else {}
+            ref = req.get("Order#") or req.get("Invoice") or ""
+            cols = st.columns([1.3, 1.2, 5, 0.8])
+            cols[0].write(f"{req.get('Type', '')} #{i} {ref}")
+            cols[1].write(f"{hit['author']} · {hit['when']}")
+            body = _highlight(hit["text"], words)
+            if hit["attachment"]:
+                body += f" 📎 {_highlight(hit['attachment'], words)}"
+            if hit["invoice"]:  # extracted from the PDF: say what was found in it
+                found = [f"invoice {n}" for n in hit["invoice"]["numbers"][:2]] + \
+                        [f"total {t}" for t in hit["invoice"]["totals"][-1:]]
+                body += " · 🧾 " + html_escape(", ".join(found) or "invoice text")
+            cols[2].markdown(body or "—", unsafe_allow_html=True)
+            if req and cols[3].button("Open", key=f"csearch_open_{n}"):
+                st.session_state.selected_request = i
+                go_to("req_detail" if req.get("Type") == "📑" else "detail")
+    else:
+        st.info("Type a word to search all comment threads, or pick an author or dates.")
+
+    if st.button("⬅ Back to Home", key="csearch_back"):
+        go_to("home")
+
 # ──────────────────────────────────────────────────────────────────────
 # ---------------- ALL PURCHASE/SALES ORDERS PAGE ----------------------
 # ──────────────────────────────────────────────────────────────────────
@@ -1016,10 +4293,6 @@ if st.session_state.page == "requests":
                         "Encargado": encargado_po,
                         "Pago": pago
                     })
-                    try:
-                        export_snapshot_to_disk()
-                    except Exception as e:
-                        st.warning(f"Auto-export failed: {e}")
 
                     st.success("✅ Purchase request submitted.")
                     st.session_state.purchase_item_rows = 1
@@ -1116,10 +4389,6 @@ if st.session_state.page == "requests":
                         "Encargado": encargado_so,
                         "Pago": pago_so
                     })
-                    try:
-                        export_snapshot_to_disk()
-                    except Exception as e:
-                        st.warning(f"Auto-export failed: {e}")
 
                     st.success("✅ Sales order submitted.")
                     st.session_state.invoice_item_rows = 1
@@ -1134,7 +4403,7 @@ if st.session_state.page == "requests":
     st.markdown("# 📋 All Purchase/Sales Orders")
     st.markdown("---")
     _ = st_autorefresh(interval=10000, limit=None, key="requests_refresh")
-    load_data()
+    refresh_on_change("request", "comments")
 
     # Create/refresh snapshot on page open; show path + quick download
     try:
@@ -1176,13 +4445,19 @@ if st.session_state.page == "requests":
             return True
         return r.get("Type") == type_filter.split()[0]  # "💲" or "🛒"
 
+    # Orders whose attached PDF invoices mention the search words also match
+    invoice_keys = search_invoice_threads(search_term) if search_term.strip() else set()
+
     filtered_requests = [
         (i, r) for (i, r) in base_requests
         if r.get("Type") in {"💲","🛒"}
-        and (search_term.lower() in json.dumps(r).lower())
+        and (search_term.lower() in json.dumps(r).lower() or str(i) in invoice_keys)
         and _matches_status(r)
         and _matches_type(r)
     ]
+    by_invoice = sum(1 for i, r in filtered_requests if str(i) in invoice_keys and search_term.lower() not in json.dumps(r).lower())
+    if by_invoice:
+        st.caption(f"🧾 {by_invoice} order(s) matched by the text of their attached invoices")
 
     # ─── SORT: READY first, then by ETA (today first), then others by our STATUS_ORDER and ETA ───
     today = date.today()
@@ -1230,38 +4505,37 @@ if st.session_state.page == "requests":
                     out.append(str(x))
             return ", ".join(out)
 
-        rows = []
-        for _, r in filtered_requests:
-            is_po = (r.get("Type") == "💲")
-            row = {
-                "Type": r.get("Type",""),
-                "Ref#": r.get("Invoice","") if is_po else r.get("Order#",""),
-                "Description": _join(r.get("Description", [])),
-                "Qty": _join(r.get("Quantity", [])),
-                # export normalized status so CSV filters work cleanly
-                "Status": normalize_status(r.get("Status","")),
-                "Ordered Date": r.get("Date",""),
-                "ETA Date": r.get("ETA Date",""),
-                "Shipping Method": r.get("Shipping Method",""),
-                "Encargado": r.get("Encargado",""),
-                "Partner": r.get("Proveedor","") if is_po else r.get("Cliente",""),
-                "Pago": r.get("Pago",""),
-            }
-            if include_prices:
-                if is_po:
-                    row["Cost"] = _fmt_money_list(r.get("Cost", []))
-                else:
-                    row["Sale Price"] = _fmt_money_list(r.get("Sale Price", []))
-            rows.append(row)
-
-        df_export = pd.DataFrame(rows)
-        st.download_button(
-            "📥 Export Filtered Requests to CSV",
-            df_export.to_csv(index=False).encode("utf-8"),
-            "requests_export.csv",
-            "text/csv",
-            use_container_width=True
-        )
+        def _build_csv():
+            rows = []
+            for _, r in filtered_requests:
+                is_po = (r.get("Type") == "💲")
+                row = {
+                    "Type": r.get("Type",""),
+                    "Ref#": r.get("Invoice","") if is_po else r.get("Order#",""),
+                    "Description": _join(r.get("Description", [])),
+                    "Qty": _join(r.get("Quantity", [])),
+                    # export normalized status so CSV filters work cleanly
+                    "Status": normalize_status(r.get("Status","")),
+                    "Ordered Date": r.get("Date",""),
+                    "ETA Date": r.get("ETA Date",""),
+                    "Shipping Method": r.get("Shipping Method",""),
+                    "Encargado": r.get("Encargado",""),
+                    "Partner": r.get("Proveedor","") if is_po else r.get("Cliente",""),
+                    "Pago": r.get("Pago",""),
+                }
+                if include_prices:
+                    if is_po:
+                        row["Cost"] = _fmt_money_list(r.get("Cost", []))
+                    else:
+                        row["Sale Price"] = _fmt_money_list(r.get("Sale Price", []))
+                rows.append(row)
+            return pd.DataFrame(rows).to_csv(index=False).encode("utf-8")
+
+        # Built on request, once per (data version, rows shown, price permission) and shared
+        # across sessions; the rows cover every filter, invoice-text matches included
+        csv_key = (st.session_state.get("data_version"), tuple(i for i, _ in filtered_requests), include_prices)
+        lazy_download_button("📥 Export Filtered Requests to CSV", "orders_csv", csv_key, _build_csv,
+                             "requests_export.csv", "text/csv", "orders_csv_dl", use_container_width=True)
 
     with col_po:
         if user in PURCHASE_CREATORS:
@@ -1304,14 +4578,12 @@ if st.session_state.page == "requests":
                 c.markdown(f"<div class='header-row'>{h}</div>", unsafe_allow_html=True)
 
             today_local = date.today()
+            unread = unread_counts(user)
 
             for global_idx, req in pairs_list:
                 cols = st.columns(widths)
 
-                comments_list = st.session_state.comments.get(str(global_idx), [])
-                for c in comments_list:
-                    c.setdefault("read_by", [])
-                unread_cnt = sum(1 for c in comments_list if user not in c["read_by"] and c.get("author") != user)
+                unread_cnt = unread.get(str(global_idx), 0)
                 cols[0].markdown(f"<span class='unread-badge'>💬{unread_cnt}</span>" if unread_cnt>0 else "", unsafe_allow_html=True)
 
                 cols[1].markdown(f"<span class='type-icon'>{req.get('Type','')}</span>", unsafe_allow_html=True)
@@ -1356,7 +4628,8 @@ if st.session_state.page == "requests":
                 with cols[action_idx]:
                     a1, a2 = st.columns([1,1])
                     if a1.button("🔍", key=f"view_{global_idx}"):
-                        for c in comments_list:
+                        for c in load_thread(global_idx):
+                            c.setdefault("read_by", [])
                             if c.get("author") != user and user not in c["read_by"]:
                                 c["read_by"].append(user)
                         save_data()
@@ -1364,11 +4637,6 @@ if st.session_state.page == "requests":
                         go_to("detail")
                     if a2.button("❌", key=f"delete_{global_idx}"):
                         delete_request(global_idx)
-                        try:
-                            export_snapshot_to_disk()
-                        except Exception as e:
-                            st.warning(f"Auto-export failed: {e}")
-                        st.rerun()
 
         if user == "Bodega":
             po_pairs = [(i, r) for (i, r) in filtered_requests if r.get("Type") == "💲"]
@@ -1394,6 +4662,7 @@ if st.session_state.page == "requests":
 # -------------------------------------------
 if st.session_state.page == "detail":
     import os, time, re
+    _page_t0 = time.perf_counter()
     import pandas as pd
     from datetime import date, datetime
 
@@ -1422,8 +4691,9 @@ if st.session_state.page == "detail":
 
     def _log_status_change(idx: int, old_status: str, new_status: str, who: str):
         """
-        Append a structured status-change event into the comments list.
-        Renderer below shows a centered colored bubble for this event.
+        Build a structured status-change event for the comments list
+        (persisted by patch_request). Renderer below shows a centered colored
+        bubble for this event.
         """
         entry = {
             "author": who,
@@ -1431,10 +4701,7 @@ if st.session_state.page == "detail":
             "text": "",
             "status_change": {"old": old_status, "new": new_status}
         }
-        key = str(idx)
-        comments = st.session_state.comments.setdefault(key, [])
-        comments.append(entry)
-        st.session_state.comments[key] = comments
+        return entry
 
     # ── Helpers ────────────────────────────────────────────────────
     def _submit_comment_value(idx: int, value: str) -> bool:
@@ -1460,11 +4727,9 @@ if st.session_state.page == "detail":
         last = guard.get(str(idx))  # {"name":..., "ts":...}
         if last and last.get("name") == uploaded_file.name and (now - last.get("ts", 0)) < 3.0:
             return False
-        ts = datetime.now().strftime("%Y%m%d%H%M%S")
-        fn = f"{idx}_{ts}_{uploaded_file.name}"
-        with open(os.path.join(UPLOADS_DIR, fn), "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        add_comment(idx, st.session_state.user_name, "", attachment=fn)
+        uploaded_file.seek(0)
+        sha, _ = store_attachment(uploaded_file)
+        add_comment(idx, st.session_state.user_name, "", attachment=uploaded_file.name, attachment_sha=sha)
         guard[str(idx)] = {"name": uploaded_file.name, "ts": now}
         st.session_state["detail_upload_guard"] = guard
         return True
@@ -1507,12 +4772,12 @@ if st.session_state.page == "detail":
         while len(prices) < L: prices.append("")
         return descs, qtys, prices
 
-    # ── Auto-refresh comments every second ──────────────────────────
-    _ = st_autorefresh(
-        interval=1000,
-        limit=None,
-        key=f"detail_comments_refresh_{st.session_state.selected_request}"
-    )
+    # ── Pick up changes on each run (the comments fragment polls on its own) ──
+    refresh_on_change("request", "comments", ids=[st.session_state.selected_request])
+    if not follow_pinned_record("_detail_form_", "detail_Status"):
+        st.warning("⚠️ This request was deleted by someone else.")
+        st.button("⬅ Back to All Requests", on_click=lambda: go_to("requests"))
+        st.stop()
 
     # ── Validate selection ─────────────────────────────────────────
     index = st.session_state.selected_request
@@ -1520,9 +4785,31 @@ if st.session_state.page == "detail":
         st.error("Invalid request selected.")
         st.stop()
 
-    request = st.session_state.requests[index]
+    # The form stays on the record as first rendered (its widgets keep their
+    # state across reloads), so saves compare-and-swap against that version.
+    form_key = f"_detail_form_{index}"
+    if "detail_Status" not in st.session_state or form_key not in st.session_state:
+        st.session_state[form_key] = json.loads(json.dumps(st.session_state.requests[index]))
+    request = st.session_state[form_key]
     updated_fields = {}
     is_purchase = (request.get("Type") == "💲")
+    loaded_version = record_version(request)
+
+    def _patch_and_rerun(fields, stamps=None, done_msg=None):
+        try:
+            patch_request(index, fields, expected_version=loaded_version, comments=stamps,
+                          record_id=request.get("_id"))
+        except RecordVersionConflict as e:
+            queue_merge_conflicts([{"idx": e.idx, "base": request, "theirs": e.current, "fields": fields}], stamps)
+            st.rerun()
+        except IndexError:
+            st.session_state.pop(form_key, None)
+            st.warning("⚠️ This request was deleted by someone else — your changes were not saved.")
+            st.stop()
+        st.session_state.pop(form_key, None)
+        if done_msg:
+            st.success(done_msg)
+        st.rerun()
     hide_prices = (st.session_state.user_name == "Bodega")
 
     # ─────────── SIDEBAR ───────────
@@ -1613,24 +4900,14 @@ if st.session_state.page == "detail":
                 descs.append("")
                 qtys.append("")
                 prices.append("" if not hide_prices else "")
-                request["Description"] = descs
-                request["Quantity"] = qtys
-                request[price_key] = prices
-                st.session_state.requests[index] = request
-                save_data()
-                st.rerun()
+                _patch_and_rerun({"Description": descs, "Quantity": qtys, price_key: prices})
 
         with c_rem:
             if st.button("❌ Remove last item", use_container_width=True, key=f"remove_item_{index}") and descs:
                 descs.pop()
                 if qtys:   qtys.pop()
                 if prices: prices.pop()
-                request["Description"] = descs
-                request["Quantity"] = qtys
-                request[price_key] = prices
-                st.session_state.requests[index] = request
-                save_data()
-                st.rerun()
+                _patch_and_rerun({"Description": descs, "Quantity": qtys, price_key: prices})
 
         # Collect changes (convert types when possible)
         if descs != request.get("Description", []):
@@ -1679,20 +4956,17 @@ if st.session_state.page == "detail":
 
         st.markdown("---")
         if updated_fields and st.button("💾 Save Changes", use_container_width=True):
-            # 1) Stamp status change BEFORE saving, if it changed
+            # 1) Stamp status change in the same write, if it changed
+            stamps = []
             if "Status" in updated_fields:
-                _log_status_change(
+                stamps.append(_log_status_change(
                     index,
                     request.get("Status", " "),
                     updated_fields["Status"],
                     st.session_state.user_name
-                )
-            # 2) Persist the record
-            request.update(updated_fields)
-            st.session_state.requests[index] = request
-            save_data()
-            st.success("✅ Changes saved.")
-            st.rerun()
+                ))
+            # 2) Persist only the changed fields
+            _patch_and_rerun(updated_fields, stamps, "✅ Changes saved.")
 
         if st.button("🗑️ Delete Request", use_container_width=True):
             delete_request(index)
@@ -1703,7 +4977,12 @@ if st.session_state.page == "detail":
     # ─────────── MAIN AREA: COMMENTS ───────────
     st.markdown("## 💬 Comments")
     col_l, col_center, col_r = st.columns([1, 6, 1])
-    with col_center:
+
+    # The chat refreshes on its own timer: new messages don't rerun the sidebar editor
+    @st.fragment(run_every=CHAT_REFRESH_SECONDS)
+    def _comments_panel():
+        tick_t0 = time.perf_counter()
+        refresh_on_change("comments", ids=[index])
         st.markdown("""
             <style>
                 .chat-author-in    { font-size:12px; color:#555; margin:4px 0 0 5px; clear:both; }
@@ -1719,64 +4998,7 @@ if st.session_state.page == "detail":
             </style>
         """, unsafe_allow_html=True)
 
-        existing_comments = st.session_state.comments.get(str(index), [])
-        authors = []
-        for c in existing_comments:
-            if c["author"] not in authors:
-                authors.append(c["author"])
-        base_colors = ["#D1E8FF", "#FFD1DC", "#DFFFD6", "#FFFACD", "#E0E0E0"]
-        color_map = {a: base_colors[i % len(base_colors)] for i, a in enumerate(authors)}
-
-        for comment in existing_comments:
-            # special render for status change
-            if "status_change" in comment:
-                old_s = comment["status_change"].get("old","")
-                new_s = comment["status_change"].get("new","")
-                who   = comment.get("author","")
-                when  = comment.get("when","")
-                bg    = _status_color(new_s)
-                st.markdown(
-                    f'<div class="status-change" style="background:{bg};">'
-                    f'{who} cambió estado: <b>{old_s}</b> → <b>{new_s}</b>'
-                    f'<div class="status-small">{when}</div>'
-                    f'</div>',
-                    unsafe_allow_html=True
-                )
-                continue
-
-            author = comment["author"]
-            text = comment.get("text", "")
-            when = comment.get("when", "")
-            attachment = comment.get("attachment", None)
-            align = "right" if author == st.session_state.user_name else "left"
-            cls = "out" if author == st.session_state.user_name else "in"
-
-            # author label
-            st.markdown(
-                f'<div class="chat-author-{cls}" style="text-align:{align};">{author}</div>',
-                unsafe_allow_html=True
-            )
-
-            if attachment:
-                file_path = os.path.join(UPLOADS_DIR, attachment)
-                st.markdown(
-                    f'<div class="chat-attachment" style="float:{align};">'
-                    f'📎 <a href="/{file_path}" class="attachment-link" download>{attachment}</a>'
-                    f'</div>'
-                    f'<div class="chat-timestamp" style="text-align:{align};">{when}</div>'
-                    f'<div class="clearfix"></div>',
-                    unsafe_allow_html=True
-                )
-
-            if text:
-                bg = color_map.get(author, "#EDEDED")
-                text_color = "#FFF" if cls == "out" else "#000"
-                st.markdown(
-                    f'<div class="chat-bubble" style="background:{bg}; color:{text_color}; float:{align};">{text}</div>'
-                    f'<div class="chat-timestamp" style="text-align:{align};">{when}</div>'
-                    f'<div class="clearfix"></div>',
-                    unsafe_allow_html=True
-                )
+        render_chat(index, st.session_state.user_name, _status_color, style="detail", out_text_color="#FFF")
 
         st.markdown("---")
 
@@ -1786,7 +5008,7 @@ if st.session_state.page == "detail":
             msg = st.text_input("Type your message here…", key=text_key, placeholder="Press Enter to send")
             sent = st.form_submit_button("Send")
             if sent and _submit_comment_value(index, msg):
-                st.rerun()
+                rerun_chat()
 
         uploaded_file = st.file_uploader(
             "Attach PDF, PNG or XLSX:",
@@ -1798,7 +5020,12 @@ if st.session_state.page == "detail":
             if st.button("Upload File", key=f"upload_file_{index}") and uploaded_file:
                 if _upload_attachment(index, uploaded_file):
                     st.success(f"Uploaded: {uploaded_file.name}")
-                    st.rerun()
+                    rerun_chat()
+        record_tick("detail chat (fragment tick)", tick_t0)
+
+    with col_center:
+        _comments_panel()
+    record_tick("detail page (full run)", _page_t0)
 
 
 ####
@@ -1894,10 +5121,7 @@ elif st.session_state.page == "req_list":
                         "Comprador Encargado": sel_c,
                         "Fecha": str(dt),
                         "Status": stt
-                    })
-                    new_idx = len(st.session_state.requests) - 1
-                    st.session_state.comments[str(new_idx)] = []
-                    save_data()
+                    })  # add_request() already creates the empty thread and saves
 
                     # Reset form state and close dialog on next run
                     st.session_state.req_item_count = 1
@@ -1915,7 +5139,7 @@ elif st.session_state.page == "req_list":
     st.markdown("<hr>", unsafe_allow_html=True)
     _ = st_autorefresh(interval=1000, limit=None, key="req_list_refresh")
 
-    load_data()
+    refresh_on_change("request", "comments")
 
     col1, col2 = st.columns([3,1])
     search_term   = col1.text_input("Search",    placeholder="Search requirements...")
@@ -1967,19 +5191,18 @@ elif st.session_state.page == "req_list":
                 "_req_obj":     r
             })
 
-    df_export = pd.DataFrame([
-        {k:v for k,v in row.items() if not k.startswith("_")}
-        for row in flat
-    ])
+    def _build_req_csv():
+        df_export = pd.DataFrame([
+            {k:v for k,v in row.items() if not k.startswith("_")}
+            for row in flat
+        ])
+        return df_export.to_csv(index=False).encode("utf-8")
 
     col_export, col_new, col_all = st.columns([3,1,1])
     with col_export:
-        st.download_button(
-            "📥 Export Filtered Requests to CSV",
-            df_export.to_csv(index=False).encode("utf-8"),
-            "req_requests.csv","text/csv",
-            use_container_width=True
-        )
+        lazy_download_button("📥 Export Filtered Requests to CSV", "req_csv",
+                             (st.session_state.get("data_version"), search_term, status_filter), _build_req_csv,
+                             "req_requests.csv", "text/csv", "req_csv_dl", use_container_width=True)
     with col_new:
         if st.button("➕ New Requirement", key="nav_new_req", use_container_width=True):
             st.session_state.show_new_req = True
@@ -2012,17 +5235,13 @@ elif st.session_state.page == "req_list":
             c.markdown(f"<div class='header-row'>{h}</div>", unsafe_allow_html=True)
 
         user = st.session_state.user_name
+        unread = unread_counts(user)
         for i, row in enumerate(flat):
             cols = st.columns([0.5,0.5,2,1,1,1,1,1.5,1,1])
             idx  = st.session_state.requests.index(row["_req_obj"])
 
-            # compute unread comment count
-            comments_list = st.session_state.comments.get(str(idx), [])
-            unread_cnt = sum(
-                1 for c in comments_list
-                  if c.get("author","") != user
-                     and user not in c.get("read_by", [])
-            )
+            # unread comment count (from the thread index, no comment bodies)
+            unread_cnt = unread.get(str(idx), 0)
             cols[0].markdown(
                 f"<span class='status-open'>💬{unread_cnt}</span>" if unread_cnt>0 else "",
                 unsafe_allow_html=True
@@ -2055,7 +5274,7 @@ elif st.session_state.page == "req_list":
             with cols[9]:
                 a1, a2 = st.columns([1,1])
                 if a1.button("🔍", key=f"view_{i}", use_container_width=True):
-                    for c in comments_list:
+                    for c in load_thread(idx):
                         if c.get("author","") != user:
                             c.setdefault("read_by", [])
                             if user not in c["read_by"]:
@@ -2080,6 +5299,7 @@ elif st.session_state.page == "req_list":
 
 elif st.session_state.page == "req_detail":
     import os, time
+    _page_t0 = time.perf_counter()
     import pandas as pd
     from datetime import date, datetime
     from streamlit_autorefresh import st_autorefresh
@@ -2101,8 +5321,9 @@ elif st.session_state.page == "req_detail":
 
     def _log_status_change(idx: int, old_status: str, new_status: str, who: str):
         """
-        Append a structured status-change event into the same comments list.
-        Renderer below shows a centered colored bubble for this event.
+        Build a structured status-change event for the same comments list
+        (persisted by patch_request). Renderer below shows a centered colored
+        bubble for this event.
         """
         entry = {
             "author": who,
@@ -2110,10 +5331,7 @@ elif st.session_state.page == "req_detail":
             "text": "",
             "status_change": { "old": old_status, "new": new_status }
         }
-        key = str(idx)
-        comments = st.session_state.comments.setdefault(key, [])
-        comments.append(entry)
-        st.session_state.comments[key] = comments
+        return entry
 
     # ─── Deduped submit helpers (avoid double posts during auto-refresh) ───
     def _submit_comment_value(idx: int, value: str) -> bool:
@@ -2155,25 +5373,28 @@ elif st.session_state.page == "req_detail":
         if last and last.get("name") == uploaded_file.name and (now - last.get("ts", 0)) < 3.0:
             return False
 
-        # Persist file
-        UPLOADS_DIR = "uploads"
-        os.makedirs(UPLOADS_DIR, exist_ok=True)
-        ts = datetime.now().strftime("%Y%m%d%H%M%S")
-        fn = f"{idx}_{ts}_{uploaded_file.name}"
-        with open(os.path.join(UPLOADS_DIR, fn), "wb") as f:
-            f.write(uploaded_file.getbuffer())
+        # Persist file (stored once per content, see store_attachment)
+        uploaded_file.seek(0)
+        sha, _ = store_attachment(uploaded_file)
 
-        add_comment(idx, st.session_state.user_name, "", attachment=fn)
+        add_comment(idx, st.session_state.user_name, "", attachment=uploaded_file.name, attachment_sha=sha)
         guard[str(idx)] = {"name": uploaded_file.name, "ts": now}
         st.session_state["upload_guard"] = guard
         return True
 
-    # ─── Auto‐refresh every second ─────────────────────────────────
-    _ = st_autorefresh(interval=1000, limit=None, key="requests_refresh")
-    load_data()
+    # ─── Pick up changes on each run (the comments fragment polls on its own) ──
+    refresh_on_change("request", "comments", ids=[st.session_state.selected_request])
+    if not follow_pinned_record("_req_detail_form_", "req_detail_status"):
+        st.warning("⚠️ This requirement was deleted by someone else.")
+        st.button("⬅ Back", on_click=lambda: go_to("req_list"))
+        st.stop()
 
     idx     = st.session_state.selected_request
-    request = st.session_state.requests[idx]
+    # Pin the form to the record as first rendered (see the detail page)
+    form_key = f"_req_detail_form_{idx}"
+    if "req_detail_status" not in st.session_state or form_key not in st.session_state:
+        st.session_state[form_key] = json.loads(json.dumps(st.session_state.requests[idx]))
+    request = st.session_state[form_key]
     updated = {}
 
     UPLOADS_DIR = "uploads"  # make sure this exists
@@ -2260,15 +5481,23 @@ elif st.session_state.page == "req_detail":
     cs, cd, cb = st.sidebar.columns(3, gap="small")
     with cs:
         if updated and st.button("💾 Save", key="req_detail_save", use_container_width=True):
-            # Log status change BEFORE saving the record
+            # Status change is stamped in the same write as the record
+            stamps = []
             if "Status" in updated and updated["Status"] != original_status:
-                _log_status_change(idx, original_status, updated["Status"], st.session_state.user_name)
-            if "Items" in updated:
-                st.session_state["items_count"] = len(updated["Items"])
-            request.update(updated)
-            st.session_state.requests[idx] = request
-            save_data()
-            st.sidebar.success("✅ Saved")
+                stamps.append(_log_status_change(idx, original_status, updated["Status"], st.session_state.user_name))
+            try:
+                patch_request(idx, updated, expected_version=record_version(request), comments=stamps,
+                              record_id=request.get("_id"))
+                st.session_state.pop(form_key, None)
+                if "Items" in updated:
+                    st.session_state["items_count"] = len(updated["Items"])
+                st.sidebar.success("✅ Saved")
+            except RecordVersionConflict as e:
+                queue_merge_conflicts([{"idx": e.idx, "base": request, "theirs": e.current, "fields": updated}], stamps)
+                st.rerun()
+            except IndexError:
+                st.session_state.pop(form_key, None)
+                st.sidebar.warning("⚠️ This request was deleted by someone else — your changes were not saved.")
     with cd:
         if st.button("🗑️ Delete", key="req_detail_delete", use_container_width=True):
             delete_request(idx)
@@ -2281,7 +5510,12 @@ elif st.session_state.page == "req_detail":
     # ─── MAIN AREA: COMMENTS (with status-change bubble) ───────────
     st.markdown("## 💬 Comments")
     col_l, col_center, col_r = st.columns([1, 6, 1])
-    with col_center:
+
+    # The chat refreshes on its own timer: new messages don't rerun the sidebar editor
+    @st.fragment(run_every=CHAT_REFRESH_SECONDS)
+    def _comments_panel():
+        tick_t0 = time.perf_counter()
+        refresh_on_change("comments", ids=[idx])
         st.markdown("""
         <style>
           .chat-author-in    { font-size:12px; color:#555; margin:4px 0 0 5px; clear:both; }
@@ -2296,58 +5530,7 @@ elif st.session_state.page == "req_detail":
         </style>
         """, unsafe_allow_html=True)
 
-        existing_comments = st.session_state.comments.get(str(idx), [])
-        authors = []
-        for c in existing_comments:
-            if c.get("author") and c["author"] not in authors:
-                authors.append(c["author"])
-        base_colors = ["#D1E8FF","#FFD1DC","#DFFFD6","#FFFACD","#E0E0E0"]
-        color_map = {a: base_colors[i % len(base_colors)] for i,a in enumerate(authors)}
-
-        for comment in existing_comments:
-            # Special render for status change
-            if "status_change" in comment:
-                old_s = comment["status_change"].get("old","")
-                new_s = comment["status_change"].get("new","")
-                who   = comment.get("author","")
-                when  = comment.get("when","")
-                bg    = _status_color(new_s)
-                html  = (
-                    f'<div class="status-change" style="background:{bg};">'
-                    f'{who} cambió estado: <b>{old_s}</b> → <b>{new_s}</b>'
-                    f'<div class="status-small">{when}</div>'
-                    f'</div>'
-                )
-                st.markdown(html, unsafe_allow_html=True)
-                continue
-
-            # Regular comment / attachment
-            author = comment["author"]
-            text = comment.get("text", "")
-            when = comment.get("when", "")
-            attachment = comment.get("attachment", None)
-            file_path = os.path.join(UPLOADS_DIR, attachment) if attachment else None
-            bg = color_map.get(author, "#EDEDED")
-            align = "right" if author == st.session_state.user_name else "left"
-            float_dir = align
-            cls = 'out' if author == st.session_state.user_name else 'in'
-            # author label
-            st.markdown(f'<div class="chat-author-{cls}" style="text-align:{align};">{author}</div>', unsafe_allow_html=True)
-            if attachment:
-                link_html = f'<a href="/{file_path}" class="attachment-link" download>{attachment}</a>'
-                st.markdown(
-                    f'<div class="chat-attachment" style="float:{float_dir};">📎 {link_html}</div>'
-                    f'<div class="chat-timestamp" style="text-align:{align};">{when}</div>'
-                    f'<div style="clear:both;"></div>',
-                    unsafe_allow_html=True
-                )
-            if text:
-                st.markdown(
-                    f'<div class="chat-bubble" style="background:{bg}; float:{float_dir};">{text}</div>'
-                    f'<div class="chat-timestamp" style="text-align:{align};">{when}</div>'
-                    f'<div style="clear:both;"></div>',
-                    unsafe_allow_html=True
-                )
+        render_chat(idx, st.session_state.user_name, _status_color, style="req_detail")
 
         st.markdown("---")
 
@@ -2357,7 +5540,7 @@ elif st.session_state.page == "req_detail":
             msg = st.text_input("Type your message here…", key=text_key, placeholder="Press Enter to send")
             sent = st.form_submit_button("Send")
             if sent and _submit_comment_value(idx, msg):
-                st.rerun()
+                rerun_chat()
 
         uploaded_file = st.file_uploader("Attach PDF, PNG or XLSX:", type=["pdf","png","xlsx"], key=f"fileuploader_{idx}")
         _, cu = st.columns([1,1])
@@ -2365,7 +5548,11 @@ elif st.session_state.page == "req_detail":
             if st.button("Upload File", key=f"upload_file_{idx}") and uploaded_file:
                 if _upload_attachment(idx, uploaded_file):
                     st.success(f"Uploaded: {uploaded_file.name}")
-                    st.rerun()
+                    rerun_chat()
+        record_tick("req_detail chat (fragment tick)", tick_t0)
+
+    with col_center:
+        _comments_panel()
 
     if "show_new_po" not in st.session_state: st.session_state.show_new_po=False
     if "show_new_so" not in st.session_state: st.session_state.show_new_so=False
@@ -2625,5 +5812,4 @@ elif st.session_state.page == "req_detail":
         purchase_order_dialog()
     if st.session_state.show_new_so:
         sales_order_dialog()
-
-
+    record_tick("req_detail page (full run)", _page_t0)
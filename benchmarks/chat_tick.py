@@ -0,0 +1,80 @@
+"""
+Per-tick script time of the chat pages, measured with Streamlit's AppTest.
+
+Seeds a scratch data directory with one order and one requirement whose
+threads hold --comments messages each, runs the detail and req_detail pages
+--runs times, then prints the medians App.py records (record_tick): the full
+page run, which is what every 1 s autorefresh tick cost before the chat
+became a fragment, and the chat fragment tick, which is what a tick costs now.
+
+    python benchmarks/chat_tick.py --comments 120 --runs 21
+
+Nothing outside the scratch directory is touched.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+from streamlit.testing.v1 import AppTest
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(HERE, "App.py")
+
+
+def seed(comments):
+    requests = [
+        {"Type": "💲", "Invoice": "1", "Order#": "T", "Date": "2025-01-02", "Status": "READY",
+         "Shipping Method": "Air", "ETA Date": "2025-02-01", "Description": ["a", "b"], "Quantity": [3, 4],
+         "Cost": [1.5, 2.0], "Proveedor": "Amz", "Encargado": "Tito", "Pago": ""},
+        {"Type": "📑", "Items": [{"Description": "d", "Target Price": "10", "QTY": "1"}],
+         "Vendedor Encargado": "John", "Comprador Encargado": "David", "Fecha": "2025-01-01", "Status": "OPEN"},
+    ]
+    thread = [{"author": "Tito" if i % 2 else "David", "text": f"message {i}", "when": "2025-01-01 10:00"}
+              for i in range(comments)]
+    with open("requests.json", "w", encoding="utf-8") as f:
+        json.dump(requests, f)
+    os.makedirs("comments", exist_ok=True)
+    for key in ("0", "1"):
+        with open(os.path.join("comments", f"{key}.json"), "w", encoding="utf-8") as f:
+            json.dump(thread, f)
+
+
+def run_page(page, runs, **state):
+    at = AppTest.from_file(APP, default_timeout=120)
+    at.session_state["authenticated"] = True
+    at.session_state["user_name"] = "David"
+    at.session_state["snapshot_ack_ts"] = time.time()
+    at.session_state["page"] = page
+    for k, v in state.items():
+        at.session_state[k] = v
+    for _ in range(runs):
+        at.run()
+        if at.exception:
+            sys.exit(f"{page}: {at.exception[0].value}")
+    return at
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Median per-tick script time of the detail chat pages.")
+    parser.add_argument("--comments", type=int, default=120, help="messages per thread (default 120)")
+    parser.add_argument("--runs", type=int, default=21, help="runs per page (default 21)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="chat-tick-") as workdir:
+        os.chdir(workdir)
+        os.environ["HELP_CENTER_EXPORT_DIR"] = os.path.join(workdir, "exports")
+        seed(args.comments)
+        run_page("detail", args.runs, selected_request=0)
+        run_page("req_detail", args.runs, selected_request=1)
+        home = run_page("home", 1)
+        for caption in home.caption:
+            if re.search(r"ms median over \d+ runs", caption.value):
+                print(caption.value)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+"""
+The Help Center's attachment store: uploads kept once per content under
+uploads/ab/cd/<sha256>, the files derived from them (previews, invoice text),
+the orphan collector and the storage report. App.py imports it; an admin can
+run the report or a collector pass from the command line:
+
+    python -m helpcenter_attachments report [--top 10] [--json]
+    python -m helpcenter_attachments collect
+
+Run it from the app directory (HELP_CENTER_STORE=sqlite for a multi-worker
+store), like run_workers.py.
+"""
+import argparse
+import hashlib
+import heapq
+import json
+import os
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+
+import streamlit as st
+from streamlit import logger as st_logger
+
+from helpcenter_store import _fsync_paths, primary_lock, read_comment_rows
+
+UPLOADS_DIR = "uploads"
+
+
+# ----- CONTENT-ADDRESSED ATTACHMENTS -----
+# Uploads are stored once per content, by SHA-256, under uploads/ab/cd/<hash>
+# (two shard levels keep directories small). Files are streamed to disk in
+# chunks while hashing; a comment keeps the hash ("attachment_sha") plus the
+# original file name ("attachment"). Uploads from before this layout
+# (uploads/<idx>_<timestamp>_<name>) are moved in by App.py's migrate_legacy_uploads().
+ATTACHMENT_CHUNK = 1024 * 1024  # bytes per read while hashing/copying
+_LEGACY_UPLOAD_NAME = re.compile(r"^\d+_\d{14}_(.+)$")
+
+
+def attachment_path(sha):
+    return os.path.join(UPLOADS_DIR, sha[:2], sha[2:4], sha)
+
+
+def store_attachment(fp, chunk_size=ATTACHMENT_CHUNK):
+    """
+    Copy the binary file object `fp` into the store, hashing as it streams.
+    Content already stored is not written twice. Returns (sha256, size).
+    """
+    tmp_dir = os.path.join(UPLOADS_DIR, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp = os.path.join(tmp_dir, f"{os.getpid()}.{threading.get_ident()}.part")
+    digest, size = hashlib.sha256(), 0
+    try:
+        with open(tmp, "wb") as out:
+            while True:
+                chunk = fp.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+        sha = digest.hexdigest()
+        path = attachment_path(sha)
+        try:
+            os.utime(path)  # stored already: a fresh reference, not an orphan candidate
+            os.remove(tmp)
+        except FileNotFoundError:  # new content (or just quarantined by the collector)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+            _fsync_paths([path])
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return sha, size
+
+
+def _legacy_uploads():
+    """Flat files left in uploads/ by the old <idx>_<timestamp>_<name> layout."""
+    try:
+        return {e.name for e in os.scandir(UPLOADS_DIR) if e.is_file() and not e.name.startswith(".")}
+    except FileNotFoundError:
+        return set()
+
+
+# ----- DERIVED FILES (previews, invoice text) -----
+# Built once per content next to the store, under uploads/previews/ab/ and
+# uploads/text/ab/. When the collector deletes an attachment it deletes these
+# too and tells the in-process caches registered with on_derived_dropped().
+PREVIEW_DIR = "previews"  # under UPLOADS_DIR
+INVOICE_TEXT_DIR = "text"  # under UPLOADS_DIR
+_DROP_HOOKS = {}  # name -> fn(sha)
+
+
+def preview_path(sha, kind):
+    return os.path.join(UPLOADS_DIR, PREVIEW_DIR, sha[:2], f"{sha}.{kind}")
+
+
+def invoice_text_path(sha, kind="json"):
+    return os.path.join(UPLOADS_DIR, INVOICE_TEXT_DIR, sha[:2], f"{sha}.{kind}")
+
+
+def on_derived_dropped(name, fn):
+    """Call fn(sha) whenever the derived files of `sha` are deleted (re-registering `name` replaces it)."""
+    _DROP_HOOKS[name] = fn
+
+
+def drop_derived_files(sha):
+    paths = [preview_path(sha, k) for k in ("png", "json", "err")] + [invoice_text_path(sha, k) for k in ("json", "err")]
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    for fn in list(_DROP_HOOKS.values()):
+        fn(sha)
+
+
+# ----- ATTACHMENT GARBAGE COLLECTION + STORAGE REPORT -----
+# Deleting a request (or restoring an older snapshot) drops comments but not
+# their files. The collector counts references from every stored comment;
+# unreferenced files are moved to uploads/quarantine/ and only deleted once
+# they have stayed there ATTACHMENT_GC_GRACE. Files referenced again (a
+# restore, a re-upload) are put back. Files younger than ATTACHMENT_GC_MIN_AGE
+# are skipped: an upload is stored before its comment is saved.
+ATTACHMENT_GC_EVERY = 6 * 3600  # seconds between collector runs
+ATTACHMENT_GC_GRACE = 7 * 24 * 3600  # seconds in quarantine before deletion
+ATTACHMENT_GC_MIN_AGE = 3600  # seconds; never quarantine a fresh upload
+ATTACHMENT_QUARANTINE = "quarantine"  # under UPLOADS_DIR
+_SHA256_HEX = re.compile(r"^[0-9a-f]{64}$")
+
+
+@st.cache_resource
+def _attachment_gc_state():
+    """Process-wide lock + collector stats shared by all sessions."""
+    return {"lock": threading.Lock(), "last_run": None, "last_result": None, "error": None}
+
+
+def _attachment_home(name):
+    """Where a stored file named `name` (a hash or a legacy flat name) lives."""
+    return attachment_path(name) if _SHA256_HEX.match(name) else os.path.join(UPLOADS_DIR, name)
+
+
+def stored_attachments():
+    """{name: (path, size, mtime)} of the live files: hashes under ab/cd/ plus legacy flat uploads."""
+    found = {}
+    for name in _legacy_uploads():
+        path = os.path.join(UPLOADS_DIR, name)
+        info = os.stat(path)
+        found[name] = (path, info.st_size, info.st_mtime)
+    for shard in os.scandir(UPLOADS_DIR):
+        if not (shard.is_dir() and len(shard.name) == 2):
+            continue
+        for sub in os.scandir(shard.path):
+            if not sub.is_dir():
+                continue
+            for e in os.scandir(sub.path):
+                if e.is_file() and _SHA256_HEX.match(e.name):
+                    info = e.stat()
+                    found[e.name] = (e.path, info.st_size, info.st_mtime)
+    return found
+
+
+def attachment_refs(comments):
+    """{stored name: {thread key: [original names]}} for every attachment comment."""
+    refs = {}
+    for key, thread in comments.items():
+        for c in thread or []:
+            if c.get("attachment"):
+                name = c.get("attachment_sha") or c["attachment"]
+                refs.setdefault(name, {}).setdefault(key, []).append(c["attachment"])
+    return refs
+
+
+def _stored_comments():
+    with primary_lock(shared=True):
+        return {k: json.loads(t) for k, t in read_comment_rows().items()}
+
+
+def collect_orphan_attachments(now=None):
+    """
+    One collector pass: put back referenced quarantined files, delete the
+    ones past the grace period, quarantine new orphans and stale partial
+    uploads. Returns {"quarantined", "restored", "deleted", "freed"}.
+    """
+    now = time.time() if now is None else now
+    quarantine = os.path.join(UPLOADS_DIR, ATTACHMENT_QUARANTINE)
+    os.makedirs(quarantine, exist_ok=True)
+    result = {"quarantined": 0, "restored": 0, "deleted": 0, "freed": 0}
+    with _attachment_gc_state()["lock"]:
+        comments = _stored_comments()
+        if not comments:
+            return result  # a missing/empty store is a restore waiting to happen
+        refs = attachment_refs(comments)
+        for e in list(os.scandir(quarantine)):
+            try:
+                home = _attachment_home(e.name)
+                if e.name in refs and not os.path.exists(home):
+                    os.makedirs(os.path.dirname(home), exist_ok=True)
+                    os.replace(e.path, home)
+                    result["restored"] += 1
+                elif e.name in refs or now - e.stat().st_mtime >= ATTACHMENT_GC_GRACE:
+                    size = e.stat().st_size
+                    os.remove(e.path)  # expired, or a duplicate of a live copy
+                    if e.name not in refs and _SHA256_HEX.match(e.name):
+                        drop_derived_files(e.name)
+                    result["deleted"] += 1
+                    result["freed"] += size
+            except FileNotFoundError:
+                continue  # another worker got there first
+        for name, (path, _, mtime) in stored_attachments().items():
+            if name in refs or now - mtime < ATTACHMENT_GC_MIN_AGE:
+                continue
+            try:
+                if now - os.stat(path).st_mtime < ATTACHMENT_GC_MIN_AGE:
+                    continue  # re-uploaded (touched) since the listing: referenced again
+                os.replace(path, os.path.join(quarantine, name))
+                os.utime(os.path.join(quarantine, name), (now, now))  # the grace period starts now
+                result["quarantined"] += 1
+            except FileNotFoundError:
+                continue
+        tmp_dir = os.path.join(UPLOADS_DIR, "tmp")
+        if os.path.isdir(tmp_dir):
+            for e in os.scandir(tmp_dir):  # partial uploads of crashed processes
+                if now - e.stat().st_mtime >= ATTACHMENT_GC_MIN_AGE:
+                    try:
+                        os.remove(e.path)
+                    except FileNotFoundError:
+                        pass
+    return result
+
+
+def attachment_storage_report(top=10):
+    """
+    Disk usage of the attachment store: totals (stored vs. referenced bytes,
+    so the saving from deduplication shows), bytes per request, the largest
+    files, orphans waiting for the collector, the quarantine and references
+    whose file is missing.
+    """
+    comments = _stored_comments()
+    refs = attachment_refs(comments)
+    stored = stored_attachments()
+    per_request, logical = {}, 0
+    for name, by_key in refs.items():
+        size = stored.get(name, (None, 0))[1]
+        for key, names in by_key.items():
+            row = per_request.setdefault(key, {"request": int(key), "files": 0, "bytes": 0})
+            row["files"] += len(names)
+            row["bytes"] += size * len(names)
+            logical += size * len(names)
+    largest = heapq.nlargest(top, stored.items(), key=lambda kv: kv[1][1])
+    orphans = [(n, s) for n, (_, s, _) in stored.items() if n not in refs]
+    quarantine = os.path.join(UPLOADS_DIR, ATTACHMENT_QUARANTINE)
+    held = [e.stat().st_size for e in os.scandir(quarantine)] if os.path.isdir(quarantine) else []
+    return {
+        "files": len(stored),
+        "bytes": sum(s for _, s, _ in stored.values()),
+        "referenced_bytes": logical,
+        "per_request": sorted(per_request.values(), key=lambda r: -r["bytes"]),
+        "largest": [{"file": n, "bytes": s, "names": sorted({x for xs in refs.get(n, {}).values() for x in xs}),
+                     "requests": sorted(int(k) for k in refs.get(n, {}))} for n, (_, s, _) in largest],
+        "orphans": len(orphans),
+        "orphan_bytes": sum(s for _, s in orphans),
+        "quarantined": len(held),
+        "quarantined_bytes": sum(held),
+        "missing": sorted(n for n in refs if n not in stored),
+    }
+
+
+@st.cache_resource
+def start_attachment_gc():
+    """One daemon thread per process running the collector every ATTACHMENT_GC_EVERY."""
+    state = _attachment_gc_state()
+
+    def _loop():
+        while True:
+            try:
+                state["last_result"] = collect_orphan_attachments()
+                state["last_run"] = datetime.now()
+                state["error"] = None
+            except Exception as e:  # keep the collector alive; surfaced in Backup & Restore
+                state["error"] = str(e)
+            time.sleep(ATTACHMENT_GC_EVERY)
+
+    t = threading.Thread(target=_loop, name="attachment-gc", daemon=True)
+    t.start()
+    return t
+
+
+def _print_report(report):
+    mb = 1024 * 1024
+    print(f"{report['files']} files, {report['bytes'] / mb:.1f} MB stored "
+          f"({report['referenced_bytes'] / mb:.1f} MB referenced)")
+    print(f"orphans: {report['orphans']} ({report['orphan_bytes'] / mb:.1f} MB) · "
+          f"quarantined: {report['quarantined']} ({report['quarantined_bytes'] / mb:.1f} MB)")
+    if report["missing"]:
+        print(f"missing files: {len(report['missing'])}")
+    print("\nlargest files:")
+    for row in report["largest"]:
+        print(f"  {row['bytes'] / mb:8.2f} MB  {row['file'][:12]}  {', '.join(row['names'])}  "
+              f"requests {row['requests']}")
+    print("\nper request:")
+    for row in report["per_request"]:
+        print(f"  #{row['request']:<6} {row['files']:4d} files  {row['bytes'] / mb:8.2f} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m helpcenter_attachments",
+                                     description="Attachment storage report and orphan collector.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    report = sub.add_parser("report", help="disk usage: totals, per request, largest files, orphans")
+    report.add_argument("--top", type=int, default=10, help="largest files to list (default 10)")
+    report.add_argument("--json", action="store_true", help="print the report as JSON")
+    sub.add_parser("collect", help="run one collector pass (quarantine orphans, delete expired ones)")
+    args = parser.parse_args(argv)
+    st_logger.set_log_level("error")  # no "missing ScriptRunContext" noise outside `streamlit run`
+
+    if args.command == "report":
+        result = attachment_storage_report(top=args.top)
+        if args.json:
+            json.dump(result, sys.stdout, indent=2)
+            print()
+        else:
+            _print_report(result)
+    else:
+        print(json.dumps(collect_orphan_attachments()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1374 @@
+"""
+Shared persistence of the Help Center: the primary store (JSON files, or
+SQLite/WAL for several workers), cross-process locking and atomic writes,
+the change log, compare-and-swap rebasing, the group-commit writer and the
+notification bus it publishes on. App.py imports it, and so do the tests and
+command-line tools, so nothing here touches a Streamlit session; process-wide
+state lives in st.cache_resource like the rest of the app.
+"""
+import gzip
+import json
+import os
+import secrets
+import socket
+import sqlite3
+import threading
+import time
+from collections import deque
+from collections.abc import MutableMapping
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import quote, unquote
+
+import streamlit as st
+
+try:
+    import fcntl  # POSIX advisory locks for the shared primary JSONs
+except ImportError:
+    fcntl = None
+
+
+# ----- STORE CONFIG -----
+REQUESTS_FILE = "requests.json"
+COMMENTS_FILE = "comments.json"  # legacy single file, split into COMMENTS_DIR on first use
+COMMENTS_DIR = "comments"
+# "json" (default, single server) or "sqlite" (shared store for run_workers.py)
+STORE_BACKEND = os.environ.get("HELP_CENTER_STORE", "json").strip().lower()
+STORE_DB_FILE = os.environ.get("HELP_CENTER_DB", "helpcenter.db")
+# change notifications between sessions: "local" (one process) or "unix" (worker sockets)
+NOTIFY_BACKEND = os.environ.get("HELP_CENTER_NOTIFY", "unix" if STORE_BACKEND == "sqlite" else "local").strip().lower()
+NOTIFY_DIR = os.environ.get("HELP_CENTER_NOTIFY_DIR", "notify")
+
+
+# ----- PRIMARY FILE LOCKING + ATOMIC WRITES -----
+# Several Streamlit processes share requests.json / comments/. Writers
+# hold an exclusive advisory lock (flock on a sidecar .lock file) across the
+# whole read-compare-write cycle; readers take it shared so they always see a
+# matching pair. Files are replaced via temp + rename, so even an unlocked
+# reader never sees a truncated file. fsync is batched: a write within
+# PRIMARY_FSYNC_WINDOW of the last one leaves its flush to the syncer thread.
+PRIMARY_LOCK_FILE = "primary.lock"
+PRIMARY_FSYNC_WINDOW = 0.5  # seconds
+
+
+@st.cache_resource
+def _primary_lock_state():
+    return {"local": threading.local(), "fallback": threading.RLock(),
+            "last_fsync": 0.0, "dirty": set(), "cond": threading.Condition()}
+
+
+@contextmanager
+def primary_lock(shared=False):
+    """
+    Cross-process advisory lock on the primary JSONs (re-entrant per thread).
+    Without fcntl (Windows) it degrades to an in-process lock.
+    """
+    state = _primary_lock_state()
+    local = state["local"]
+    depth = getattr(local, "depth", 0)
+    if depth == 0:
+        if fcntl is None:
+            state["fallback"].acquire()
+        else:
+            local.fd = os.open(PRIMARY_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(local.fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    local.depth = depth + 1
+    try:
+        yield
+    finally:
+        local.depth -= 1
+        if local.depth == 0:
+            if fcntl is None:
+                state["fallback"].release()
+            else:
+                fcntl.flock(local.fd, fcntl.LOCK_UN)
+                os.close(local.fd)
+
+
+@contextmanager
+def dir_lock(path, lock, name=".lock"):
+    """
+    Exclusive lock on the files of directory `path`: `lock` between threads,
+    flock on `path`/`name` between processes. Not re-entrant.
+    """
+    with lock:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(path, exist_ok=True)
+        fd = os.open(os.path.join(path, name), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)  # drops the flock
+
+
+def _fsync_paths(paths):
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    for d in {os.path.dirname(os.path.abspath(p)) for p in paths}:
+        try:
+            fd = os.open(d, os.O_RDONLY)
+        except OSError:
+            continue  # directories can't be opened on Windows
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+def atomic_write_text(path, text, durable=False):
+    """
+    Replace `path` with `text` via a temp file + rename. The fsync is done
+    inline if `durable` or no other one happened within PRIMARY_FSYNC_WINDOW;
+    otherwise the syncer thread flushes it (together with any others) shortly.
+    """
+    state = _primary_lock_state()
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+    os.replace(tmp, path)
+    with state["cond"]:
+        if durable or time.monotonic() - state["last_fsync"] >= PRIMARY_FSYNC_WINDOW:
+            state["last_fsync"] = time.monotonic()
+            _fsync_paths([path])
+        else:
+            state["dirty"].add(path)
+            state["cond"].notify()
+
+
+def flush_primary_writes():
+    """fsync every replaced file still waiting on the batch; returns how many."""
+    state = _primary_lock_state()
+    with state["cond"]:
+        paths, state["dirty"] = list(state["dirty"]), set()
+        if paths:
+            _fsync_paths(paths)
+            state["last_fsync"] = time.monotonic()
+    return len(paths)
+
+
+@st.cache_resource
+def start_primary_syncer():
+    """One daemon thread per process that flushes batched fsyncs."""
+    state = _primary_lock_state()
+
+    def _loop():
+        while True:
+            with state["cond"]:
+                while not state["dirty"]:
+                    state["cond"].wait()
+            time.sleep(PRIMARY_FSYNC_WINDOW)
+            try:
+                flush_primary_writes()
+            except OSError:
+                pass  # retried with the next batch
+
+    t = threading.Thread(target=_loop, name="primary-fsync", daemon=True)
+    t.start()
+    return t
+
+
+# ----- SHARED STORE (JSON files, or SQLite/WAL for multi-worker mode) -----
+# HELP_CENTER_STORE=sqlite keeps requests/comments as one row per record in
+# STORE_DB_FILE (WAL journal), so several server processes (run_workers.py)
+# share one dataset. Every commit bumps meta.change_counter; each process
+# checks it cheaply via PRAGMA data_version, which only changes when another
+# connection committed. The rest of the app still sees the same JSON texts.
+# Script runs come and go on fresh threads, so connections live in a small
+# process-wide pool (borrowed with store_connection()), and the schema setup
+# and JSON import run once per process.
+STORE_POOL_SIZE = 8  # idle connections kept open per process
+# events that touch only the request rows / threads they name
+ROW_LOCAL_OPS = {"add_request", "update_request", "append_comments", "put_thread", "drop_thread"}
+
+
+@st.cache_resource
+def _store_state():
+    return {"lock": threading.Lock(), "setup_lock": threading.Lock(), "ready": False, "idle": []}
+
+
+def _setup_store():
+    """Create the schema (WAL mode sticks to the file) and seed it from JSON; once per process."""
+    state = _store_state()
+    with state["setup_lock"]:
+        if state["ready"]:
+            return
+        conn = sqlite3.connect(STORE_DB_FILE, timeout=30, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS requests (idx INTEGER PRIMARY KEY, body TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS comments (key TEXT PRIMARY KEY, body TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+                INSERT OR IGNORE INTO meta (key, value) VALUES ('change_counter', 0);
+            """)
+            _import_json_into_store(conn)
+        finally:
+            conn.close()
+        state["ready"] = True
+
+
+@contextmanager
+def store_connection():
+    """
+    Borrow a pooled connection to the shared SQLite store: a dict with "conn"
+    plus its last seen "pragma" (data_version) and "counter".
+    """
+    state = _store_state()
+    if not state["ready"]:
+        _setup_store()
+    with state["lock"]:
+        entry = state["idle"].pop() if state["idle"] else None
+    if entry is None:
+        conn = sqlite3.connect(STORE_DB_FILE, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        entry = {"conn": conn, "pragma": None, "counter": None}
+    try:
+        yield entry
+    finally:
+        if entry["conn"].in_transaction:
+            entry["conn"].execute("ROLLBACK")
+        with state["lock"]:
+            if len(state["idle"]) < STORE_POOL_SIZE:
+                state["idle"].append(entry)
+                entry = None
+        if entry is not None:
+            entry["conn"].close()
+
+
+def _import_json_into_store(conn):
+    """One-time migration: seed an empty store from existing requests/comments JSON."""
+    if conn.execute("SELECT value FROM meta WHERE key = 'change_counter'").fetchone()[0]:
+        return
+    loaded = []
+    for path, empty in ((REQUESTS_FILE, []), (COMMENTS_FILE, {})):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                loaded.append(json.load(f))
+        except (OSError, json.JSONDecodeError):
+            loaded.append(empty)
+    if os.path.isdir(COMMENTS_DIR):  # the JSON store split into one file per thread
+        for name in os.listdir(COMMENTS_DIR):
+            try:
+                if name.endswith(".json"):
+                    with open(os.path.join(COMMENTS_DIR, name), "r", encoding="utf-8") as f:
+                        loaded[1][unquote(name[:-5])] = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                continue
+    if loaded[0] or loaded[1]:
+        _store_write(conn, loaded[0], loaded[1], None)
+
+
+def store_change_counter():
+    """Cross-process change counter; re-read only when another connection committed."""
+    with store_connection() as entry:
+        pragma = entry["conn"].execute("PRAGMA data_version").fetchone()[0]
+        if pragma != entry["pragma"] or entry["counter"] is None:
+            entry["pragma"] = pragma
+            entry["counter"] = entry["conn"].execute(
+                "SELECT value FROM meta WHERE key = 'change_counter'").fetchone()[0]
+        return entry["counter"]
+
+
+def _store_write(conn, requests, comments, events):
+    """
+    Persist in one transaction: only the rows `events` touched when they are
+    all row-local, else a full rewrite (deletes/truncations re-index rows).
+    Returns the new change counter.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if events is not None and all(ev["op"] in ROW_LOCAL_OPS for ev in events):
+            idxs = sorted({ev["idx"] for ev in events if "idx" in ev})
+            keys = sorted({ev["key"] for ev in events if "key" in ev})
+            conn.executemany("INSERT OR REPLACE INTO requests (idx, body) VALUES (?, ?)",
+                             [(i, json.dumps(requests[i])) for i in idxs])
+            conn.executemany("INSERT OR REPLACE INTO comments (key, body) VALUES (?, ?)",
+                             [(k, json.dumps(comments[k])) for k in keys if k in comments])
+            conn.executemany("DELETE FROM comments WHERE key = ?", [(k,) for k in keys if k not in comments])
+        else:
+            conn.execute("DELETE FROM requests")
+            conn.execute("DELETE FROM comments")
+            conn.executemany("INSERT INTO requests (idx, body) VALUES (?, ?)",
+                             [(i, json.dumps(r)) for i, r in enumerate(requests)])
+            conn.executemany("INSERT INTO comments (key, body) VALUES (?, ?)",
+                             [(k, json.dumps(v)) for k, v in comments.items()])
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'change_counter'")
+        counter = conn.execute("SELECT value FROM meta WHERE key = 'change_counter'").fetchone()[0]
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return counter
+
+
+# ----- JSON STORE: ONE FILE PER COMMENT THREAD -----
+# Without SQLite each thread lives in COMMENTS_DIR/<quoted key>.json, so a
+# comment replaces one small file and a reader re-reads only the files whose
+# stat moved. COMMENTS_DIR/.change_counter is bumped by every write (the
+# directory's own mtime is too coarse to tell two quick commits apart). A
+# legacy comments.json is split up on first use and kept as *.migrated.
+COMMENTS_COUNTER_FILE = ".change_counter"
+
+
+@st.cache_resource
+def _comment_files_state():
+    return {"lock": threading.Lock(), "migrated": False, "files": {}}
+
+
+def comment_thread_path(key):
+    return os.path.join(COMMENTS_DIR, quote(str(key), safe="") + ".json")
+
+
+def _migrate_comments_file():
+    """Split a legacy comments.json into per-thread files (checked once per process)."""
+    state = _comment_files_state()
+    if state["migrated"]:
+        return
+    with primary_lock():
+        try:
+            with open(COMMENTS_FILE, "r", encoding="utf-8") as f:
+                text = f.read()
+        except FileNotFoundError:
+            text = None  # nothing to migrate (or another process just did it)
+        if text is not None:
+            os.makedirs(COMMENTS_DIR, exist_ok=True)
+            for key, thread in (json.loads(text) if text.strip() else {}).items():
+                atomic_write_text(comment_thread_path(key), json.dumps(thread, indent=2))
+            _bump_comments_counter()
+            flush_primary_writes()
+            try:
+                os.replace(COMMENTS_FILE, COMMENTS_FILE + ".migrated")
+            except FileNotFoundError:
+                pass
+        state["migrated"] = True
+
+
+def _comments_counter():
+    try:
+        with open(os.path.join(COMMENTS_DIR, COMMENTS_COUNTER_FILE), "r", encoding="utf-8") as f:
+            return int(f.read() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def _bump_comments_counter():
+    atomic_write_text(os.path.join(COMMENTS_DIR, COMMENTS_COUNTER_FILE), str(_comments_counter() + 1))
+
+
+def _read_comment_files():
+    """{thread key: JSON text} of COMMENTS_DIR; only files whose stat changed are read again."""
+    _migrate_comments_file()
+    state = _comment_files_state()
+    try:
+        entries = [e for e in os.scandir(COMMENTS_DIR) if e.name.endswith(".json")]
+    except FileNotFoundError:
+        entries = []
+    with state["lock"]:
+        cache, state["files"] = state["files"], {}
+        for e in entries:
+            try:
+                s = e.stat()
+                stamp = (s.st_ino, s.st_mtime_ns, s.st_size)
+                if e.name not in cache or cache[e.name][0] != stamp:
+                    with open(e.path, "r", encoding="utf-8") as f:
+                        cache[e.name] = (stamp, f.read())
+            except FileNotFoundError:
+                continue  # dropped since the scan
+            state["files"][e.name] = cache[e.name]
+        return {unquote(name[:-5]): text for name, (_, text) in state["files"].items()}
+
+
+def _write_comment_files(comments, keys=None, durable=False):
+    """
+    Store the threads `keys` of `comments` (a missing key deletes its file).
+    keys=None writes every thread and drops stale files, skipping unchanged ones.
+    """
+    _migrate_comments_file()
+    os.makedirs(COMMENTS_DIR, exist_ok=True)
+    stored = None
+    if keys is None:
+        stored = _read_comment_files()
+        keys = set(comments) | set(stored)
+    removed = []
+    for key in keys:
+        path = comment_thread_path(key)
+        if key in comments:
+            text = json.dumps(comments[key], indent=2)
+            if stored is None or stored.get(key) != text:
+                atomic_write_text(path, text)
+        elif os.path.exists(path):
+            os.remove(path)
+            removed.append(path)
+    _bump_comments_counter()
+    if durable:
+        flush_primary_writes()
+        _fsync_paths(removed)
+
+
+def read_primary_texts(comments=True):
+    """
+    (requests JSON text, comments JSON text) of the stored state; "" when
+    missing. With comments=False the comments are not read (None).
+    """
+    if STORE_BACKEND == "sqlite":
+        with store_connection() as entry:
+            conn = entry["conn"]
+            conn.execute("BEGIN")  # one snapshot for both tables
+            try:
+                reqs = [row[0] for row in conn.execute("SELECT body FROM requests ORDER BY idx")]
+                coms = ([f"{json.dumps(k)}: {v}" for k, v in conn.execute("SELECT key, body FROM comments")]
+                        if comments else [])
+            finally:
+                conn.execute("COMMIT")
+        if not reqs and not coms:
+            return "", ("" if comments else None)
+        return "[" + ", ".join(reqs) + "]", ("{" + ", ".join(coms) + "}" if comments else None)
+    text = ""
+    if os.path.exists(REQUESTS_FILE) and os.path.getsize(REQUESTS_FILE) > 0:
+        with open(REQUESTS_FILE, "r", encoding="utf-8") as f:
+            text = f.read()
+    if not comments:
+        return text, None
+    rows = _read_comment_files()
+    return text, ("{" + ", ".join(f"{json.dumps(k)}: {v}" for k, v in rows.items()) + "}" if rows else "")
+
+
+def read_comment_rows():
+    """
+    {thread key: thread JSON text} as stored: one row (SQLite) or one file
+    (JSON store) per thread.
+    """
+    if STORE_BACKEND == "sqlite":
+        with store_connection() as entry:
+            return dict(entry["conn"].execute("SELECT key, body FROM comments"))
+    return _read_comment_files()
+
+
+def stored_thread_keys():
+    """Keys of the stored comment threads, without reading any thread."""
+    if STORE_BACKEND == "sqlite":
+        with store_connection() as entry:
+            return [row[0] for row in entry["conn"].execute("SELECT key FROM comments")]
+    _migrate_comments_file()
+    try:
+        return [unquote(e.name[:-5]) for e in os.scandir(COMMENTS_DIR) if e.name.endswith(".json")]
+    except FileNotFoundError:
+        return []
+
+
+def read_comment_threads(keys):
+    """{key: thread} of the stored threads `keys` (missing ones are left out); reads only those."""
+    return {k: json.loads(t) for k, t in _read_thread_texts(keys).items()}
+
+
+def _read_thread_texts(keys):
+    keys = list(dict.fromkeys(keys))
+    texts = {}
+    if STORE_BACKEND == "sqlite":
+        with store_connection() as entry:
+            for start in range(0, len(keys), 500):  # SQLite caps bound parameters per statement
+                chunk = keys[start:start + 500]
+                texts.update(entry["conn"].execute(
+                    f"SELECT key, body FROM comments WHERE key IN ({', '.join('?' * len(chunk))})", chunk))
+    else:
+        _migrate_comments_file()
+        for key in keys:
+            try:
+                with open(comment_thread_path(key), "r", encoding="utf-8") as f:
+                    texts[key] = f.read()
+            except FileNotFoundError:
+                continue
+    return texts
+
+
+def write_primary_state(requests, comments, events=None, durable=False):
+    """
+    Store the full state (callers hold primary_lock). `events` lets both
+    stores write only the touched threads (and, with SQLite, request rows).
+    """
+    if STORE_BACKEND == "sqlite":
+        with store_connection() as entry:
+            # our own commits don't move this connection's PRAGMA data_version
+            entry["counter"] = _store_write(entry["conn"], requests, comments, events)
+    else:
+        keys = None
+        if events is not None and all(ev["op"] in ROW_LOCAL_OPS for ev in events):
+            keys = {ev["key"] for ev in events if "key" in ev}
+        if keys is None or any("idx" in ev for ev in events):
+            atomic_write_text(REQUESTS_FILE, json.dumps(requests, indent=2), durable=durable)
+        _write_comment_files(comments, keys, durable=durable)
+
+
+def _primary_signature():
+    """
+    (mtime_ns, size) of requests.json plus the comment files' change counter —
+    changes whenever save_data() runs. With the SQLite store it is the store's
+    cross-process change counter.
+    """
+    if STORE_BACKEND == "sqlite":
+        return ("sqlite", store_change_counter())
+    try:
+        s = os.stat(REQUESTS_FILE)
+        sig = (s.st_mtime_ns, s.st_size)
+    except FileNotFoundError:
+        sig = None
+    return sig, _comments_counter(), os.path.exists(COMMENTS_FILE)
+
+
+# ----- CHANGE LOG (EVENTS + CHECKPOINTS) -----
+# Every save appends the mutations it made to events/events.jsonl, one JSON
+# event per line with a monotonically increasing "seq". Every
+# EVENT_CHECKPOINT_EVERY events a full-state checkpoint is written together
+# with the log offset it covers, so state = latest checkpoint + tail, and a
+# consumer that remembers its last seq can resume without rescanning.
+# Commits are write-ahead: a pending marker, the log append, then the data
+# write; a failed data write truncates its events off again, and a commit
+# interrupted by a crash is repaired by the next one (recover_pending_commit).
+EVENTS_DIR = "events"
+EVENT_LOG_FILE = os.path.join(EVENTS_DIR, "events.jsonl")
+EVENT_PENDING_FILE = os.path.join(EVENTS_DIR, "pending.json")
+EVENT_CHECKPOINT_EVERY = 200
+EVENT_CHECKPOINT_KEEP = 5
+
+
+@st.cache_resource
+def _event_log_state():
+    """Process-wide append position of the change log (guarded by `lock`)."""
+    return {"lock": threading.Lock(), "seq": 0, "size": -1, "checkpoint_seq": None}
+
+
+def _checkpoint_files():
+    """[(seq, path)] of the checkpoints on disk (periodic + reset), newest first."""
+    out = []
+    if os.path.isdir(EVENTS_DIR):
+        for name in os.listdir(EVENTS_DIR):
+            prefix = name.split("_", 1)[0]
+            if prefix in ("checkpoint", "reset") and name.endswith(".json.gz"):
+                try:
+                    out.append((int(name[len(prefix) + 1:-len(".json.gz")]), os.path.join(EVENTS_DIR, name)))
+                except ValueError:
+                    continue
+    return sorted(out, reverse=True)
+
+
+def _read_checkpoint(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _last_logged_seq():
+    """Seq of the last complete line in the log (reads only the file tail)."""
+    if not os.path.exists(EVENT_LOG_FILE):
+        return 0
+    with open(EVENT_LOG_FILE, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        step = 4096
+        while True:
+            start = max(0, end - step)
+            f.seek(start)
+            lines = f.read(end - start).splitlines()
+            for line in reversed(lines[1:] if start else lines):
+                try:
+                    return int(json.loads(line)["seq"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+            if not start:
+                return 0
+            step *= 4
+
+
+def _read_primary_files():
+    """(requests, comments) as currently stored — empty if missing/unreadable."""
+    return _parse_primary_texts(read_primary_texts())
+
+
+def _parse_primary_texts(texts):
+    out = []
+    for text, empty in zip(texts, ([], {})):
+        try:
+            out.append(json.loads(text) if text else empty)
+        except json.JSONDecodeError:
+            out.append(empty)
+    return out[0], out[1]
+
+
+def apply_event(requests, comments, ev):
+    """Apply one change-log event to (requests, comments) in place."""
+    op = ev["op"]
+    if op == "add_request":
+        requests.append(ev["record"])
+    elif op == "update_request":
+        rec = requests[ev["idx"]]
+        rec.update(ev.get("set", {}))
+        for k in ev.get("unset", []):
+            rec.pop(k, None)
+    elif op == "delete_request":
+        i = ev["idx"]
+        requests.pop(i)
+        # re-index the threads present (a session only holds the ones it opened)
+        shifted = {str(int(k) - (int(k) > i)): v for k, v in comments.items()
+                   if k.isdigit() and int(k) != i and int(k) - (int(k) > i) < len(requests)}
+        comments.clear()
+        comments.update(shifted)
+    elif op == "truncate_requests":
+        del requests[ev["n"]:]
+    elif op == "append_comments":
+        comments.setdefault(ev["key"], []).extend(ev["comments"])
+    elif op == "put_thread":
+        comments[ev["key"]] = ev["thread"]
+    elif op == "drop_thread":
+        comments.pop(ev["key"], None)
+    elif op == "reset":
+        snap = _read_checkpoint(os.path.join(EVENTS_DIR, ev["checkpoint"]))
+        requests[:] = snap["requests"]
+        comments.clear()
+        comments.update(snap["comments"])
+    else:
+        raise ValueError(f"unknown change-log op {op!r}")
+
+
+def diff_events(old_requests, old_comments, new_requests, new_comments):
+    """Minimal events turning the old state into the new one (field level)."""
+    events = []
+    for i, new in enumerate(new_requests):
+        if i >= len(old_requests):
+            events.append({"op": "add_request", "idx": i, "record": new})
+            continue
+        old = old_requests[i]
+        if old == new:
+            continue
+        changed = {k: v for k, v in new.items() if k not in old or old[k] != v}
+        removed = [k for k in old if k not in new]
+        ev = {"op": "update_request", "idx": i, "set": changed}
+        if removed:
+            ev["unset"] = removed
+        events.append(ev)
+    if len(old_requests) > len(new_requests):
+        events.append({"op": "truncate_requests", "n": len(new_requests)})
+
+    for key, thread in new_comments.items():
+        old = old_comments.get(key)
+        if old == thread:
+            continue
+        if old is not None and thread[:len(old)] == old:
+            events.append({"op": "append_comments", "key": key, "comments": thread[len(old):]})
+        else:
+            events.append({"op": "put_thread", "key": key, "thread": thread})
+    for key in old_comments:
+        if key not in new_comments:
+            events.append({"op": "drop_thread", "key": key})
+    return events
+
+
+def write_checkpoint(requests, comments, seq, offset, prefix="checkpoint"):
+    """Full state as of `seq`; `offset` is where the log continues after it."""
+    os.makedirs(EVENTS_DIR, exist_ok=True)
+    path = os.path.join(EVENTS_DIR, f"{prefix}_{seq:010d}.json.gz")
+    tmp = path + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        json.dump({"seq": seq, "offset": offset, "requests": requests, "comments": dict(comments)}, f, ensure_ascii=False)
+    os.replace(tmp, path)
+    # Keep the newest few periodic ones; reset_* files stay (reset events name them)
+    periodic = [p for _, p in _checkpoint_files() if os.path.basename(p).startswith("checkpoint_")]
+    for old in periodic[EVENT_CHECKPOINT_KEEP:]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+    return path
+
+
+def _append_locked(state, events, user, ts=None):
+    """Append stamped events; caller holds state["lock"]. Returns the new size."""
+    os.makedirs(EVENTS_DIR, exist_ok=True)
+    size = os.path.getsize(EVENT_LOG_FILE) if os.path.exists(EVENT_LOG_FILE) else 0
+    if size != state["size"]:  # first use, or another process appended
+        state["seq"] = _last_logged_seq()
+        cps = _checkpoint_files()
+        state["checkpoint_seq"] = cps[0][0] if cps else 0
+        state["size"] = size
+    if not events:
+        return size
+    ts = ts or datetime.now().isoformat(timespec="seconds")
+    lines = []
+    for ev in events:
+        state["seq"] += 1
+        lines.append(json.dumps({"seq": state["seq"], "ts": ts, "user": user, **ev}, ensure_ascii=False))
+    with open(EVENT_LOG_FILE, "a", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+        state["size"] = f.tell()
+    return state["size"]
+
+
+def _truncate_log(state, size, seq):
+    """Cut the log back to `size` bytes (ending at `seq`); caller holds state["lock"]."""
+    with open(EVENT_LOG_FILE, "r+b") as f:
+        f.truncate(size)
+        f.flush()
+        os.fsync(f.fileno())
+    state["size"], state["seq"] = size, seq
+
+
+def commit_events(events, requests, comments, write, user=""):
+    """
+    Stamp `events` with seq/ts/user, append them to the log, then call
+    `write()` to store the state they produced (`requests`, `comments`). If
+    the append or the write fails, the log is cut back and the error raised,
+    so the log never holds events whose data didn't land. A checkpoint, when
+    due, is written once the data is stored. Returns the last seq written.
+    """
+    state = _event_log_state()
+    with primary_lock(), state["lock"]:  # seq order is shared by all processes
+        size = _append_locked(state, [], user)
+        seq = state["seq"]
+        atomic_write_text(EVENT_PENDING_FILE, json.dumps({"size": size, "seq": seq, "end": seq + len(events)}),
+                          durable=True)
+        try:
+            _append_locked(state, events, user)
+            write()
+        except Exception:
+            if os.path.exists(EVENT_LOG_FILE):
+                _truncate_log(state, size, seq)
+            os.remove(EVENT_PENDING_FILE)  # only once the log is back where it was
+            raise
+        os.remove(EVENT_PENDING_FILE)
+        if events and state["seq"] - state["checkpoint_seq"] >= EVENT_CHECKPOINT_EVERY:
+            write_checkpoint(requests, comments, state["seq"], state["size"])
+            state["checkpoint_seq"] = state["seq"]
+        return state["seq"]
+
+
+def recover_pending_commit():
+    """
+    Finish a commit that a crash interrupted (callers hold primary_lock): if
+    all its events reached the log, the log is the truth and the stored state
+    is rebuilt from it; otherwise its partial append is cut off (its data was
+    never written). Returns True if there was one.
+    """
+    try:
+        with open(EVENT_PENDING_FILE, "r", encoding="utf-8") as f:
+            pending = json.load(f)
+    except FileNotFoundError:
+        return False
+    except json.JSONDecodeError:
+        os.remove(EVENT_PENDING_FILE)  # torn marker: its append never started
+        return False
+    state = _event_log_state()
+    with state["lock"]:
+        if _last_logged_seq() >= pending["end"]:
+            requests, comments, _ = rebuild_from_events()
+            write_primary_state(requests, comments, durable=True)
+        elif os.path.exists(EVENT_LOG_FILE):
+            _truncate_log(state, pending["size"], pending["seq"])
+        state["size"] = -1  # re-read the position on the next append
+        os.remove(EVENT_PENDING_FILE)
+    return True
+
+
+def log_reset(requests, comments, reason, user=""):
+    """
+    Record a wholesale replacement (restore): the new state goes into a
+    reset_<seq> checkpoint first, then a "reset" event pointing at it.
+    """
+    state = _event_log_state()
+    with primary_lock(), state["lock"]:
+        _append_locked(state, [], user)
+        seq = state["seq"] + 1
+        name = f"reset_{seq:010d}.json.gz"
+        event = {"op": "reset", "checkpoint": name, "reason": reason}
+        ts = datetime.now().isoformat(timespec="seconds")
+        line = json.dumps({"seq": seq, "ts": ts, "user": user, **event}, ensure_ascii=False) + "\n"
+        # offset = log size once this very line is appended
+        write_checkpoint(requests, comments, seq, state["size"] + len(line.encode("utf-8")), prefix="reset")
+        _append_locked(state, [event], user, ts)
+        state["checkpoint_seq"] = state["seq"]
+        return state["seq"]
+
+
+def read_events(since_seq=0):
+    """
+    Yield events with seq > since_seq in order. Starts from the newest
+    checkpoint at or before since_seq, so catching up reads only the tail.
+    """
+    if not os.path.exists(EVENT_LOG_FILE):
+        return
+    offset = 0
+    for seq, path in _checkpoint_files():
+        if seq <= since_seq:
+            try:
+                offset = _read_checkpoint(path).get("offset") or 0
+            except Exception:
+                continue
+            break
+    with open(EVENT_LOG_FILE, "r", encoding="utf-8") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith("\n"):
+                break  # partial line from a writer still appending
+            ev = json.loads(line)
+            if ev["seq"] > since_seq:
+                yield ev
+
+
+def rebuild_from_events():
+    """(requests, comments, seq) rebuilt from the newest checkpoint + log tail."""
+    requests, comments, seq = [], {}, 0
+    for cp_seq, path in _checkpoint_files():
+        try:
+            snap = _read_checkpoint(path)
+        except Exception:
+            continue
+        requests, comments, seq = snap["requests"], snap["comments"], cp_seq
+        break
+    for ev in read_events(seq):
+        apply_event(requests, comments, ev)
+        seq = ev["seq"]
+    return requests, comments, seq
+
+
+def event_log_status():
+    """Head seq, newest checkpoint seq and log size, for the admin captions."""
+    cps = _checkpoint_files()
+    return {
+        "seq": _last_logged_seq(),
+        "checkpoint": cps[0][0] if cps else None,
+        "bytes": os.path.getsize(EVENT_LOG_FILE) if os.path.exists(EVENT_LOG_FILE) else 0,
+    }
+
+
+# ----- OPTIMISTIC CONCURRENCY (per-record versions, compare-and-swap) -----
+# Every record carries a stable "_id" (positions shift when a record is
+# deleted) and a "_version". A record update only lands if the stored record
+# with the same id is still at the version its writer started from;
+# rebase_events() replays a session's own edits onto the stored state that
+# way and hands back the records that moved on as merge conflicts. Comment
+# threads (keyed by position) are merged (appends + read_by).
+
+
+def new_record_id():
+    return secrets.token_hex(8)
+
+
+def record_version(record):
+    """Per-record version; records written before versioning count as 0."""
+    return record.get("_version", 0)
+
+
+class RecordVersionConflict(ValueError):
+    """A write was based on an older version of the record than the stored one."""
+
+    def __init__(self, idx, expected, current):
+        super().__init__(f"request #{idx} is at version {record_version(current)}, expected {expected}")
+        self.idx = idx
+        self.expected = expected
+        self.current = current
+
+
+def _comment_id(c):
+    return (c.get("author"), c.get("when"), c.get("text"), c.get("attachment"))
+
+
+def _merge_thread(base, mine, theirs):
+    """Three-way merge of a comment thread: keep theirs, add my new entries, union read_by."""
+    merged = [dict(c) for c in theirs]
+    by_id = {_comment_id(c): c for c in merged}
+    for j, c in enumerate(mine):
+        if j < len(base) and base[j] == c:
+            continue
+        target = by_id.get(_comment_id(c))
+        if target is None:
+            merged.append(c)
+            by_id[_comment_id(c)] = c
+        elif "read_by" in c:
+            target["read_by"] = list(dict.fromkeys(target.get("read_by", []) + c["read_by"]))
+    return merged
+
+
+def record_positions(requests):
+    """{_id: index} of the records that have an id."""
+    return {r["_id"]: i for i, r in enumerate(requests) if r.get("_id")}
+
+
+def rebase_events(local_events, base_requests, base_comments, requests, comments):
+    """
+    Replay this session's `local_events` (relative to base_*) onto the stored
+    `requests`/`comments` in place. Records are found by _id (by position for
+    records from before ids). Returns (applied_events, conflicts) where
+    conflicts are {"idx", "base", "theirs", "fields"} for record updates
+    whose stored version moved on, and for edits of records someone else
+    deleted meanwhile ("theirs" is None: nothing left to merge into).
+    """
+    applied, conflicts, gone = [], [], set()
+    added = {}  # session index of an added request -> its _id
+    positions = None  # record_positions(requests), rebuilt after adds/deletes
+
+    def _stored_index(i):
+        """Stored index of the session's record `i`, or None if it is gone."""
+        nonlocal positions
+        rid = added.get(i) or (base_requests[i].get("_id") if i < len(base_requests) else None)
+        if rid is None:  # a record from before ids: same position
+            return i if i < len(requests) else None
+        if positions is None:
+            positions = record_positions(requests)
+        return positions.get(rid)
+
+    for ev in local_events:
+        op = ev["op"]
+        if op == "add_request":
+            record = {**ev["record"], "_version": 1}
+            record.setdefault("_id", new_record_id())
+            added[ev["idx"]] = record["_id"]
+            ev = {**ev, "idx": len(requests), "record": record}
+            positions = None
+        elif op in ("update_request", "delete_request"):
+            i = ev["idx"]
+            j = _stored_index(i)
+            fields = {k: v for k, v in ev.get("set", {}).items() if k != "_version"}
+            if j is None:
+                if i not in gone:
+                    gone.add(i)
+                    conflicts.append({"idx": i, "base": base_requests[i], "theirs": None, "fields": fields})
+                continue
+            if record_version(requests[j]) != record_version(base_requests[i]):
+                conflicts.append({"idx": j, "base": base_requests[i], "theirs": requests[j], "fields": fields})
+                continue
+            if op == "update_request":
+                ev = {**ev, "idx": j, "set": {**ev.get("set", {}), "_version": record_version(requests[j]) + 1}}
+            else:
+                apply_event(base_requests, base_comments, ev)  # later local diffs are relative to this
+                added = {k - (k > i): v for k, v in added.items() if k != i}
+                ev = {**ev, "idx": j}
+                positions = None
+        elif op == "truncate_requests":
+            n = ev["n"]
+            if [r.get("_id") for r in requests[n:]] != [r.get("_id") for r in base_requests[n:]] \
+                    or len(requests) != len(base_requests):
+                continue  # others added or moved records since: don't cut theirs off
+        elif op in ("append_comments", "put_thread", "drop_thread"):
+            key, base = ev["key"], base_comments.get(ev["key"])
+            if key.isdigit():
+                j = _stored_index(int(key))
+                if j is None:
+                    i = int(key)
+                    if i not in gone and i < len(base_requests):
+                        gone.add(i)
+                        conflicts.append({"idx": i, "base": base_requests[i], "theirs": None, "fields": {}})
+                    continue
+                if int(key) in added:  # thread of a record added above
+                    base = None
+                key = str(j)
+                ev = {**ev, "key": key}
+            stored = comments.get(key)
+            if op == "put_thread" and stored is not None and stored != base:
+                ev = {**ev, "thread": _merge_thread(base or [], ev["thread"], stored)}
+            elif op == "drop_thread" and stored != base:
+                continue
+        apply_event(requests, comments, ev)
+        applied.append(ev)
+    return applied, conflicts
+
+
+# ----- COMMENT SEQUENCE NUMBERS -----
+# The writer gives every comment it stores a per-thread "seq" (1, 2, ...);
+# comments from before numbering count by position.
+
+
+def comment_seqs(thread):
+    """The seq of each comment in `thread` (unnumbered ones follow their predecessor)."""
+    seqs, prev = [], 0
+    for c in thread:
+        prev = c.get("seq", prev + 1)
+        seqs.append(prev)
+    return seqs
+
+
+def number_new_comments(events, comments):
+    """Number the comments `events` store (the writer calls this before logging them)."""
+    for ev in events:
+        if ev["op"] not in ("append_comments", "put_thread"):
+            continue
+        fresh = {id(c) for c in ev.get("comments", ev.get("thread", []))}
+        prev = 0
+        for c in comments.get(ev["key"]) or []:
+            if "seq" not in c and id(c) in fresh:
+                c["seq"] = prev + 1
+            prev = c.get("seq", prev + 1)
+
+
+# ----- GROUP-COMMIT WRITER -----
+# Writes to the primary JSONs are jobs for one writer thread per process.
+# Jobs arriving within GROUP_COMMIT_WINDOW of the first are applied to a
+# single read of the stored state and land as one durable write (one
+# change-log append + fsync, one atomic replace + fsync per file). Jobs get
+# the requests parsed whole and the comment threads as a StoredThreads view
+# that reads a thread only when a job touches it. Each caller gets a Future
+# resolving to {"value", "requests", "comments", "signature"} ("comments":
+# only the threads the batch read or wrote; both are the writer's: read
+# only). The log and the data land together or not at all (see
+# commit_events).
+GROUP_COMMIT_WINDOW = 0.05  # seconds
+GROUP_COMMIT_MAX_BATCH = 64
+
+
+@st.cache_resource
+def _group_commit_state():
+    return {"cond": threading.Condition(), "queue": [], "batches": 0, "jobs": 0}
+
+
+def submit_write(job, user=""):
+    """
+    Queue `job(requests, comments) -> (events, value)`; it must mutate the
+    stored state it is given in place and return the events describing that.
+    If it raises, its edits are dropped. Returns a concurrent.futures.Future.
+    """
+    start_group_commit_writer()
+    state = _group_commit_state()
+    fut = Future()
+    with state["cond"]:
+        state["queue"].append((job, user, fut))
+        state["cond"].notify()
+    return fut
+
+
+class StoredThreads(MutableMapping):
+    """
+    The writer's view of the stored comment threads: every key is listed up
+    front, a thread is read and parsed on first access, so a commit touching
+    two threads reads two. `originals` holds the stored text (None: absent)
+    of every thread accessed or replaced, so a failed write can put them back.
+    """
+
+    def __init__(self):
+        self._keys = set(stored_thread_keys())
+        self._threads = {}
+        self.originals = {}
+
+    def _remember(self, keys):
+        unread = [k for k in keys if k not in self.originals]
+        texts = _read_thread_texts([k for k in unread if k in self._keys]) if unread else {}
+        for k in unread:
+            self.originals[k] = texts.get(k)
+        return texts
+
+    def __getitem__(self, key):
+        if key not in self._threads:
+            if key not in self._keys:
+                raise KeyError(key)
+            text = self._remember([key]).get(key, self.originals.get(key))
+            if text is None:  # dropped since the listing
+                raise KeyError(key)
+            self._threads[key] = json.loads(text)
+        return self._threads[key]
+
+    def __setitem__(self, key, thread):
+        self._remember([key])
+        self._keys.add(key)
+        self._threads[key] = thread
+
+    def __delitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        self._remember([key])
+        self._keys.discard(key)
+        self._threads.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def clear(self):
+        self._remember(self._keys)  # one read for all of them, not one per popitem()
+        self._keys.clear()
+        self._threads.clear()
+
+    def loaded(self):
+        """{key: thread} of the threads read or written so far (a plain dict)."""
+        return {k: self._threads[k] for k in self._keys if k in self._threads}
+
+
+def _commit_batch(batch):
+    with primary_lock():
+        recover_pending_commit()
+        requests_text, _ = read_primary_texts(comments=False)
+        if not os.path.exists(EVENT_LOG_FILE):  # the log starts from the state before this batch
+            log_reset(*_read_primary_files(), "initial state", user=batch[0][1])
+        requests, comments = _parse_primary_texts((requests_text, ""))[0], StoredThreads()
+        events, done, landed = [], [], []
+        for job, user, fut in batch:
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                job_events, value = job(requests, comments)
+            except Exception as e:
+                fut.set_exception(e)
+                # drop whatever it changed before raising: replay the batch so far on a fresh copy
+                requests, comments = _parse_primary_texts((requests_text, ""))[0], StoredThreads()
+                events = [ev for text in landed for ev in json.loads(text)]
+                for ev in events:
+                    apply_event(requests, comments, ev)
+                continue
+            job_events = [{**ev, "user": user} for ev in job_events]
+            landed.append(json.dumps(job_events))  # as it left the job, for the replay above
+            events += job_events
+            done.append((fut, value))
+        if not done:
+            return
+        number_new_comments(events, comments)
+
+        def _write():
+            try:
+                write_primary_state(requests, comments, events, durable=True)
+            except Exception:
+                if STORE_BACKEND != "sqlite":  # the files are replaced one by one: put them back
+                    atomic_write_text(REQUESTS_FILE, requests_text, durable=True)
+                    originals = comments.originals
+                    _write_comment_files({k: json.loads(t) for k, t in originals.items() if t is not None},
+                                         keys=set(originals), durable=True)
+                raise
+
+        try:
+            if events:
+                commit_events(events, requests, comments, _write, user="")
+            signature = _primary_signature()
+        except Exception as e:
+            for fut, _ in done:
+                fut.set_exception(e)
+            return
+    try:
+        publish_events(events)
+    except Exception:
+        pass  # subscribers still catch up on their next full reload
+    loaded = comments.loaded()
+    for fut, value in done:
+        fut.set_result({"value": value, "requests": requests, "comments": loaded, "signature": signature})
+
+
+@st.cache_resource
+def start_group_commit_writer():
+    """The per-process writer thread draining submit_write() jobs."""
+    state = _group_commit_state()
+
+    def _loop():
+        while True:
+            with state["cond"]:
+                while not state["queue"]:
+                    state["cond"].wait()
+            time.sleep(GROUP_COMMIT_WINDOW)  # let the burst arrive
+            with state["cond"]:
+                batch = state["queue"][:GROUP_COMMIT_MAX_BATCH]
+                del state["queue"][:GROUP_COMMIT_MAX_BATCH]
+            try:
+                _commit_batch(batch)
+            except Exception as e:  # keep the writer alive; callers see the error
+                for _, _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+            state["batches"] += 1
+            state["jobs"] += len(batch)
+
+    t = threading.Thread(target=_loop, name="group-commit", daemon=True)
+    t.start()
+    return t
+
+
+def replace_primary_state(requests, comments, reason, user=""):
+    """
+    Replace the whole stored state (a restore) through the writer, logged as
+    the events turning the current state into the restored one. Restored
+    records that differ from the stored ones get a _version above every
+    stored version, so a session holding a pre-restore copy fails
+    compare-and-swap instead of matching an old version again, and an _id
+    if they had none.
+    Returns the commit result (see submit_write).
+    """
+    def _bare(r):
+        return {k: v for k, v in r.items() if k not in ("_version", "_id")}
+
+    def _job(stored_requests, stored_comments):
+        top = max((record_version(r) for r in stored_requests + requests), default=0)
+        new_requests, seen = [], set()
+        for i, r in enumerate(requests):
+            old = stored_requests[i] if i < len(stored_requests) else None
+            if old is not None and _bare(old) == _bare(r) and r.get("_id") in (None, old.get("_id")):
+                r = old
+            else:  # restored ids stay (a stale copy then fails on _version); missing ones are added
+                r = {**r, "_version": top + 1, "_id": r.get("_id") or new_record_id()}
+            if r.get("_id") in seen:
+                r = {**r, "_id": new_record_id()}
+            seen.add(r.get("_id"))
+            new_requests.append(r)
+        events = diff_events(stored_requests, stored_comments, new_requests, comments)
+        stored_requests[:] = new_requests
+        stored_comments.clear()
+        stored_comments.update(comments)
+        return [{**ev, "reason": reason} for ev in events], len(events)
+
+    return submit_write(_job, user).result()
+
+
+@st.cache_resource
+def ensure_record_ids():
+    """
+    Once per process: give stored records from before ids one. _version is
+    left alone, so sessions holding them still save their edits (by position).
+    Returns the number of records updated.
+    """
+    def _job(requests, comments):
+        events = []
+        for i, r in enumerate(requests):
+            if not r.get("_id"):
+                r["_id"] = new_record_id()
+                events.append({"op": "update_request", "idx": i, "set": {"_id": r["_id"]}, "reason": "record ids"})
+        return events, len(events)
+
+    return submit_write(_job).result()["value"]
+
+
+# ----- CHANGE-NOTIFICATION BUS -----
+# publish(topic, id) / subscribe(topic). Topics: "request" and "comments",
+# ids are request indexes as strings, "*" means "anything may have changed"
+# (deletes re-index everything, restores replace everything). The writer
+# publishes for every committed event, so subscribers never wake up before
+# the data they are told about is readable.
+#   local: in-process only (one server process)
+#   unix:  also broadcast as datagrams to every worker's socket in NOTIFY_DIR
+NOTIFY_LOG_SIZE = 2000  # notifications kept per process for subscribers to catch up
+
+
+class Subscription:
+    """A cursor into the bus for one topic; poll() returns ids seen since the last poll."""
+
+    def __init__(self, bus, topic):
+        self.bus = bus
+        self.topic = topic
+        self.seq = None  # first poll reports "*" so the subscriber loads once
+
+    def poll(self):
+        ids, self.seq = self.bus._since(self.topic, self.seq)
+        return ids
+
+
+class LocalBus:
+    """In-process bus: publishers and subscribers share one notification log."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._log = deque(maxlen=NOTIFY_LOG_SIZE)
+
+    def publish(self, topic, id):
+        self._deliver(topic, str(id))
+
+    def subscribe(self, topic):
+        return Subscription(self, topic)
+
+    def _deliver(self, topic, id):
+        with self._lock:
+            self._seq += 1
+            self._log.append((self._seq, topic, id))
+
+    def _since(self, topic, seq):
+        with self._lock:
+            head = self._seq
+            if seq is None or (self._log and self._log[0][0] > seq + 1):
+                return {"*"}, head  # new subscriber, or it fell behind the log
+            return {i for s, t, i in self._log if s > seq and t == topic}, head
+
+
+class UnixSocketBus(LocalBus):
+    """
+    Local bus plus a broadcast to the other worker processes on this machine:
+    each process binds NOTIFY_DIR/<pid>.sock (datagram) and a thread feeds
+    what it receives into the local log. Sockets of dead workers are removed.
+    """
+
+    def __init__(self, directory):
+        super().__init__()
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, f"{os.getpid()}.sock")
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        self._out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        threading.Thread(target=self._receive, name="notify-bus", daemon=True).start()
+
+    def publish(self, topic, id):
+        super().publish(topic, id)
+        msg = json.dumps({"t": topic, "id": str(id)}).encode("utf-8")
+        for name in os.listdir(self.directory):
+            peer = os.path.join(self.directory, name)
+            if not name.endswith(".sock") or peer == self.path:
+                continue
+            try:
+                self._out.sendto(msg, peer)
+            except (ConnectionRefusedError, FileNotFoundError):
+                try:
+                    os.remove(peer)  # worker is gone
+                except OSError:
+                    pass
+            except OSError:
+                pass  # peer's buffer is full: it will catch up on its next reload
+
+    def _receive(self):
+        while True:
+            try:
+                data = self._sock.recv(65536)
+                msg = json.loads(data)
+                self._deliver(msg["t"], msg["id"])
+            except Exception:
+                time.sleep(0.1)
+
+
+@st.cache_resource
+def notification_bus():
+    """The process-wide bus (HELP_CENTER_NOTIFY=local|unix; unix by default with the SQLite store)."""
+    if NOTIFY_BACKEND == "unix" and hasattr(socket, "AF_UNIX"):
+        try:
+            return UnixSocketBus(NOTIFY_DIR)
+        except OSError:
+            pass  # e.g. read-only dir: fall back to in-process notifications
+    return LocalBus()
+
+
+def publish(topic, id):
+    notification_bus().publish(topic, id)
+
+
+def subscribe(topic):
+    return notification_bus().subscribe(topic)
+
+
+def publish_events(events):
+    """Publish what a batch of change-log events touched."""
+    for ev in events:
+        if ev["op"] in ("add_request", "update_request"):
+            publish("request", ev["idx"])
+        elif ev["op"] in ("append_comments", "put_thread", "drop_thread"):
+            publish("comments", ev["key"])
+        else:  # delete / truncate / reset re-index or replace everything
+            publish("request", "*")
+            publish("comments", "*")
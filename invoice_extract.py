@@ -0,0 +1,82 @@
+"""
+Text extraction for PDF invoices, run as a child process of the Help Center.
+
+App.py runs `python invoice_extract.py --json <path>` per stored attachment
+(a fresh process, so parsing never shares the app's GIL, memory or threads)
+and reads back the text plus the invoice numbers and totals it could spot.
+A PDF that can't be parsed exits with UNREADABLE_EXIT; any other failure
+(killed, out of memory) is worth retrying.
+
+    python invoice_extract.py invoice.pdf   # print what would be indexed
+"""
+import json
+import re
+import sys
+
+import pdfplumber
+
+MAX_PAGES = 20  # invoices are short; skip the rest of huge scans/catalogs
+MAX_CHARS = 200_000  # text kept per file
+UNREADABLE_EXIT = 3  # exit status of --json for a file that isn't a parseable PDF
+
+INVOICE_NUMBER = re.compile(
+    r"\b(?:invoice|factura|inv)\b\.?\s*(?:no\.?|n[o°º]\.?|number|num\.?|#)?\s*[:#]?\s*"
+    r"([A-Z0-9][A-Z0-9\-/]{2,})",
+    re.IGNORECASE,
+)
+TOTAL = re.compile(
+    r"\b(?:grand\s+total|total\s+due|amount\s+due|balance\s+due|total)\b\s*(?:\(?[A-Z]{3}\)?)?\s*[:=]?\s*"
+    r"\$?\s*(\d{1,3}(?:[,.]\d{3})*(?:[.,]\d{2})|\d+(?:[.,]\d{2})?)",
+    re.IGNORECASE,
+)
+
+
+def _unique(values):
+    seen = []
+    for v in values:
+        if v not in seen:
+            seen.append(v)
+    return seen
+
+
+def extract_invoice(path, max_pages=MAX_PAGES, max_chars=MAX_CHARS):
+    """
+    {"text", "pages", "invoice_numbers", "totals"} of the PDF at `path`.
+    Numbers must contain a digit; totals keep the document's own formatting.
+    """
+    texts = []
+    with pdfplumber.open(path) as pdf:
+        pages = len(pdf.pages)
+        for page in pdf.pages[:max_pages]:
+            texts.append(page.extract_text() or "")
+            page.close()  # drop the page's parsed objects as we go
+    text = "\n".join(texts)[:max_chars]
+    numbers = [m.group(1) for m in INVOICE_NUMBER.finditer(text) if any(ch.isdigit() for ch in m.group(1))]
+    return {
+        "text": text,
+        "pages": pages,
+        "invoice_numbers": _unique(numbers)[:5],
+        "totals": _unique(m.group(1) for m in TOTAL.finditer(text))[:5],
+    }
+
+
+def _main_json(path):
+    """--json mode: the full result as one JSON document on stdout."""
+    try:
+        result = extract_invoice(path)
+    except MemoryError:
+        raise
+    except Exception as e:  # pdfplumber/pdfminer reject the file
+        print(f"{path}: {e!r}", file=sys.stderr)
+        return UNREADABLE_EXIT
+    json.dump(result, sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--json"]:
+        sys.exit(_main_json(sys.argv[2]))
+    for arg in sys.argv[1:]:
+        result = extract_invoice(arg)
+        result["text"] = result["text"][:500]
+        print(json.dumps(result, indent=2, ensure_ascii=False))
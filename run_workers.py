@@ -0,0 +1,73 @@
+"""
+Multi-worker launcher for the Help Center.
+
+Starts N Streamlit server processes on consecutive ports, all serving the
+same dataset through the shared SQLite/WAL store (HELP_CENTER_STORE=sqlite),
+so you can put them behind a reverse proxy with sticky sessions.
+
+    python run_workers.py --workers 4 --base-port 8501
+
+Every worker runs from this directory, so they share helpcenter.db,
+events/, uploads/ and the export folder; attachments are served by all of
+them on one port (HELP_CENTER_FILES_PORT, default 8600). On the first start an existing
+requests.json and comments/ (or comments.json) are imported into the store. Ctrl+C stops all
+workers.
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run several Help Center workers on one shared store.")
+    parser.add_argument("--workers", type=int, default=2, help="number of Streamlit processes (default 2)")
+    parser.add_argument("--base-port", type=int, default=8501, help="port of the first worker (default 8501)")
+    parser.add_argument("--address", default="127.0.0.1", help="address to bind (default 127.0.0.1, behind the proxy)")
+    parser.add_argument("--db", default=None, help="SQLite store path (default helpcenter.db next to App.py)")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env["HELP_CENTER_STORE"] = "sqlite"
+    env["HELP_CENTER_DB"] = os.path.abspath(args.db) if args.db else os.path.join(HERE, "helpcenter.db")
+    env.setdefault("HELP_CENTER_FILES_ADDRESS", args.address)  # the workers share one attachment port
+
+    procs = []
+    for n in range(args.workers):
+        port = args.base_port + n
+        cmd = [
+            sys.executable, "-m", "streamlit", "run", os.path.join(HERE, "App.py"),
+            "--server.port", str(port),
+            "--server.address", args.address,
+            "--server.headless", "true",
+        ]
+        procs.append(subprocess.Popen(cmd, cwd=HERE, env=env))
+        print(f"worker {n + 1}/{args.workers}: http://{args.address}:{port}  (pid {procs[-1].pid})")
+
+    def _stop(*_):
+        for p in procs:
+            if p.poll() is None:
+                p.terminate()
+        for p in procs:
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+    while True:
+        for n, p in enumerate(procs):
+            if p.poll() is not None:
+                print(f"worker {n + 1} exited with {p.returncode}; stopping the others")
+                _stop()
+        time.sleep(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Several writer processes against one store (HELP_CENTER_STORE=json and
+sqlite): each process runs threads that submit_write() compare-and-swap
+patches and comment appends at the same time. Afterwards nothing may be
+lost, comment seqs are unique and contiguous, the change log is contiguous
+and rebuilds the final state, and every stored JSON document parses.
+
+    python -m pytest tests
+"""
+import json
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import wait
+
+import pytest
+
+fcntl = pytest.importorskip("fcntl")  # the store's cross-process locks are POSIX flocks
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import helpcenter_store as store  # noqa: E402
+import streamlit as st  # noqa: E402
+
+WORKERS = 4  # processes
+THREADS = 3  # submitting threads per process
+ROUNDS = 15  # per thread: one CAS patch + one comment append (+ one own-record patch)
+TIMEOUT = 600  # s for all workers together
+
+
+def _worker(workdir, backend, wid, errors):
+    """One writer process; always reports (wid, failures), whatever goes wrong."""
+    failures = []
+    try:
+        os.chdir(workdir)
+        store.STORE_BACKEND = backend
+        own = wid + 1  # request row this process patches without conflicts
+
+        def read_stored():
+            with store.primary_lock(shared=True):
+                return store._parse_primary_texts(store.read_primary_texts())
+
+        def cas_increment():
+            """Bump requests[0]["count"] from the version we read; retry when someone else won."""
+            while True:
+                seen = read_stored()[0][0]
+
+                def job(requests, comments, seen=seen):
+                    rec = requests[0]
+                    if store.record_version(rec) != store.record_version(seen):
+                        raise store.RecordVersionConflict(0, store.record_version(seen), rec)
+                    changed = {"count": seen["count"] + 1, "_version": store.record_version(seen) + 1}
+                    rec.update(changed)
+                    return [{"op": "update_request", "idx": 0, "set": changed}], None
+                try:
+                    return store.submit_write(job, user=f"w{wid}").result(timeout=60)
+                except store.RecordVersionConflict:
+                    continue
+
+        def append_comment(tid, i):
+            comment = {"author": f"w{wid}", "text": f"{wid}-{tid}-{i}", "when": "2025-01-01 10:00"}
+            key = str(i % 3)
+
+            def job(requests, comments):
+                comments.setdefault(key, []).append(comment)
+                return [{"op": "append_comments", "key": key, "comments": [comment]}], None
+            return store.submit_write(job, user=f"w{wid}")
+
+        def patch_own(tid, i):
+            def job(requests, comments):
+                hits = requests[own].get("hits", []) + [f"{tid}-{i}"]
+                requests[own]["hits"] = hits
+                return [{"op": "update_request", "idx": own, "set": {"hits": hits}}], None
+            return store.submit_write(job, user=f"w{wid}")
+
+        def run(tid):
+            try:
+                for i in range(ROUNDS):
+                    futures = [append_comment(tid, i), patch_own(tid, i)]
+                    cas_increment()
+                    wait(futures)
+                    for fut in futures:
+                        fut.result()
+                    requests, comments = read_stored()  # a reader mid-stream must always parse
+                    assert len(requests) == WORKERS + 1
+            except Exception as e:
+                failures.append(repr(e))
+
+        threads = [threading.Thread(target=run, args=(tid,)) for tid in range(THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    except BaseException as e:
+        failures.append(repr(e))
+    finally:
+        errors.put((wid, failures[:10]))  # reported to the parent, which fails the test
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_concurrent_writers(tmp_path, monkeypatch, backend):
+    monkeypatch.chdir(tmp_path)
+    requests = [{"Type": "📑", "Status": "OPEN", "count": 0, "_version": 1}]
+    requests += [{"Type": "📑", "Status": f"worker {w}", "_version": 1} for w in range(WORKERS)]
+    with open("requests.json", "w", encoding="utf-8") as f:
+        json.dump(requests, f)
+    with open("comments.json", "w", encoding="utf-8") as f:
+        json.dump({"0": [], "1": [], "2": []}, f)
+
+    st.cache_resource.clear()  # no process state from the previous backend leaks into the workers
+    store.STORE_BACKEND = backend
+    ctx = multiprocessing.get_context("fork")
+    errors = ctx.Queue()
+    procs = [ctx.Process(target=_worker, args=(str(tmp_path), backend, w, errors)) for w in range(WORKERS)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(timeout=TIMEOUT)  # each report is small, so a finished worker never blocks on the queue
+    hung = [p for p in procs if p.is_alive()]
+    for p in hung:
+        p.kill()
+    assert not hung, f"{len(hung)} worker(s) still running after {TIMEOUT} s"
+    assert [p.exitcode for p in procs] == [0] * WORKERS
+    reports = dict(errors.get(timeout=10) for _ in procs)
+    assert reports == {w: [] for w in range(WORKERS)}
+
+    with store.primary_lock(shared=True):
+        texts = store.read_primary_texts()
+    requests, comments = json.loads(texts[0]), json.loads(texts[1])
+
+    # no lost updates
+    updates = WORKERS * THREADS * ROUNDS
+    assert requests[0]["count"] == updates
+    assert requests[0]["_version"] == 1 + updates
+    for w in range(WORKERS):
+        hits = requests[w + 1]["hits"]
+        assert sorted(hits) == sorted(f"{t}-{i}" for t in range(THREADS) for i in range(ROUNDS))
+    texts_stored = [c["text"] for thread in comments.values() for c in thread]
+    assert sorted(texts_stored) == sorted(f"{w}-{t}-{i}" for w in range(WORKERS)
+                                          for t in range(THREADS) for i in range(ROUNDS))
+
+    # comment seqs unique and contiguous per thread
+    for thread in comments.values():
+        assert [c["seq"] for c in thread] == list(range(1, len(thread) + 1))
+
+    # the change log is contiguous and rebuilds exactly the stored state
+    with open(store.EVENT_LOG_FILE, "r", encoding="utf-8") as f:
+        seqs = [json.loads(line)["seq"] for line in f]
+    assert seqs == list(range(1, len(seqs) + 1))
+    assert not os.path.exists(store.EVENT_PENDING_FILE)
+    rebuilt_requests, rebuilt_comments, last_seq = store.rebuild_from_events()
+    assert (rebuilt_requests, rebuilt_comments, last_seq) == (requests, comments, seqs[-1])
+
+    # every JSON document on disk parses
+    if backend == "json":
+        with open("requests.json", "r", encoding="utf-8") as f:
+            assert json.load(f) == requests
+        names = [n for n in os.listdir("comments") if n.endswith(".json")]
+        assert sorted(names) == ["0.json", "1.json", "2.json"]
+        for name in names:
+            with open(os.path.join("comments", name), "r", encoding="utf-8") as f:
+                assert json.load(f) == comments[name[:-5]]
+    assert not [n for n in os.listdir(".") if n.endswith(".tmp")]
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
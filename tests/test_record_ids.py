@@ -0,0 +1,108 @@
+"""
+Records are addressed by their stable _id, not by position: a session that
+loaded the store before someone else deleted a record must still save its
+edits to the records it meant (and learn that the deleted one is gone).
+
+    python -m pytest tests
+"""
+import json
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("fcntl")  # the store's cross-process locks are POSIX flocks
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import helpcenter_store as store  # noqa: E402
+import streamlit as st  # noqa: E402
+
+
+def _records(n):
+    return [{"Type": "📑", "Status": f"r{i}", "_id": f"id{i}", "_version": 1} for i in range(n)]
+
+
+def _stored():
+    with store.primary_lock(shared=True):
+        return store._parse_primary_texts(store.read_primary_texts())
+
+
+def _save(base_requests, base_comments, requests, comments, hints=()):
+    """What App.save_data() submits: the session's edits, rebased in the writer (base_comments: the threads it holds)."""
+    baseline = json.dumps([base_requests, base_comments])
+    hints = json.loads(json.dumps(list(hints)))
+    base_requests, base_comments = json.loads(baseline)
+    for ev in hints:
+        store.apply_event(base_requests, base_comments, ev)
+    edits = store.diff_events(base_requests, base_comments, requests, comments)
+
+    def job(stored_requests, stored_comments):
+        base_requests, base_comments = json.loads(baseline)
+        applied, conflicts = store.rebase_events(hints, base_requests, base_comments, stored_requests, stored_comments)
+        more, more_conflicts = store.rebase_events(edits, base_requests, base_comments, stored_requests, stored_comments)
+        return applied + more, conflicts + more_conflicts
+
+    return store.submit_write(job).result(timeout=60)["value"]
+
+
+@pytest.fixture
+def json_store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(store, "STORE_BACKEND", "json")
+    st.cache_resource.clear()
+    with open("requests.json", "w", encoding="utf-8") as f:
+        json.dump(_records(4), f)
+    with open("comments.json", "w", encoding="utf-8") as f:
+        json.dump({"0": [], "1": [], "2": [], "3": []}, f)
+    yield
+    st.cache_resource.clear()
+
+
+def test_stale_edit_after_delete_lands_on_the_same_record(json_store):
+    base_requests, base_comments = _stored()
+
+    # someone else deletes record #1: #2 and #3 move up
+    other = json.loads(json.dumps(base_requests))
+    del other[1]
+    assert _save(base_requests, {}, other, {}, hints=[{"op": "delete_request", "idx": 1}]) == []
+
+    # this session still holds the pre-delete copy and edits #2, #1 and #3's thread
+    mine_requests = json.loads(json.dumps(base_requests))
+    mine_comments = json.loads(json.dumps(base_comments))
+    mine_requests[2]["Status"] = "edited"
+    mine_requests[1]["Status"] = "edited too"
+    mine_comments["3"] = [{"author": "a", "text": "hi", "when": "2025-01-01 10:00"}]
+    conflicts = _save(base_requests, base_comments, mine_requests, mine_comments)
+
+    requests, comments = _stored()
+    assert [r["_id"] for r in requests] == ["id0", "id2", "id3"]
+    assert [r["Status"] for r in requests] == ["r0", "edited", "r3"]
+    assert requests[1]["_version"] == 2
+    assert [c["text"] for c in comments["2"]] == ["hi"]  # #3's thread is stored under its new position
+    assert comments["1"] == []
+    assert [(c["idx"], c["theirs"], c["fields"]) for c in conflicts] == [(1, None, {"Status": "edited too"})]
+
+    # the change log still rebuilds exactly what is stored
+    rebuilt_requests, rebuilt_comments, _ = store.rebuild_from_events()
+    assert (rebuilt_requests, rebuilt_comments) == (requests, comments)
+
+
+def test_stale_delete_removes_the_record_it_meant(json_store):
+    base_requests, _ = _stored()
+    other = json.loads(json.dumps(base_requests))
+    del other[0]
+    _save(base_requests, {}, other, {}, hints=[{"op": "delete_request", "idx": 0}])
+
+    mine = json.loads(json.dumps(base_requests))
+    del mine[2]
+    assert _save(base_requests, {}, mine, {}, hints=[{"op": "delete_request", "idx": 2}]) == []
+    assert [r["_id"] for r in _stored()[0]] == ["id1", "id3"]
+
+
+def test_records_from_before_ids_get_one(json_store):
+    with open("requests.json", "w", encoding="utf-8") as f:
+        json.dump([{"Type": "📑", "_version": 3}, {"Type": "📑", "_id": "kept"}], f)
+    assert store.ensure_record_ids() == 1
+    requests, _ = _stored()
+    assert requests[0]["_id"] and requests[0]["_version"] == 3
+    assert requests[1]["_id"] == "kept"